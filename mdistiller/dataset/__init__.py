@@ -1,14 +1,29 @@
+import os
+
 from mdistiller.engine.utils import is_distributed
+from mdistiller.engine.cfg import get_teacher_tag
+from mdistiller.engine.device import configure_dataloader, get_device, get_memory_format
+from mdistiller.engine.prefetcher import DevicePrefetcher
 
-from .cifar100 import get_cifar100_dataloaders, get_cifar100_dataloaders_sample
+from .cifar100 import get_cifar100_dataloaders, get_cifar100_dataloaders_sample, CIFAR100_MEAN, CIFAR100_STD
 from .imagenet import get_imagenet_dataloaders
 from .tiny_imaganet import get_tiny_imagenet_dataloaders
 from .cub2011 import get_cub2011_dataloaders
 from .dtd import get_dtd_dataloaders
 from .food101 import get_food101_dataloaders
-
-def get_dataset(cfg):
-    return {
+from .teacher_cache import (
+    TeacherFeatureCache,
+    open_teacher_cache,
+    get_replay_loader
+)
+from .region_labels import TeacherRegionMap, get_region_label_loader
+
+def get_dataset(cfg, teacher_feature_keys=None):
+    """
+        teacher_feature_keys: the teacher features of the distiller (see
+            Distiller.get_teacher_feature_keys), read from TEACHER_CACHE if any.
+    """
+    train_loader, val_loader, num_data, num_classes = {
         "cifar100": get_cifar,
         "imagenet": get_imagenet,
         "tiny-imagenet": get_tiny_imagenet,
@@ -17,6 +32,107 @@ def get_dataset(cfg):
         "food101": get_food101
     }[cfg.DATASET.TYPE](cfg)
 
+    if cfg.TEACHER_CACHE.ENABLE and not cfg.TEACHER_CACHE.AUGMENT:
+        # train on the un-augmented samples, eg: for a cache with NUM_VIEWS=1
+        train_loader.dataset.transform = val_loader.dataset.transform
+
+    if cfg.TEACHER_CACHE.ENABLE:
+        train_loader = get_teacher_cache_loader(
+            train_loader, cfg, num_data, num_classes, teacher_feature_keys)
+
+    if cfg.REGION_LABELS.ENABLE:
+        if cfg.TEACHER_CACHE.ENABLE:
+            raise ValueError("REGION_LABELS can not be used with TEACHER_CACHE")
+        train_loader = get_region_label_loader(
+            train_loader, get_region_map(cfg, num_data, num_classes))
+
+    train_loader = configure_dataloader(train_loader, cfg)
+    val_loader = configure_dataloader(val_loader, cfg)
+
+    # the loaders yield batches that are already on the device
+    device = get_device(cfg)
+    memory_format = get_memory_format(cfg, device)
+    normalize = get_device_normalize(cfg)
+    train_loader = DevicePrefetcher(
+        train_loader, device, memory_format, normalize,
+        use_stream=cfg.DATASET.DEVICE_PREFETCH)
+    val_loader = DevicePrefetcher(
+        val_loader, device, memory_format, normalize,
+        use_stream=cfg.DATASET.DEVICE_PREFETCH)
+
+    return train_loader, val_loader, num_data, num_classes
+
+
+def get_teacher_cache_meta(cfg, num_data, num_classes):
+    # the cache is only valid for the same samples & augmentations
+    return dict(
+        dataset=cfg.DATASET.TYPE,
+        teacher=get_teacher_tag(cfg),
+        enhance_augment=cfg.DATASET.ENHANCE_AUGMENT,
+        augment=cfg.TEACHER_CACHE.AUGMENT,
+        seed=cfg.TEACHER_CACHE.SEED,
+        num_data=num_data,
+        num_classes=num_classes,
+    )
+
+
+def get_teacher_cache_loader(train_loader, cfg, num_data, num_classes, feature_keys=None):
+    """
+        The train loader replays the augmentations of the cache,
+        and yields the cached teacher logits as the last item.
+        A topk cache yields its sparse (values, indices, tail), see
+        TopKTeacherLogitCache & gdkd_loss_topk.
+        If feature_keys is not empty & the cache has teacher features (`features/`),
+        they are yielded after the logits.
+    """
+    meta = get_teacher_cache_meta(cfg, num_data, num_classes)
+    cache = open_teacher_cache(cfg.TEACHER_CACHE.PATH)
+    cache.check(**meta)
+    feature_path = os.path.join(cfg.TEACHER_CACHE.PATH, "features")
+    feature_cache = None
+    if feature_keys and os.path.exists(os.path.join(feature_path, TeacherFeatureCache.meta_file)):
+        feature_cache = TeacherFeatureCache(feature_path)
+        feature_cache.check(num_views=cache.num_views, **meta)
+    return get_replay_loader(
+        train_loader, cfg.TEACHER_CACHE.SEED, cache.num_views,
+        cache=cache, feature_cache=feature_cache,
+        sparse=cache.meta.get("format") == "topk")
+
+
+def get_region_map_meta(cfg, num_data, num_classes):
+    # the map is only valid for the same samples & teacher
+    return dict(
+        dataset=cfg.DATASET.TYPE,
+        teacher=get_teacher_tag(cfg),
+        resolution=cfg.REGION_LABELS.RESOLUTION,
+        num_data=num_data,
+        num_classes=num_classes,
+    )
+
+
+def get_region_map(cfg, num_data, num_classes):
+    """
+        The train loader yields the crop box & the teacher logits pooled from
+        the region map as the last items, see RegionLabelDataset.
+    """
+    if cfg.DATASET.TYPE == "cifar100":
+        raise NotImplementedError("REGION_LABELS requires a RandomResizedCrop dataset")
+    region_map = TeacherRegionMap(cfg.REGION_LABELS.PATH)
+    region_map.check(**get_region_map_meta(cfg, num_data, num_classes))
+    return region_map
+
+
+def get_device_normalize(cfg):
+    """
+        Returns: (mean, std) if the images are normalized on the device, else None.
+    """
+    if not cfg.DATASET.DEVICE_NORMALIZE:
+        return None
+    if cfg.DATASET.TYPE != "cifar100":
+        raise NotImplementedError(
+            f"DATASET.DEVICE_NORMALIZE is not supported for {cfg.DATASET.TYPE}")
+    return CIFAR100_MEAN, CIFAR100_STD
+
 
 def get_cifar(cfg):
     if is_distributed():
@@ -29,14 +145,22 @@ def get_cifar(cfg):
             num_workers=cfg.DATASET.NUM_WORKERS,
             k=cfg.CRD.NCE.K,
             mode=cfg.CRD.MODE,
-            enhance_augment=cfg.DATASET.ENHANCE_AUGMENT
+            enhance_augment=cfg.DATASET.ENHANCE_AUGMENT,
+            pin_memory=cfg.DATASET.PIN_MEMORY,
+            persistent_workers=cfg.DATASET.PERSISTENT_WORKERS,
+            prefetch_factor=cfg.DATASET.PREFETCH_FACTOR,
+            device_normalize=cfg.DATASET.DEVICE_NORMALIZE
         )
     else:
         train_loader, val_loader, num_data = get_cifar100_dataloaders(
             batch_size=cfg.SOLVER.BATCH_SIZE,
             val_batch_size=cfg.DATASET.TEST.BATCH_SIZE,
             num_workers=cfg.DATASET.NUM_WORKERS,
-            enhance_augment=cfg.DATASET.ENHANCE_AUGMENT
+            enhance_augment=cfg.DATASET.ENHANCE_AUGMENT,
+            pin_memory=cfg.DATASET.PIN_MEMORY,
+            persistent_workers=cfg.DATASET.PERSISTENT_WORKERS,
+            prefetch_factor=cfg.DATASET.PREFETCH_FACTOR,
+            device_normalize=cfg.DATASET.DEVICE_NORMALIZE
         )
     num_classes = 100
 
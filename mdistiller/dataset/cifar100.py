@@ -7,6 +7,10 @@ from PIL import Image
 
 
 from .transforms.cutout import Cutout
+from .sampler import ResumableSampler
+
+CIFAR100_MEAN = (0.5071, 0.4867, 0.4408)
+CIFAR100_STD = (0.2675, 0.2565, 0.2761)
 
 
 def get_data_folder():
@@ -128,8 +132,7 @@ def get_cifar100_train_transform_with_autoaugment():
             AutoAugment(AutoAugmentPolicy.CIFAR10, fill=128),
             transforms.ToTensor(),
             Cutout(n_holes=1, length=16),
-            transforms.Normalize(
-                (0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)),
+            transforms.Normalize(CIFAR100_MEAN, CIFAR100_STD),
         ]
     )
 
@@ -145,45 +148,75 @@ def get_cifar100_train_transform_with_randomaugment():
             RandAugment(2, 10),
             transforms.ToTensor(),
             Cutout(n_holes=1, length=16),
-            transforms.Normalize(
-                (0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)),
+            transforms.Normalize(CIFAR100_MEAN, CIFAR100_STD),
         ]
     )
 
     return train_transform
 
 
-def get_cifar100_train_transform():
+def get_cifar100_train_transform(device_normalize=False):
+    if device_normalize:
+        # return uint8 images, which are normalized on the device
+        return transforms.Compose(
+            [
+                transforms.RandomCrop(32, padding=4),
+                transforms.RandomHorizontalFlip(),
+                transforms.PILToTensor(),
+            ]
+        )
+
     train_transform = transforms.Compose(
         [
             transforms.RandomCrop(32, padding=4),
             transforms.RandomHorizontalFlip(),
             transforms.ToTensor(),
-            transforms.Normalize((0.5071, 0.4867, 0.4408),
-                                 (0.2675, 0.2565, 0.2761)),
+            transforms.Normalize(CIFAR100_MEAN, CIFAR100_STD),
         ]
     )
 
     return train_transform
 
 
-def get_cifar100_test_transform():
+def get_cifar100_test_transform(device_normalize=False):
+    if device_normalize:
+        return transforms.PILToTensor()
+
     return transforms.Compose(
         [
             transforms.ToTensor(),
-            transforms.Normalize((0.5071, 0.4867, 0.4408),
-                                 (0.2675, 0.2565, 0.2761)),
+            transforms.Normalize(CIFAR100_MEAN, CIFAR100_STD),
         ]
     )
 
 
-def get_cifar100_dataloaders(batch_size, val_batch_size, num_workers, enhance_augment=False):
-    data_folder = get_data_folder()
+def _get_train_transform(enhance_augment, device_normalize):
     if enhance_augment:
-        train_transform = get_cifar100_train_transform_with_autoaugment()
+        if device_normalize:
+            raise ValueError(
+                "device_normalize is not supported with enhance_augment (Cutout needs float images)")
+        return get_cifar100_train_transform_with_autoaugment()
     else:
-        train_transform = get_cifar100_train_transform()
-    test_transform = get_cifar100_test_transform()
+        return get_cifar100_train_transform(device_normalize)
+
+
+def _get_loader_kwargs(num_workers, pin_memory, persistent_workers, prefetch_factor):
+    kwargs = dict(num_workers=num_workers, pin_memory=pin_memory)
+    if num_workers > 0:
+        kwargs.update(
+            persistent_workers=persistent_workers,
+            prefetch_factor=prefetch_factor
+        )
+    return kwargs
+
+
+def get_cifar100_dataloaders(batch_size, val_batch_size, num_workers, enhance_augment=False,
+                             pin_memory=True, persistent_workers=True, prefetch_factor=2, device_normalize=False):
+    data_folder = get_data_folder()
+    train_transform = _get_train_transform(enhance_augment, device_normalize)
+    test_transform = get_cifar100_test_transform(device_normalize)
+    loader_kwargs = _get_loader_kwargs(
+        num_workers, pin_memory, persistent_workers, prefetch_factor)
     train_set = CIFAR100Instance(
         root=data_folder, download=True, train=True, transform=train_transform
     )
@@ -193,27 +226,27 @@ def get_cifar100_dataloaders(batch_size, val_batch_size, num_workers, enhance_au
     )
 
     train_loader = DataLoader(
-        train_set, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        train_set, batch_size=batch_size, sampler=ResumableSampler(train_set), **loader_kwargs
     )
     test_loader = DataLoader(
         test_set,
         batch_size=val_batch_size,
         shuffle=False,
-        num_workers=1,
+        **loader_kwargs
     )
     return train_loader, test_loader, num_data
 
 
 # CIFAR-100 for CRD
 def get_cifar100_dataloaders_sample(
-    batch_size, val_batch_size, num_workers, k, mode="exact", enhance_augment=False
+    batch_size, val_batch_size, num_workers, k, mode="exact", enhance_augment=False,
+    pin_memory=True, persistent_workers=True, prefetch_factor=2, device_normalize=False
 ):
     data_folder = get_data_folder()
-    if enhance_augment:
-        train_transform = get_cifar100_train_transform_with_autoaugment()
-    else:
-        train_transform = get_cifar100_train_transform()
-    test_transform = get_cifar100_test_transform()
+    train_transform = _get_train_transform(enhance_augment, device_normalize)
+    test_transform = get_cifar100_test_transform(device_normalize)
+    loader_kwargs = _get_loader_kwargs(
+        num_workers, pin_memory, persistent_workers, prefetch_factor)
 
     train_set = CIFAR100InstanceSample(
         root=data_folder,
@@ -231,12 +264,12 @@ def get_cifar100_dataloaders_sample(
     )
 
     train_loader = DataLoader(
-        train_set, batch_size=batch_size, shuffle=True, num_workers=num_workers
+        train_set, batch_size=batch_size, sampler=ResumableSampler(train_set), **loader_kwargs
     )
     test_loader = DataLoader(
         test_set,
         batch_size=val_batch_size,
         shuffle=False,
-        num_workers=num_workers,
+        **loader_kwargs
     )
     return train_loader, test_loader, num_data
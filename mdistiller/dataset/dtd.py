@@ -5,14 +5,14 @@ import torch
 from torchvision.datasets import DTD
 from torchvision.datasets.folder import default_loader
 import torchvision.transforms as transforms
-from torch.utils.data import DistributedSampler, DataLoader
+from torch.utils.data import DataLoader
 import pandas as pd
 
 from functools import reduce
 from pathlib import Path
 
 from mdistiller.engine.utils import log_msg
-from .sampler import DistributedEvalSampler
+from .sampler import DistributedEvalSampler, ResumableSampler
 from .instance_sample import InstanceSample
 from .imagenet import (
     get_imagenet_train_transform,
@@ -62,15 +62,11 @@ def get_dtd_dataloaders(batch_size, val_batch_size, k=-1, num_workers=4, is_dist
         data_folder, split="train", transform=train_transform, k=k, download=True)
     num_data = len(train_set)
 
-    if is_distributed:
-        train_sampler = DistributedSampler(train_set)
-    else:
-        train_sampler = None
+    train_sampler = ResumableSampler(train_set)
 
     train_loader = DataLoader(
         train_set,
         batch_size=batch_size,
-        shuffle=not is_distributed,
         num_workers=num_workers,
         pin_memory=True,
         sampler=train_sampler
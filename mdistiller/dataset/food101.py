@@ -2,13 +2,13 @@ import os
 import torch
 from torchvision.datasets import Food101 as Food101Base
 
-from torch.utils.data import DistributedSampler, DataLoader
+from torch.utils.data import DataLoader
 
 import PIL.Image
 import io
 
 from mdistiller.engine.utils import log_msg
-from .sampler import DistributedEvalSampler
+from .sampler import DistributedEvalSampler, ResumableSampler
 from .instance_sample import InstanceSample
 from .imagenet import (
     get_imagenet_train_transform,
@@ -86,15 +86,11 @@ def get_food101_dataloaders(batch_size, val_batch_size, k=-1, num_workers=4, is_
         data_folder, split="train", transform=train_transform, k=k, download=True)
     num_data = len(train_set)
 
-    if is_distributed:
-        train_sampler = DistributedSampler(train_set)
-    else:
-        train_sampler = None
+    train_sampler = ResumableSampler(train_set)
 
     train_loader = DataLoader(
         train_set,
         batch_size=batch_size,
-        shuffle=not is_distributed,
         num_workers=num_workers,
         pin_memory=True,
         sampler=train_sampler
@@ -4,8 +4,7 @@ import torch
 from torchvision.datasets import ImageNet
 import torchvision.transforms as transforms
 
-from torch.utils.data.distributed import DistributedSampler
-from .sampler import DistributedEvalSampler
+from .sampler import DistributedEvalSampler, ResumableSampler
 from .instance_sample import InstanceSample
 
 data_folder = os.path.join(os.path.dirname(
@@ -72,14 +71,10 @@ def get_imagenet_dataloaders(batch_size, val_batch_size, k=-1, num_workers=16, i
     train_set = ImageNetInstanceSample(data_folder, split='train',
                          transform=train_transform,  k=k)
     num_data = len(train_set)
-    if is_distributed:
-        train_sampler = DistributedSampler(train_set)
-    else:
-        train_sampler = None
+    train_sampler = ResumableSampler(train_set)
     train_loader = torch.utils.data.DataLoader(
         train_set,
         batch_size=batch_size,
-        shuffle=not is_distributed,
         num_workers=num_workers,
         pin_memory=True,
         sampler=train_sampler
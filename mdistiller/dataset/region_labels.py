@@ -0,0 +1,250 @@
+import os
+import json
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision.transforms as transforms
+from torch.utils.data import Dataset, DataLoader
+
+from .sampler import ResumableSampler
+from .transforms.crop_box import RandomResizedCropWithBox
+
+
+class TeacherRegionMap():
+    """
+        Spatial teacher logit maps of the train set, stored in memory-mapped
+        fp16 arrays: [num_data, grid, grid, num_classes] for the "dense" format;
+        for the "topk" format, the topk logits & int16 indices of each cell and
+        one fill logit for its other classes (the mean of their logits).
+        `meta.json` records how the maps are generated.
+    """
+
+    meta_file = "meta.json"
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, self.meta_file), "r") as f:
+            self.meta = json.load(f)
+        # opened lazily: memmaps must not be pickled to the dataloader workers
+        self._arrays = None
+
+    @classmethod
+    def create(cls, path, num_data, num_classes, grid, format="dense", topk=0, **meta):
+        if format not in ["dense", "topk"]:
+            raise ValueError(f"Unknown REGION_LABELS.FORMAT: {format}")
+        os.makedirs(path, exist_ok=True)
+        shape = (num_data, grid, grid)
+        if format == "dense":
+            arrays = {"logits": (np.float16, shape + (num_classes,))}
+        else:
+            arrays = {
+                "values": (np.float16, shape + (topk,)),
+                "indices": (np.int16, shape + (topk,)),
+                "fill": (np.float16, shape),
+            }
+        for name, (dtype, array_shape) in arrays.items():
+            array = np.lib.format.open_memmap(
+                os.path.join(path, f"{name}.npy"), mode="w+", dtype=dtype, shape=array_shape)
+            del array
+        meta.update(
+            format=format,
+            num_data=num_data,
+            num_classes=num_classes,
+            grid=grid,
+            topk=topk,
+            arrays=list(arrays),
+            finished=False,
+        )
+        with open(os.path.join(path, cls.meta_file), "w") as f:
+            json.dump(meta, f, indent=4)
+        return cls(path, mode="r+")
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = {
+                name: np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode=self.mode)
+                for name in self.meta["arrays"]
+            }
+        return self._arrays
+
+    @property
+    def grid(self):
+        return self.meta["grid"]
+
+    def get(self, index):
+        """
+            Returns: the dense fp32 logit map [grid, grid, num_classes] of a sample.
+        """
+        if self.meta["format"] == "dense":
+            return self.arrays["logits"][index].astype(np.float32)
+        arrays = self.arrays
+        logits = np.repeat(
+            arrays["fill"][index].astype(np.float32)[..., None], self.meta["num_classes"], axis=-1)
+        np.put_along_axis(
+            logits, arrays["indices"][index].astype(np.int64),
+            arrays["values"][index].astype(np.float32), axis=-1)
+        return logits
+
+    def pool(self, index, box):
+        """
+            Returns: the teacher logits [num_classes] of the crop box (x0, y0, x1, y1),
+                ie: the mean of the logit map over the box, weighted by the cell areas.
+        """
+        weights = get_box_weights(box, self.grid)
+        logits = np.tensordot(weights, self.get(index), axes=([0, 1], [0, 1]))
+        return logits / weights.sum()
+
+    def write(self, indices, logit_maps):
+        """
+            logit_maps: the fp32 logit maps [B, grid, grid, num_classes]
+        """
+        if self.meta["format"] == "dense":
+            self.arrays["logits"][indices] = logit_maps.astype(np.float16)
+            return
+        values, topk_indices, fill = compress_region_logits(
+            torch.from_numpy(logit_maps), self.meta["topk"])
+        self.arrays["values"][indices] = values.numpy().astype(np.float16)
+        self.arrays["indices"][indices] = topk_indices.numpy().astype(np.int16)
+        self.arrays["fill"][indices] = fill.numpy().astype(np.float16)
+
+    def finish(self):
+        for array in self.arrays.values():
+            array.flush()
+        self.meta["finished"] = True
+        with open(os.path.join(self.path, self.meta_file), "w") as f:
+            json.dump(self.meta, f, indent=4)
+
+    def check(self, **expected):
+        if not self.meta["finished"]:
+            raise ValueError("Region label map {} is incomplete".format(self.path))
+        for k, v in expected.items():
+            if self.meta.get(k) != v:
+                raise ValueError("Region label map {} mismatch: {}={}, expected {}".format(
+                    self.path, k, self.meta.get(k), v))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+
+def compress_region_logits(logits, k):
+    """
+        Keep the topk logits of each cell, the other classes share one fill logit.
+        Returns: values [..., k], indices [..., k], fill [...]
+    """
+    logits = logits.float()
+    values, indices = logits.topk(k, dim=-1)
+    num_others = max(logits.shape[-1] - k, 1)
+    fill = (logits.sum(-1) - values.sum(-1)) / num_others
+    return values, indices, fill
+
+
+def get_box_weights(box, grid):
+    """
+        Returns: the area of the crop box (x0, y0, x1, y1) in each cell of the
+            grid x grid map [grid, grid], in the (normalized) image coordinates.
+    """
+    x0, y0, x1, y1 = box
+    edges = np.arange(grid + 1, dtype=np.float64) / grid
+    wx = np.clip(np.minimum(edges[1:], x1) - np.maximum(edges[:-1], x0), 0, None)
+    wy = np.clip(np.minimum(edges[1:], y1) - np.maximum(edges[:-1], y0), 0, None)
+    return np.outer(wy, wx)
+
+
+def get_region_logits(teacher, image, grid):
+    """
+        The spatial logit map of a teacher with a global average pooling and a
+        linear `fc` head (the imagenet ResNet & MobileNetV1): the head is applied
+        to each location of the last feature map, which is average pooled to the
+        grid x grid cells. The mean of the map equals the teacher logits when the
+        feature map size is a multiple of grid.
+        Returns: (logit_map [B, grid, grid, num_classes], logits [B, num_classes])
+    """
+    fc = getattr(teacher, "fc", None)
+    if not isinstance(fc, torch.nn.Linear):
+        raise ValueError(
+            "REGION_LABELS requires a teacher with a linear fc head, got {}".format(type(teacher).__name__))
+    logits, feats = teacher(image)
+    # the head in fp32, also under autocast
+    with torch.autocast(device_type=image.device.type, enabled=False):
+        feat = feats["feats"][-1].float()
+        logit_map = F.conv2d(
+            F.adaptive_avg_pool2d(feat, grid), fc.weight.float()[:, :, None, None], fc.bias.float())
+    return logit_map.permute(0, 2, 3, 1), logits
+
+
+def get_region_transform(train_transform, resolution):
+    """
+        The precompute transform: the full image resized to resolution x resolution,
+        with the normalization of the train transform.
+    """
+    normalize = [t for t in train_transform.transforms if isinstance(t, transforms.Normalize)]
+    return transforms.Compose([
+        transforms.Resize((resolution, resolution)),
+        transforms.ToTensor(),
+        *normalize,
+    ])
+
+
+class RegionLabelDataset(Dataset):
+    """
+        Record the RandomResizedCrop box of each sample, and append the crop box
+        [4] & the teacher logits pooled over it from the region map to the sample.
+        The RandomResizedCrop of the dataset transform is replaced in place.
+    """
+
+    def __init__(self, dataset, region_map):
+        self.dataset = dataset
+        self.region_map = region_map
+        crops = [
+            (i, t) for i, t in enumerate(getattr(dataset.transform, "transforms", []))
+            if isinstance(t, transforms.RandomResizedCrop)
+        ]
+        if len(crops) != 1:
+            raise ValueError(
+                "REGION_LABELS requires one RandomResizedCrop in the train transform, "
+                "eg: DATASET.ENHANCE_AUGMENT is not supported")
+        i, crop = crops[0]
+        self.crop = RandomResizedCropWithBox.from_crop(crop)
+        dataset.transform.transforms[i] = self.crop
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        # forward the attributes of the dataset, eg: classes
+        if name == "dataset":
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, index):
+        data = self.dataset[index]
+        box = self.crop.box
+        logits = self.region_map.pool(index, box)
+        return (*data, torch.tensor(box, dtype=torch.float32), torch.from_numpy(logits).float())
+
+
+def get_region_label_loader(loader, region_map):
+    """
+        Rebuild a train loader that yields the crop box & the region teacher logits.
+    """
+    dataset = RegionLabelDataset(loader.dataset, region_map)
+    kwargs = dict(
+        batch_size=loader.batch_size,
+        num_workers=loader.num_workers,
+        pin_memory=loader.pin_memory,
+        drop_last=loader.drop_last,
+        collate_fn=loader.collate_fn,
+        worker_init_fn=loader.worker_init_fn,
+    )
+    if loader.num_workers > 0:
+        kwargs.update(
+            persistent_workers=loader.persistent_workers,
+            prefetch_factor=loader.prefetch_factor,
+        )
+    sampler = ResumableSampler(dataset, seed=getattr(loader.sampler, "seed", None))
+    return DataLoader(dataset, sampler=sampler, **kwargs)
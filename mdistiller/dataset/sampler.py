@@ -1,7 +1,23 @@
 import torch
+import torch.distributed as dist
 from torch.utils.data import DistributedSampler, Dataset
 from typing import TypeVar, Optional, Iterator
 
+from mdistiller.engine.utils import get_rank, get_world_size, is_distributed
+
+
+def get_shared_seed() -> int:
+    """
+        A seed from the global torch seed (eg: `--seed`, or random when unset),
+        the one of rank 0 on all ranks.
+    """
+    seed = torch.initial_seed() % 2**31
+    if is_distributed():
+        seeds = [seed]
+        dist.broadcast_object_list(seeds, src=0)
+        seed = seeds[0]
+    return seed
+
 
 class DistributedEvalSampler(DistributedSampler):
     """ A distributed sampler that doesn't add duplicates. Arguments are the same as DistributedSampler """
@@ -13,3 +29,43 @@ class DistributedEvalSampler(DistributedSampler):
             if self.rank >= len(self.dataset) % self.num_replicas:
                 self.num_samples -= 1
             self.total_size = len(self.dataset)
+
+
+class ResumableSampler(DistributedSampler):
+    """
+        A training sampler that can resume from the middle of an epoch.
+        The permutation only depends on (seed, epoch), and the skipped
+        indices are never passed to the dataset, ie: not decoded.
+        seed: None for get_shared_seed(), ie: the experiment seed; the trainer
+            saves it in the checkpoints.
+        Also works without torch.distributed (one replica).
+
+        yield_epoch: yield (index, epoch) instead of index, for the datasets
+            whose samples depend on the epoch (see AugmentReplayDataset).
+    """
+
+    def __init__(self, dataset: Dataset, shuffle: bool = True, seed: Optional[int] = None, drop_last: bool = False,
+                 yield_epoch: bool = False):
+        if seed is None:
+            seed = get_shared_seed()
+        super().__init__(dataset, num_replicas=get_world_size(), rank=get_rank(),
+                         shuffle=shuffle, seed=seed, drop_last=drop_last)
+        self.start_index = 0
+        self.yield_epoch = yield_epoch
+
+    def set_epoch(self, epoch: int) -> None:
+        super().set_epoch(epoch)
+        self.start_index = 0
+
+    def set_start_index(self, start_index: int) -> None:
+        """skip the first `start_index` samples (of this rank) in the current epoch"""
+        self.start_index = min(start_index, self.num_samples)
+
+    def __iter__(self) -> Iterator:
+        indices = list(super().__iter__())[self.start_index:]
+        if self.yield_epoch:
+            return iter([(idx, self.epoch) for idx in indices])
+        return iter(indices)
+
+    def __len__(self) -> int:
+        return self.num_samples - self.start_index
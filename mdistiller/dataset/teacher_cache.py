@@ -0,0 +1,533 @@
+import os
+import re
+import json
+import random
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from .sampler import ResumableSampler
+
+
+def get_replay_seed(seed, view, index):
+    return int(np.random.SeedSequence([seed, view, index]).generate_state(1)[0])
+
+
+@contextmanager
+def replay_rng(seed):
+    """
+        Seed python/numpy/torch rngs for one sample, and restore them afterwards.
+    """
+    py_state = random.getstate()
+    np_state = np.random.get_state()
+    torch_state = torch.get_rng_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(py_state)
+        np.random.set_state(np_state)
+        torch.set_rng_state(torch_state)
+
+
+class TeacherLogitCache():
+    """
+        Teacher logits of each augmentation view of the train set, stored
+        in a memory-mapped fp16 array [num_views, num_data, num_classes].
+        `meta.json` records how the views are generated.
+    """
+
+    logits_file = "logits.npy"
+    meta_file = "meta.json"
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, self.meta_file), "r") as f:
+            self.meta = json.load(f)
+        # opened lazily: memmaps must not be pickled to the dataloader workers
+        self._logits = None
+
+    @classmethod
+    def create(cls, path, num_views, num_data, num_classes, **meta):
+        os.makedirs(path, exist_ok=True)
+        logits = np.lib.format.open_memmap(
+            os.path.join(path, cls.logits_file), mode="w+", dtype=np.float16,
+            shape=(num_views, num_data, num_classes))
+        del logits
+        meta.update(
+            format="dense",
+            num_views=num_views,
+            num_data=num_data,
+            num_classes=num_classes,
+            finished_views=[],
+        )
+        with open(os.path.join(path, cls.meta_file), "w") as f:
+            json.dump(meta, f, indent=4)
+        return cls(path, mode="r+")
+
+    @property
+    def logits(self):
+        if self._logits is None:
+            self._logits = np.load(
+                os.path.join(self.path, self.logits_file), mmap_mode=self.mode)
+        return self._logits
+
+    @property
+    def num_views(self):
+        return self.meta["num_views"]
+
+    def get_view(self, epoch):
+        # epoch starts from 1
+        return (epoch - 1) % self.num_views
+
+    def get(self, view, index):
+        return self.logits[view, index]
+
+    def write(self, view, indices, logits):
+        self.logits[view, indices] = logits.astype(np.float16)
+
+    def finish_view(self, view):
+        self.logits.flush()
+        self.meta["finished_views"] = sorted(
+            set(self.meta["finished_views"]) | {view})
+        self.save_meta()
+
+    def save_meta(self):
+        with open(os.path.join(self.path, self.meta_file), "w") as f:
+            json.dump(self.meta, f, indent=4)
+
+    def check(self, **expected):
+        if len(self.meta["finished_views"]) != self.num_views:
+            raise ValueError("Teacher cache {} is incomplete, finished views: {}".format(
+                self.path, self.meta["finished_views"]))
+        for k, v in expected.items():
+            if self.meta.get(k) != v:
+                raise ValueError("Teacher cache {} mismatch: {}={}, expected {}".format(
+                    self.path, k, self.meta.get(k), v))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_logits"] = None
+        return state
+
+
+def compress_topk_logits(logits, k, temperature):
+    """
+        logits: [B, C] -> values [B, k], indices [B, k], tail [B]
+
+        `tail` is the logit that, assigned to every non-topk class, keeps
+        the total tail probability mass at `temperature`. So the densified
+        logits give exact topk-vs-other (GDKD high level) and topk block
+        distributions for any topk size <= k at this temperature; only the
+        distribution inside the other block becomes uniform.
+    """
+    num_classes = logits.shape[1]
+    if k >= num_classes:
+        raise ValueError(f"topk {k} must be less than num_classes {num_classes}")
+    logits = logits.float()
+    values, indices = logits.topk(k, dim=1, sorted=True)
+    mask = torch.zeros_like(logits, dtype=torch.bool).scatter_(1, indices, True)
+    tail_lse = torch.logsumexp(
+        (logits / temperature).masked_fill(mask, float("-inf")), dim=1)
+    tail = temperature * (tail_lse - np.log(num_classes - k))
+    return values, indices, tail
+
+
+def densify_topk_logits(values, indices, tail, num_classes):
+    logits = tail.float().unsqueeze(1).expand(-1, num_classes).contiguous()
+    return logits.scatter_(1, indices.long(), values.float())
+
+
+def get_topk_partitions(values, tail, num_classes, k, temperature):
+    """
+        The GDKD partitions of the teacher directly from the sparse form
+        (values sorted in descending order, k <= stored topk):
+        p0: [B, 2] probs of the topk block & the other block,
+        log_p1: [B, k] log probs inside the topk block.
+    """
+    stored_k = values.shape[1]
+    values = values.float() / temperature
+    tail = tail.float() / temperature
+    lse_top = torch.logsumexp(values[:, :k], dim=1)
+    # the other block: the stored values after k + the uniform tail
+    lse_other = torch.logsumexp(torch.cat([
+        values[:, k:],
+        (tail + np.log(num_classes - stored_k)).unsqueeze(1)
+    ], dim=1), dim=1)
+    log_p0 = torch.stack([lse_top, lse_other], dim=1).log_softmax(dim=1)
+    log_p1 = values[:, :k] - lse_top.unsqueeze(1)
+    return log_p0.exp(), log_p1
+
+
+class TopKTeacherLogitCache(TeacherLogitCache):
+    """
+        Sparse teacher logits for large class counts: per sample, the topk
+        logits (fp16), their class indices (int16) and one fp16 tail logit
+        summarizing the mass of the other classes at `temperature`
+        (see compress_topk_logits). `get()` returns the densified logits.
+    """
+
+    values_file = "values.npy"
+    indices_file = "indices.npy"
+    tail_file = "tail.npy"
+
+    def __init__(self, path, mode="r"):
+        super().__init__(path, mode)
+        self._arrays = None
+
+    @classmethod
+    def create(cls, path, num_views, num_data, num_classes, topk=20, temperature=4.0, **meta):
+        if num_classes > np.iinfo(np.int16).max:
+            raise ValueError("int16 indices support at most 32767 classes")
+        os.makedirs(path, exist_ok=True)
+        shapes = {
+            cls.values_file: ((num_views, num_data, topk), np.float16),
+            cls.indices_file: ((num_views, num_data, topk), np.int16),
+            cls.tail_file: ((num_views, num_data), np.float16),
+        }
+        for name, (shape, dtype) in shapes.items():
+            arr = np.lib.format.open_memmap(
+                os.path.join(path, name), mode="w+", dtype=dtype, shape=shape)
+            del arr
+        meta.update(
+            format="topk",
+            topk=topk,
+            temperature=temperature,
+            num_views=num_views,
+            num_data=num_data,
+            num_classes=num_classes,
+            finished_views=[],
+        )
+        with open(os.path.join(path, cls.meta_file), "w") as f:
+            json.dump(meta, f, indent=4)
+        return cls(path, mode="r+")
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = [
+                np.load(os.path.join(self.path, name), mmap_mode=self.mode)
+                for name in [self.values_file, self.indices_file, self.tail_file]
+            ]
+        return self._arrays
+
+    def get(self, view, index):
+        values, indices, tail = self.arrays
+        logits = np.full(self.meta["num_classes"],
+                         tail[view, index], dtype=np.float16)
+        logits[indices[view, index].astype(np.int64)] = values[view, index]
+        return logits
+
+    def get_sparse(self, view, index):
+        """
+            Returns: (values [topk], indices [topk], tail) of a sample,
+                eg: for the GDKD partitions, see get_topk_partitions.
+        """
+        values, indices, tail = self.arrays
+        return values[view, index], indices[view, index], tail[view, index]
+
+    def write(self, view, indices, logits):
+        values, topk_indices, tail = compress_topk_logits(
+            torch.as_tensor(logits), self.meta["topk"], self.meta["temperature"])
+        self.write_sparse(view, indices, values.numpy(),
+                          topk_indices.numpy(), tail.numpy())
+
+    def write_sparse(self, view, indices, values, topk_indices, tail):
+        values_arr, indices_arr, tail_arr = self.arrays
+        values_arr[view, indices] = values.astype(np.float16)
+        indices_arr[view, indices] = topk_indices.astype(np.int16)
+        tail_arr[view, indices] = tail.astype(np.float16)
+
+    def finish_view(self, view):
+        for arr in self.arrays:
+            arr.flush()
+        self.meta["finished_views"] = sorted(
+            set(self.meta["finished_views"]) | {view})
+        self.save_meta()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_arrays"] = None
+        return state
+
+
+def open_teacher_cache(path, mode="r"):
+    with open(os.path.join(path, TeacherLogitCache.meta_file), "r") as f:
+        cache_format = json.load(f).get("format", "dense")
+    if cache_format == "topk":
+        return TopKTeacherLogitCache(path, mode)
+    return TeacherLogitCache(path, mode)
+
+
+def resolve_feature_keys(keys, list_lens):
+    """
+        keys: eg: ["feats[1:]", "feats[-1]", "pooled_feat"], see Distiller.get_teacher_feature_keys
+        list_lens: the length of the feature lists of the teacher, eg: {"feats": 5, "preact_feats": 5}
+        Returns: sorted concrete keys, eg: ["feats.1", "feats.4", "pooled_feat"]
+    """
+    resolved = set()
+    for key in keys:
+        m = re.fullmatch(r"(\w+)(?:\[(-?\d*)(:?)(-?\d*)\])?", key)
+        if m is None:
+            raise ValueError(f"Invalid teacher feature key: {key}")
+        name, start, is_slice, stop = m.groups()
+        if name not in list_lens:
+            resolved.add(name)
+            continue
+        n = list_lens[name]
+        if is_slice:
+            indices = range(n)[slice(
+                int(start) if start else None, int(stop) if stop else None)]
+        else:
+            indices = [range(n)[int(start)]]
+        resolved.update(f"{name}.{i}" for i in indices)
+    return sorted(resolved)
+
+
+def get_feature(feats, key):
+    name, _, i = key.partition(".")
+    return feats[name][int(i)] if i else feats[name]
+
+
+def quantize_feature(x, dtype):
+    """
+        int8: symmetric absmax quantization per sample & channel
+        ([B, C, H, W] -> scale [B, C]), or per sample for vectors ([B, C] -> scale [B, 1]).
+        Returns: (x_q, scale), scale is None for fp16.
+    """
+    if dtype == "fp16":
+        return x.half(), None
+    elif dtype != "int8":
+        raise ValueError(f"Unknown feature dtype: {dtype}")
+    x = x.float()
+    if x.dim() > 2:
+        scale = x.abs().flatten(2).amax(dim=2)
+    else:
+        scale = x.abs().amax(dim=1, keepdim=True)
+    scale = scale.clamp_min(1e-8) / 127
+    x_q = (x / scale.view(*scale.shape, *[1] * (x.dim() - 2))).round_().clamp_(-127, 127)
+    return x_q.to(torch.int8), scale.half()
+
+
+def dequantize_feature(x_q, scale):
+    if scale is None:
+        return x_q.float()
+    scale = scale.float()
+    return x_q.float().mul_(scale.view(*scale.shape, *[1] * (x_q.dim() - 2)))
+
+
+class TeacherFeatureCache(TeacherLogitCache):
+    """
+        Teacher features for the feature distillers, only the layers in `keys`
+        (see resolve_feature_keys). Each key of each view is stored in chunks
+        of `chunk_size` samples: `{key}/view{v}_{c}.npy` ([chunk, *shape], int8
+        or fp16) and `{key}/view{v}_{c}_scale.npy` (int8 only).
+        `get()` returns the quantized sample, see build_teacher_features.
+    """
+
+    def __init__(self, path, mode="r"):
+        super().__init__(path, mode)
+        self._chunks = {}
+
+    @classmethod
+    def create(cls, path, num_views, num_data, keys, shapes, list_lens,
+               dtype="int8", chunk_size=8192, **meta):
+        if dtype not in ["int8", "fp16"]:
+            raise ValueError(f"Unknown feature dtype: {dtype}")
+        os.makedirs(path, exist_ok=True)
+        for key in keys:
+            os.makedirs(os.path.join(path, key), exist_ok=True)
+            for view in range(num_views):
+                for chunk in range(0, num_data, chunk_size):
+                    n = min(chunk_size, num_data - chunk)
+                    shape = [n, *shapes[key]]
+                    arr = np.lib.format.open_memmap(
+                        cls._chunk_file(path, key, view, chunk, chunk_size), mode="w+",
+                        dtype=np.int8 if dtype == "int8" else np.float16, shape=shape)
+                    del arr
+                    if dtype == "int8":
+                        scale_shape = [n, shape[1] if len(shape) > 2 else 1]
+                        arr = np.lib.format.open_memmap(
+                            cls._chunk_file(path, key, view, chunk, chunk_size, "_scale"),
+                            mode="w+", dtype=np.float16, shape=scale_shape)
+                        del arr
+        meta.update(
+            format="features",
+            keys=keys,
+            shapes=shapes,
+            list_lens=list_lens,
+            dtype=dtype,
+            chunk_size=chunk_size,
+            num_views=num_views,
+            num_data=num_data,
+            finished_views=[],
+        )
+        with open(os.path.join(path, cls.meta_file), "w") as f:
+            json.dump(meta, f, indent=4)
+        return cls(path, mode="r+")
+
+    @staticmethod
+    def _chunk_file(path, key, view, chunk, chunk_size, suffix=""):
+        return os.path.join(path, key, "view{}_{:05d}{}.npy".format(
+            view, chunk // chunk_size, suffix))
+
+    @property
+    def keys(self):
+        return self.meta["keys"]
+
+    def missing_keys(self, keys):
+        return sorted(set(resolve_feature_keys(
+            keys, self.meta["list_lens"])) - set(self.keys))
+
+    def build_features(self, data):
+        return build_teacher_features(data, self.meta["list_lens"])
+
+    def _get_chunk(self, key, view, index, suffix=""):
+        chunk_size = self.meta["chunk_size"]
+        index = int(index)
+        chunk = index - index % chunk_size
+        name = (key, view, chunk, suffix)
+        if name not in self._chunks:
+            self._chunks[name] = np.load(
+                self._chunk_file(self.path, key, view, chunk, chunk_size, suffix),
+                mmap_mode=self.mode)
+        return self._chunks[name], index - chunk
+
+    def get(self, view, index):
+        data = {}
+        for key in self.keys:
+            arr, i = self._get_chunk(key, view, index)
+            if self.meta["dtype"] == "int8":
+                scale, _ = self._get_chunk(key, view, index, "_scale")
+                data[key] = (np.array(arr[i]), np.array(scale[i]))
+            else:
+                data[key] = np.array(arr[i])
+        return data
+
+    def write(self, view, indices, feats):
+        """
+            indices: numpy array of the sample indices
+            feats: the teacher features, quantized on their device
+        """
+        for key in self.keys:
+            x_q, scale = quantize_feature(
+                get_feature(feats, key), self.meta["dtype"])
+            x_q = x_q.cpu().numpy()
+            scale = scale.cpu().numpy() if scale is not None else None
+            chunks = indices - indices % self.meta["chunk_size"]
+            for chunk in np.unique(chunks):
+                sel = chunks == chunk
+                arr, _ = self._get_chunk(key, view, int(chunk))
+                arr[indices[sel] - chunk] = x_q[sel]
+                if scale is not None:
+                    arr, _ = self._get_chunk(key, view, int(chunk), "_scale")
+                    arr[indices[sel] - chunk] = scale[sel]
+
+    def finish_view(self, view):
+        for (_, v, _, _), arr in self._chunks.items():
+            if v == view:
+                arr.flush()
+        self.meta["finished_views"] = sorted(
+            set(self.meta["finished_views"]) | {view})
+        self.save_meta()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_chunks"] = {}
+        return state
+
+
+def build_teacher_features(data, list_lens):
+    """
+        Dequantize a batch of TeacherFeatureCache (on the device) to the feature
+        dict of the models. The layers that are not cached are None.
+    """
+    feats = {name: [None] * n for name, n in list_lens.items()}
+    for key, x in data.items():
+        x = dequantize_feature(*x) if isinstance(x, (list, tuple)) else x.float()
+        name, _, i = key.partition(".")
+        if i:
+            feats[name][int(i)] = x
+        else:
+            feats[name] = x
+    return feats
+
+
+class AugmentReplayDataset(Dataset):
+    """
+        Make the random augmentations a function of (seed, view, index),
+        so that the teacher cache tool and the training replay exactly the
+        same crops & flips. The keys are (index, epoch) from ResumableSampler.
+
+        If a cache is given, the cached teacher logits are appended to the sample,
+        followed by the quantized teacher features if a feature cache is given.
+        sparse: append the (values, indices, tail) of a topk cache instead of
+            the densified logits.
+    """
+
+    def __init__(self, dataset, seed, num_views, cache=None, feature_cache=None, sparse=False):
+        self.dataset = dataset
+        self.seed = seed
+        self.num_views = num_views
+        self.cache = cache
+        self.feature_cache = feature_cache
+        self.sparse = sparse
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        # forward the attributes of the dataset, eg: classes
+        if name == "dataset":
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, key):
+        index, epoch = key
+        view = (epoch - 1) % self.num_views
+        with replay_rng(get_replay_seed(self.seed, view, index)):
+            data = self.dataset[index]
+        if self.cache is not None and self.sparse:
+            values, indices, tail = self.cache.get_sparse(view, index)
+            data = (*data, (
+                torch.from_numpy(np.array(values)),
+                torch.from_numpy(np.array(indices)),
+                torch.tensor(float(tail), dtype=torch.float16),
+            ))
+        elif self.cache is not None:
+            logits = torch.from_numpy(np.array(self.cache.get(view, index)))
+            data = (*data, logits)
+        if self.feature_cache is not None:
+            feats = {k: tuple(torch.from_numpy(x) for x in v) if isinstance(v, tuple) else torch.from_numpy(v)
+                     for k, v in self.feature_cache.get(view, index).items()}
+            data = (*data, feats)
+        return data
+
+
+def get_replay_loader(loader, seed, num_views, cache=None, feature_cache=None, shuffle=True, sparse=False):
+    """
+        Rebuild a train loader with deterministic augmentations (and cached teacher logits).
+    """
+    dataset = AugmentReplayDataset(
+        loader.dataset, seed, num_views, cache, feature_cache, sparse)
+    kwargs = dict(
+        batch_size=loader.batch_size,
+        num_workers=loader.num_workers,
+        pin_memory=loader.pin_memory,
+        drop_last=loader.drop_last,
+        collate_fn=loader.collate_fn,
+        worker_init_fn=loader.worker_init_fn,
+    )
+    if loader.num_workers > 0:
+        kwargs.update(
+            persistent_workers=loader.persistent_workers,
+            prefetch_factor=loader.prefetch_factor,
+        )
+    sampler = ResumableSampler(
+        dataset, shuffle=shuffle, seed=getattr(loader.sampler, "seed", None), yield_epoch=True)
+    return DataLoader(dataset, sampler=sampler, **kwargs)
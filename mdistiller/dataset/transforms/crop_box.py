@@ -0,0 +1,34 @@
+import copy
+
+import torchvision.transforms as transforms
+
+
+class RandomResizedCropWithBox(transforms.RandomResizedCrop):
+    """RandomResizedCrop that records the crop box of its last image.
+
+    `box` is (x0, y0, x1, y1), normalized by the image size, eg: the full image
+    is (0, 0, 1, 1). The transform is called once per sample in a dataloader
+    worker, so the dataset reads `box` right after the transform.
+    """
+
+    box = (0.0, 0.0, 1.0, 1.0)
+
+    @classmethod
+    def from_crop(cls, crop):
+        # the same parameters as an existing RandomResizedCrop
+        new_crop = copy.copy(crop)
+        new_crop.__class__ = cls
+        return new_crop
+
+    def get_params(self, img, scale, ratio):
+        # called by RandomResizedCrop.forward as self.get_params
+        top, left, height, width = super().get_params(img, scale, ratio)
+        # PIL image: the crop runs before ToTensor
+        img_width, img_height = img.size
+        self.box = (
+            left / img_width,
+            top / img_height,
+            (left + width) / img_width,
+            (top + height) / img_height,
+        )
+        return top, left, height, width
@@ -9,6 +9,12 @@ from ._base import Distiller
 class CRD(Distiller):
     """Contrastive Representation Distillation"""
 
+    student_feature_taps = ["pooled_feat"]
+
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["pooled_feat"]
+
     def __init__(self, student, teacher, cfg, num_data):
         super(CRD, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.CRD.LOSS.CE_WEIGHT
@@ -66,9 +72,8 @@ class CRD(Distiller):
         return s_loss + t_loss
 
     def forward_train(self, image, target, index, contrastive_index, **kwargs):
-        logits_student, feature_student = self.student(image)
-        with torch.no_grad():
-            _, feature_teacher = self.teacher(image)
+        logits_student, feature_student = self.forward_student(image, **kwargs)
+        _, feature_teacher = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
@@ -149,7 +154,6 @@ class ContrastMemory(nn.Module):
         self.n_lem = output_size
         self.unigrams = torch.ones(self.n_lem)
         self.multinomial = AliasMethod(self.unigrams)
-        self.multinomial.cuda()
         self.K = K
 
         self.register_buffer("params", torch.tensor([K, T, -1, -1, momentum]))
@@ -172,6 +176,9 @@ class ContrastMemory(nn.Module):
         outputSize = self.memory_v1.size(0)
         inputSize = self.memory_v1.size(1)
 
+        # follow the device of the memory buffers
+        self.multinomial.to(self.memory_v1.device)
+
         # original score computation
         if idx is None:
             idx = self.multinomial.draw(batchSize * (self.K + 1)).view(batchSize, -1)
@@ -262,9 +269,12 @@ class AliasMethod(object):
         for last_one in smaller + larger:
             self.prob[last_one] = 1
 
+    def to(self, device):
+        self.prob = self.prob.to(device)
+        self.alias = self.alias.to(device)
+
     def cuda(self):
-        self.prob = self.prob.cuda()
-        self.alias = self.alias.cuda()
+        self.to("cuda")
 
     def draw(self, N):
         """Draw N samples from multinomial"""
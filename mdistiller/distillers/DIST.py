@@ -1,8 +1,8 @@
-import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from ._base import Distiller
+from .utils import autocast_fp32
 
 
 def cosine_similarity(a, b, eps=1e-8):
@@ -22,6 +22,7 @@ def intra_class_relation(y_s, y_t):
     return inter_class_relation(y_s.transpose(0, 1), y_t.transpose(0, 1))
 
 
+@autocast_fp32
 def dist_loss(logits_student, logits_teacher, T, beta, gamma):
     y_s = F.softmax(logits_student / T, dim=1)
     y_t = F.softmax(logits_teacher / T, dim=1)
@@ -38,6 +39,9 @@ def dist_loss(logits_student, logits_teacher, T, beta, gamma):
 class DIST(Distiller):
     """DKD with some new losses"""
 
+    # only the teacher logits are used
+    requires_teacher_features = False
+
     def __init__(self, student, teacher, cfg):
         super(DIST, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.DIST.CE_WEIGHT
@@ -46,9 +50,8 @@ class DIST(Distiller):
         self.gamma = cfg.DIST.GAMMA
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
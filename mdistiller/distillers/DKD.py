@@ -3,33 +3,17 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ._base import Distiller
+from .utils import autocast_fp32, partition_kd_loss
 
 
+@autocast_fp32
 def dkd_loss(logits_student, logits_teacher, target, alpha, beta, temperature):
+    # tckd: the binary KL of gt/other, nckd: the KL within the other classes;
+    # the partitions (gt, other), see partition_kd_loss
     gt_mask = _get_gt_mask(logits_student, target)
-    other_mask = _get_other_mask(logits_student, target)
-    pred_student = F.softmax(logits_student / temperature, dim=1)
-    pred_teacher = F.softmax(logits_teacher / temperature, dim=1)
-    pred_student = cat_mask(pred_student, gt_mask, other_mask)
-    pred_teacher = cat_mask(pred_teacher, gt_mask, other_mask)
-    log_pred_student = torch.log(pred_student)
-    tckd_loss = (
-        F.kl_div(log_pred_student, pred_teacher, size_average=False)
-        * (temperature**2)
-        / target.shape[0]
-    )
-    pred_teacher_part2 = F.softmax(
-        logits_teacher / temperature - 1000.0 * gt_mask, dim=1
-    )
-    log_pred_student_part2 = F.log_softmax(
-        logits_student / temperature - 1000.0 * gt_mask, dim=1
-    )
-    nckd_loss = (
-        F.kl_div(log_pred_student_part2, pred_teacher_part2, size_average=False)
-        * (temperature**2)
-        / target.shape[0]
-    )
-    return alpha * tckd_loss + beta * nckd_loss
+    loss, _, _ = partition_kd_loss(
+        logits_student, logits_teacher, gt_mask, alpha, [0.0, beta], temperature)
+    return loss
 
 
 def _get_gt_mask(logits, target):
@@ -38,22 +22,12 @@ def _get_gt_mask(logits, target):
     return mask
 
 
-def _get_other_mask(logits, target):
-    target = target.reshape(-1)
-    mask = torch.ones_like(logits).scatter_(1, target.unsqueeze(1), 0).bool()
-    return mask
-
-
-def cat_mask(t, mask1, mask2):
-    t1 = (t * mask1).sum(dim=1, keepdims=True)
-    t2 = (t * mask2).sum(1, keepdims=True)
-    rt = torch.cat([t1, t2], dim=1)
-    return rt
-
-
 class DKD(Distiller):
     """Decoupled Knowledge Distillation(CVPR 2022)"""
 
+    # only the teacher logits are used
+    requires_teacher_features = False
+
     def __init__(self, student, teacher, cfg):
         super(DKD, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.DKD.CE_WEIGHT
@@ -63,9 +37,8 @@ class DKD(Distiller):
         self.warmup = cfg.DKD.WARMUP
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
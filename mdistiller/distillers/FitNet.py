@@ -1,4 +1,3 @@
-import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -11,6 +10,12 @@ from .utils import get_feat_shapes
 class FitNet(Distiller):
     """FitNets: Hints for Thin Deep Nets"""
 
+    student_feature_taps = ["feats"]
+
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["feats[{}]".format(cfg.FITNET.HINT_LAYER)]
+
     def __init__(self, student, teacher, cfg):
         super(FitNet, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.FITNET.LOSS.CE_WEIGHT
@@ -33,9 +38,8 @@ class FitNet(Distiller):
         return num_p
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, feature_student = self.student(image)
-        with torch.no_grad():
-            _, feature_teacher = self.teacher(image)
+        logits_student, feature_student = self.forward_student(image, **kwargs)
+        _, feature_teacher = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
@@ -3,10 +3,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from ._base import Distiller
-from .utils import kl_div
-
-MASK_MAGNITUDE = 1000.0
-
+from .utils import (
+    autocast_fp32,
+    partition_kd_loss,
+    partition_log_softmax,
+    partition_kl_from_log_probs
+)
+from mdistiller.dataset.teacher_cache import get_topk_partitions
 
 def get_masks(logits, k=5, strategy="best"):
     if strategy == "best":
@@ -28,63 +31,47 @@ def get_masks(logits, k=5, strategy="best"):
     return mask_u1, mask_u2
 
 
-def cat_mask(t, mask1, mask2):
-    t1 = (t * mask1).sum(dim=1, keepdims=True)
-    t2 = (t * mask2).sum(dim=1, keepdims=True)
-    rt = torch.cat([t1, t2], dim=1)  # [B, 2]
-    return rt
-
-
 def gdkd_loss(logits_student, logits_teacher, target, k, strategy, w0, w1, w2, temperature, kl_type):
-    mask_u1, mask_u2 = get_masks(logits_teacher, k, strategy)
-
-    soft_logits_student = logits_student / temperature
-    soft_logits_teacher = logits_teacher / temperature
-
-    p_student = F.softmax(soft_logits_student, dim=1)
-    p_teacher = F.softmax(soft_logits_teacher, dim=1)
-
     # Notation: high_loss: level 0 loss; low_loss: level 1 loss
-    # accumulated term
-    p0_student = cat_mask(p_student, mask_u1, mask_u2)
-    p0_teacher = cat_mask(p_teacher, mask_u1, mask_u2)
-
-    log_p0_student = torch.log(p0_student)
-    high_loss = (
-        F.kl_div(log_p0_student, p0_teacher, reduction="batchmean")
-        * (temperature**2)
-    )
-
-    # topk loss
-    log_p1_student = F.log_softmax(
-        soft_logits_student - MASK_MAGNITUDE * mask_u2, dim=1
-    )
-    log_p1_teacher = F.log_softmax(
-        soft_logits_teacher - MASK_MAGNITUDE * mask_u2, dim=1
-    )
-
-    low_top_loss = kl_div(log_p1_student, log_p1_teacher, temperature, kl_type)
-
-    # other classes loss
-    log_p2_student = F.log_softmax(
-        soft_logits_student - MASK_MAGNITUDE * mask_u1, dim=1
-    )
-    log_p2_teacher = F.log_softmax(
-        soft_logits_teacher - MASK_MAGNITUDE * mask_u1, dim=1
-    )
-
-    low_other_loss = kl_div(
-        log_p2_student, log_p2_teacher, temperature, kl_type)
-
-    return (
-        w0 * high_loss + w1 * low_top_loss + w2 * low_other_loss,
-        high_loss.detach(),
-        low_top_loss.detach(),
-        low_other_loss.detach()
-    )
+    # the partitions (topk, other), see partition_kd_loss
+    mask_u1, _ = get_masks(logits_teacher, k, strategy)
+    loss, high_loss, low_losses = partition_kd_loss(
+        logits_student, logits_teacher, mask_u1, w0, [w1, w2], temperature, kl_type)
+    return loss, high_loss, low_losses[0], low_losses[1]
+
+
+@autocast_fp32
+def gdkd_loss_topk(logits_student, logits_teacher, teacher_topk, k, w0, w1, w2, temperature, kl_type):
+    """
+        gdkd_loss (strategy "best") on a topk teacher cache (TEACHER_CACHE.FORMAT topk):
+        the teacher partition masses & the topk block come from the sparse form
+        by get_topk_partitions, the other block from the densified logits
+        (the stored values after k & the uniform tail).
+        teacher_topk: (values [B, topk] in descending order, indices [B, topk], tail [B])
+    """
+    values, indices, tail = teacher_topk
+    indices = indices[:, :k].long()
+    # partition ids, 0: the topk of the teacher, 1: the other classes
+    partition = torch.ones_like(logits_student, dtype=torch.long).scatter_(1, indices, 0)
+
+    p0_teacher, log_p1_teacher = get_topk_partitions(
+        values, tail, logits_student.shape[1], k, temperature)
+    log_q, _ = partition_log_softmax(logits_teacher.detach() / temperature, partition, 2)
+    log_q = log_q.scatter(1, indices, log_p1_teacher)
+    log_p, log_mass_p = partition_log_softmax(logits_student / temperature, partition, 2)
+    high, low = partition_kl_from_log_probs(
+        log_p, log_mass_p, log_q, p0_teacher.log(), partition, 2, kl_type)
+
+    scale = temperature**2
+    high_loss, low_losses = high.mean() * scale, low.mean(0) * scale
+    loss = w0 * high_loss + w1 * low_losses[0] + w2 * low_losses[1]
+    return loss, high_loss.detach(), low_losses[0].detach(), low_losses[1].detach()
 
 
 class GDKD(Distiller):
+    # only the teacher logits are used
+    requires_teacher_features = False
+
     def __init__(self, student, teacher, cfg):
         super(GDKD, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.GDKD.CE_WEIGHT
@@ -99,24 +86,37 @@ class GDKD(Distiller):
         self.kl_type = cfg.GDKD.KL_TYPE
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
-        loss_gdkd, self.high_loss, self.low_top_loss, self.low_other_loss = gdkd_loss(
-            logits_student,
-            logits_teacher,
-            target,
-            self.k,
-            self.strategy,
-            self.w0,
-            self.w1,
-            self.w2,
-            self.temperature,
-            kl_type=self.kl_type
-        )
+        if kwargs.get("teacher_topk") is not None:
+            # a topk teacher cache, checked by Trainer.check_teacher_cache
+            loss_gdkd, self.high_loss, self.low_top_loss, self.low_other_loss = gdkd_loss_topk(
+                logits_student,
+                logits_teacher,
+                kwargs["teacher_topk"],
+                self.k,
+                self.w0,
+                self.w1,
+                self.w2,
+                self.temperature,
+                kl_type=self.kl_type
+            )
+        else:
+            loss_gdkd, self.high_loss, self.low_top_loss, self.low_other_loss = gdkd_loss(
+                logits_student,
+                logits_teacher,
+                target,
+                self.k,
+                self.strategy,
+                self.w0,
+                self.w1,
+                self.w2,
+                self.temperature,
+                kl_type=self.kl_type
+            )
         loss_kd = min(kwargs["epoch"] / self.warmup, 1.0) * loss_gdkd
         losses_dict = {
             "loss_ce": loss_ce,
@@ -1,10 +1,11 @@
-import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from ._base import Distiller
+from .utils import autocast_fp32
 
 
+@autocast_fp32
 def kd_loss(logits_student, logits_teacher, temperature):
     log_pred_student = F.log_softmax(logits_student / temperature, dim=1)
     pred_teacher = F.softmax(logits_teacher / temperature, dim=1)
@@ -16,6 +17,9 @@ def kd_loss(logits_student, logits_teacher, temperature):
 class KD(Distiller):
     """Distilling the Knowledge in a Neural Network"""
 
+    # only the teacher logits are used
+    requires_teacher_features = False
+
     def __init__(self, student, teacher, cfg):
         super(KD, self).__init__(student, teacher)
         self.temperature = cfg.KD.TEMPERATURE
@@ -23,9 +27,8 @@ class KD(Distiller):
         self.kd_loss_weight = cfg.KD.LOSS.KD_WEIGHT
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
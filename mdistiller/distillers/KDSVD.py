@@ -77,6 +77,12 @@ class KDSVD(Distiller):
     original Tensorflow code: https://github.com/sseung0703/SSKD_SVD
     """
 
+    student_feature_taps = ["feats"]
+
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["feats[1:]"]
+
     def __init__(self, student, teacher, cfg):
         super(KDSVD, self).__init__(student, teacher)
         self.k = cfg.KDSVD.K
@@ -84,9 +90,8 @@ class KDSVD(Distiller):
         self.feat_loss_weight = cfg.KDSVD.LOSS.FEAT_WEIGHT
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, feature_student = self.student(image)
-        with torch.no_grad():
-            _, feature_teacher = self.teacher(image)
+        logits_student, feature_student = self.forward_student(image, **kwargs)
+        _, feature_teacher = self.forward_teacher(image, **kwargs)
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
         loss_feat = self.feat_loss_weight * kdsvd_loss(
             feature_student["feats"][1:], feature_teacher["feats"][1:], self.k
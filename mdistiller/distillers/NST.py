@@ -1,4 +1,3 @@
-import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -40,15 +39,20 @@ class NST(Distiller):
     Like What You Like: Knowledge Distill via Neuron Selectivity Transfer
     """
 
+    student_feature_taps = ["feats"]
+
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["feats[1:]"]
+
     def __init__(self, student, teacher, cfg):
         super(NST, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.NST.LOSS.CE_WEIGHT
         self.feat_loss_weight = cfg.NST.LOSS.FEAT_WEIGHT
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, feature_student = self.student(image)
-        with torch.no_grad():
-            _, feature_teacher = self.teacher(image)
+        logits_student, feature_student = self.forward_student(image, **kwargs)
+        _, feature_teacher = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
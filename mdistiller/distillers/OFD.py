@@ -68,6 +68,12 @@ class ConnectorConvBN(nn.Module):
 
 
 class OFD(Distiller):
+    student_feature_taps = ["preact_feats"]
+
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["preact_feats[1:]"]
+
     def __init__(self, student, teacher, cfg):
         super(OFD, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.OFD.LOSS.CE_WEIGHT
@@ -127,9 +133,8 @@ class OFD(Distiller):
         return num_p
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, feature_student = self.student(image)
-        with torch.no_grad():
-            _, feature_teacher = self.teacher(image)
+        logits_student, feature_student = self.forward_student(image, **kwargs)
+        _, feature_teacher = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
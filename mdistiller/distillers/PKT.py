@@ -41,15 +41,20 @@ class PKT(Distiller):
     Code from: https://github.com/passalis/probabilistic_kt
     """
 
+    student_feature_taps = ["pooled_feat"]
+
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["pooled_feat"]
+
     def __init__(self, student, teacher, cfg):
         super(PKT, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.PKT.LOSS.CE_WEIGHT
         self.feat_loss_weight = cfg.PKT.LOSS.FEAT_WEIGHT
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, feature_student = self.student(image)
-        with torch.no_grad():
-            _, feature_teacher = self.teacher(image)
+        logits_student, feature_student = self.forward_student(image, **kwargs)
+        _, feature_teacher = self.forward_teacher(image, **kwargs)
 
         # lossess
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
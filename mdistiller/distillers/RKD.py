@@ -53,6 +53,12 @@ def rkd_loss(f_s, f_t, squared=False, eps=1e-12, distance_weight=25, angle_weigh
 class RKD(Distiller):
     """Relational Knowledge Disitllation, CVPR2019"""
 
+    student_feature_taps = ["pooled_feat"]
+
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["pooled_feat"]
+
     def __init__(self, student, teacher, cfg):
         super(RKD, self).__init__(student, teacher)
         self.distance_weight = cfg.RKD.DISTANCE_WEIGHT
@@ -63,9 +69,8 @@ class RKD(Distiller):
         self.squared = cfg.RKD.PDIST.SQUARED
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, feature_student = self.student(image)
-        with torch.no_grad():
-            _, feature_teacher = self.teacher(image)
+        logits_student, feature_student = self.forward_student(image, **kwargs)
+        _, feature_teacher = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
@@ -29,6 +29,16 @@ def hcl_loss(fstudent, fteacher):
 
 
 class ReviewKD(Distiller):
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["preact_feats[1:]", "pooled_feat"]
+
+    @classmethod
+    def get_feature_taps(cls, cfg):
+        _, teacher_taps = super().get_feature_taps(cfg)
+        student_taps = ["preact_feats" if cfg.REVIEWKD.STU_PREACT else "feats", "pooled_feat"]
+        return student_taps, teacher_taps
+
     def __init__(self, student, teacher, cfg):
         super(ReviewKD, self).__init__(student, teacher)
         self.shapes = cfg.REVIEWKD.SHAPES
@@ -64,9 +74,8 @@ class ReviewKD(Distiller):
         return num_p
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, features_student = self.student(image)
-        with torch.no_grad():
-            logits_teacher, features_teacher = self.teacher(image)
+        logits_student, features_student = self.forward_student(image, **kwargs)
+        logits_teacher, features_teacher = self.forward_teacher(image, **kwargs)
 
         # get features
         if self.stu_preact:
@@ -27,15 +27,20 @@ def similarity_loss(f_s, f_t):
 class SP(Distiller):
     """Similarity-Preserving Knowledge Distillation, ICCV2019"""
 
+    student_feature_taps = ["feats"]
+
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["feats[-1]"]
+
     def __init__(self, student, teacher, cfg):
         super(SP, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.SP.LOSS.CE_WEIGHT
         self.feat_loss_weight = cfg.SP.LOSS.FEAT_WEIGHT
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, feature_student = self.student(image)
-        with torch.no_grad():
-            _, feature_teacher = self.teacher(image)
+        logits_student, feature_student = self.forward_student(image, **kwargs)
+        _, feature_teacher = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
@@ -36,6 +36,12 @@ class VID(Distiller):
     code from author: https://github.com/ssahn0215/variational-information-distillation
     """
 
+    student_feature_taps = ["feats"]
+
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        return ["feats[1:]"]
+
     def __init__(self, student, teacher, cfg):
         super(VID, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.VID.LOSS.CE_WEIGHT
@@ -76,9 +82,8 @@ class VID(Distiller):
         return num_p
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, feature_student = self.student(image)
-        with torch.no_grad():
-            _, feature_teacher = self.teacher(image)
+        logits_student, feature_student = self.forward_student(image, **kwargs)
+        _, feature_teacher = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
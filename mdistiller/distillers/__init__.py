@@ -17,7 +17,11 @@ from .GDKD import GDKD
 from .GDKD3 import GDKD3
 from .DIST import DIST
 
-from ..models import get_model
+from .teacher import prepare_teacher
+from .teacher_server import TeacherProxy
+from .teacher_quant import quantize_teacher
+from .ensemble import get_teacher
+from ..models import get_model, set_feature_taps
 
 distiller_dict = {
     "NONE": Vanilla,
@@ -41,13 +45,35 @@ distiller_dict = {
 }
 
 
-def get_distiller(cfg, **kwargs):
+def get_prepared_teacher(teacher, cfg, feature_taps, train_loader=None):
+    # the teacher server proxy, the optimized or the quantized teacher
+    if cfg.TEACHER.SERVER.ENABLE:
+        return TeacherProxy.from_cfg(cfg, feature_taps=feature_taps)
+    elif cfg.TEACHER.OPTIMIZE:
+        teacher = prepare_teacher(teacher, cfg)
+
+    if cfg.TEACHER.QUANT.ENABLE:
+        # calibrated on the train loader
+        if train_loader is None:
+            raise ValueError("TEACHER.QUANT requires the train_loader of get_distiller for the calibration")
+        teacher = quantize_teacher(teacher, train_loader, cfg)
+    return teacher
+
+
+def get_distiller(cfg, pretrained_teacher=True, teacher=None, **kwargs):
+    """
+        teacher: an eager teacher model shared by several runs (tools/train_multi.py),
+        used as is instead of a new one & not prepared, see get_prepared_teacher.
+    """
     model_student = get_model(cfg, cfg.DISTILLER.STUDENT, pretrained=False)
 
     if cfg.DISTILLER.TYPE == "NONE":
         distiller = Vanilla(model_student)
+        set_feature_taps(distiller.student, [])
     else:
-        model_teacher = get_model(cfg, cfg.DISTILLER.TEACHER, pretrained=True)
+        model_teacher = teacher
+        if model_teacher is None:
+            model_teacher = get_teacher(cfg, pretrained=pretrained_teacher)
 
         if cfg.DISTILLER.TYPE == "CRD":
             distiller = CRD(
@@ -58,4 +84,14 @@ def get_distiller(cfg, **kwargs):
                 model_student, model_teacher, cfg
             )
 
+        # after the distiller init, which may need all the taps & the eager teacher, eg: OFD
+        student_taps, teacher_taps = distiller.get_feature_taps(cfg)
+        # eg: a teacher shared by several runs (tools/train_multi.py)
+        teacher_taps = kwargs.get("teacher_feature_taps", teacher_taps)
+        set_feature_taps(distiller.student, student_taps)
+        set_feature_taps(distiller.teacher, teacher_taps)
+        if teacher is None:
+            distiller.teacher = get_prepared_teacher(
+                distiller.teacher, cfg, teacher_taps, kwargs.get("train_loader"))
+
     return distiller
@@ -2,8 +2,15 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from mdistiller.engine.profiler import record_phase
+
 
 class Distiller(nn.Module):
+    # whether forward_train needs the teacher features, or only the logits
+    requires_teacher_features = True
+    # the student feature taps used by forward_train, eg: ["feats"]; None: all
+    student_feature_taps = None
+
     def __init__(self, student, teacher):
         super(Distiller, self).__init__()
         self.student = student
@@ -27,6 +34,48 @@ class Distiller(nn.Module):
         # calculate the extra parameters introduced by the distiller
         return 0
 
+    @classmethod
+    def get_teacher_feature_keys(cls, cfg):
+        """
+            The teacher features used by forward_train, eg: ["feats[1:]", "pooled_feat"],
+            for the teacher feature cache. None: not declared, the cache is not supported.
+        """
+        if not cls.requires_teacher_features:
+            return []
+        return None
+
+    @classmethod
+    def get_feature_taps(cls, cfg):
+        """
+            The feature taps (see mdistiller.models.taps) of the student & teacher
+            used by forward_train, eg: (["feats"], ["feats"]). The models only build
+            these taps; logit-only distillers get ([], []). None: all the taps.
+        """
+        if not cls.requires_teacher_features:
+            return [], []
+        teacher_keys = cls.get_teacher_feature_keys(cfg)
+        teacher_taps = None
+        if teacher_keys is not None:
+            # eg: "feats[1:]" -> "feats"
+            teacher_taps = sorted({key.split("[")[0] for key in teacher_keys})
+        return cls.student_feature_taps, teacher_taps
+
+    def forward_student(self, image, student_outputs=None, **kwargs):
+        if student_outputs is not None:
+            # precomputed (logits, feats), eg: by the vmapped students of MultiStudentTrainer
+            return student_outputs
+        with record_phase("student_forward"):
+            return self.student(image)
+
+    def forward_teacher(self, image, teacher_outputs=None, **kwargs):
+        if teacher_outputs is not None:
+            # precomputed (logits, feats), eg: from the teacher cache
+            return teacher_outputs
+        # the teacher is frozen
+        with record_phase("teacher_forward"):
+            with torch.no_grad():
+                return self.teacher(image)
+
     def forward_train(self, **kwargs):
         # training function for the distillation method
         raise NotImplementedError()
@@ -44,6 +93,8 @@ class Distiller(nn.Module):
 
 
 class Vanilla(Distiller):
+    requires_teacher_features = False
+
     def __init__(self, student):
         teacher = nn.Identity() # dummy
         super(Vanilla, self).__init__(student, teacher)
@@ -52,6 +103,6 @@ class Vanilla(Distiller):
         super(Distiller, self).train(mode)
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
         loss = F.cross_entropy(logits_student, target)
         return logits_student, {"loss_ce": loss}
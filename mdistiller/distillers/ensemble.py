@@ -0,0 +1,280 @@
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.func import functional_call, vmap
+
+from mdistiller.engine.utils import log_msg, local_print
+from ..models import get_model, set_feature_taps
+
+
+def _signature(model):
+    return type(model), [(k, v.shape, v.dtype) for k, v in model.state_dict().items()]
+
+
+def _record_stream(x, stream):
+    if isinstance(x, torch.Tensor):
+        if x.is_cuda:
+            x.record_stream(stream)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _record_stream(v, stream)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _record_stream(v, stream)
+
+
+def _unsqueeze(x):
+    # add the teacher dim, in nested lists & dicts
+    if isinstance(x, torch.Tensor):
+        return x.unsqueeze(0)
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_unsqueeze(v) for v in x)
+    elif isinstance(x, dict):
+        return {k: _unsqueeze(v) for k, v in x.items()}
+    return x
+
+
+def _select(x, i):
+    if isinstance(x, torch.Tensor):
+        return x[i]
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_select(v, i) for v in x)
+    elif isinstance(x, dict):
+        return {k: _select(v, i) for k, v in x.items()}
+    return x
+
+
+def _weighted_sum(x, weights):
+    # sum over the teacher dim
+    if isinstance(x, torch.Tensor):
+        return (weights.to(x.dtype).view(-1, *[1] * (x.dim() - 1)) * x).sum(0)
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_weighted_sum(v, weights) for v in x)
+    elif isinstance(x, dict):
+        return {k: _weighted_sum(v, weights) for k, v in x.items()}
+    return x
+
+
+def _add(x, y, name="feats"):
+    if isinstance(x, torch.Tensor):
+        if x.shape != y.shape:
+            raise ValueError(
+                "DISTILLER.ENSEMBLE.FEAT_AGG mean: the teachers have different shapes of {}: {} vs {}, "
+                "use FEAT_AGG first".format(name, list(x.shape), list(y.shape)))
+        return x + y
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_add(a, b, f"{name}.{i}") for i, (a, b) in enumerate(zip(x, y)))
+    elif isinstance(x, dict):
+        return {k: _add(x[k], y[k], k) for k in x}
+    return x
+
+
+class StackedTeachers(nn.Module):
+    """
+        N frozen teachers of the same architecture, run as one vmapped forward
+        over their stacked weights & BN statistics.
+        Returns: (logits, feats) with a leading teacher dim, eg: logits [N, B, C].
+    """
+
+    def __init__(self, teachers):
+        super(StackedTeachers, self).__init__()
+        self.num_teachers = len(teachers)
+        # stateless template, the weights are given by functional_call
+        self._base = [copy.deepcopy(teachers[0]).to("meta").eval()]
+        self.names = []
+        states = [{**dict(t.named_parameters()), **dict(t.named_buffers())} for t in teachers]
+        for i, name in enumerate(states[0]):
+            self.names.append(name)
+            # buffers, so that they follow .to(device) but are not trained
+            self.register_buffer(
+                f"stacked_{i}", torch.stack([state[name].detach() for state in states]))
+
+    @property
+    def feature_taps(self):
+        return getattr(self._base[0], "feature_taps", None)
+
+    @feature_taps.setter
+    def feature_taps(self, taps):
+        set_feature_taps(self._base[0], taps)
+
+    def forward(self, x):
+        state = {name: getattr(self, f"stacked_{i}") for i, name in enumerate(self.names)}
+
+        def forward(state, x):
+            return functional_call(self._base[0], state, (x,))
+
+        return vmap(forward, in_dims=(0, None))(state, x)
+
+
+class EnsembleTeacher(nn.Module):
+    """
+        An ensemble of frozen teachers, with the (logits, feats) interface of one
+        teacher, so that it feeds the existing losses (KD, DKD, GDKD, ...).
+        The teachers of the same architecture are stacked (StackedTeachers); the
+        groups of different architectures run concurrently on cuda side streams.
+
+        logit_agg:
+            "mean": the weighted mean of the logits.
+            "prob": logits whose softmax at `temperature` is the weighted mean of
+                the teacher probabilities at `temperature`.
+        feat_agg:
+            "mean": the weighted mean of each feature tap (needs the same shapes).
+            "first": the features of the first teacher.
+    """
+
+    def __init__(self, teachers, weights=None, logit_agg="mean", feat_agg="mean",
+                 temperature=1.0, stack=True, concurrent=True):
+        super(EnsembleTeacher, self).__init__()
+        if logit_agg not in ["mean", "prob"]:
+            raise ValueError(f"Unknown DISTILLER.ENSEMBLE.LOGIT_AGG: {logit_agg}")
+        if feat_agg not in ["mean", "first"]:
+            raise ValueError(f"Unknown DISTILLER.ENSEMBLE.FEAT_AGG: {feat_agg}")
+        if weights is None:
+            weights = [1.0] * len(teachers)
+        if len(weights) != len(teachers):
+            raise ValueError("DISTILLER.ENSEMBLE.WEIGHTS: {} weights for {} teachers".format(
+                len(weights), len(teachers)))
+        self.logit_agg = logit_agg
+        self.feat_agg = feat_agg
+        self.temperature = temperature
+        self.concurrent = concurrent
+        weights = torch.as_tensor(weights, dtype=torch.float32)
+        self.register_buffer("weights", weights / weights.sum())
+
+        # group the teachers by architecture, in the order of their first member
+        groups = []
+        for i, teacher in enumerate(teachers):
+            for group in groups:
+                if stack and _signature(teachers[group[0]]) == _signature(teacher):
+                    group.append(i)
+                    break
+            else:
+                groups.append([i])
+        self.group_indices = groups
+        self.groups = nn.ModuleList([
+            StackedTeachers([teachers[i] for i in group]) if len(group) > 1 else teachers[group[0]]
+            for group in groups
+        ])
+        # for the model methods, eg: get_stage_channels
+        self._reference = [teachers[0]]
+        self._streams = None
+        local_print(log_msg("Ensemble teacher: {} teachers in {} groups {}".format(
+            len(teachers), len(groups), groups), "INFO"))
+
+    def __getattr__(self, name):
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if "_reference" not in self.__dict__:
+                raise
+            return getattr(self.__dict__["_reference"][0], name)
+
+    @property
+    def feature_taps(self):
+        return self.groups[0].feature_taps if hasattr(self.groups[0], "feature_taps") else None
+
+    @feature_taps.setter
+    def feature_taps(self, taps):
+        for group in self.groups:
+            set_feature_taps(group, taps)
+
+    def train(self, mode=True):
+        # the teachers are always in eval mode
+        return super().train(False)
+
+    def _run_groups(self, x):
+        """
+            Returns: the outputs of each group, with a leading teacher dim.
+        """
+        if not (self.concurrent and x.is_cuda and len(self.groups) > 1):
+            outputs = [group(x) for group in self.groups]
+        else:
+            current_stream = torch.cuda.current_stream(x.device)
+            if self._streams is None:
+                self._streams = [torch.cuda.Stream(x.device) for _ in self.groups]
+            outputs = []
+            for group, stream in zip(self.groups, self._streams):
+                stream.wait_stream(current_stream)
+                with torch.cuda.stream(stream):
+                    outputs.append(group(x))
+            for stream in self._streams:
+                current_stream.wait_stream(stream)
+            # allocated on the side streams, used on the current stream
+            _record_stream(outputs, current_stream)
+        return [
+            output if isinstance(group, StackedTeachers) else _unsqueeze(output)
+            for group, output in zip(self.groups, outputs)
+        ]
+
+    def _aggregate_logits(self, logits):
+        # logits: [N, B, C] in the teacher order
+        weights = self.weights.view(-1, 1, 1)
+        if self.logit_agg == "mean":
+            return (weights.to(logits.dtype) * logits).sum(0)
+        log_probs = F.log_softmax(logits.float() / self.temperature, dim=-1)
+        return self.temperature * torch.logsumexp(log_probs + weights.log(), dim=0)
+
+    def forward(self, x):
+        outputs = self._run_groups(x)
+        order = [i for group in self.group_indices for i in group]
+        logits = torch.cat([logits for logits, _ in outputs])[
+            torch.as_tensor(order, device=x.device).argsort()]
+        logits = self._aggregate_logits(logits)
+
+        if self.feat_agg == "first":
+            # the first teacher is the first member of the first group
+            feats = _select(outputs[0][1], 0)
+        else:
+            feats = None
+            for group, (_, group_feats) in zip(self.group_indices, outputs):
+                group_feats = _weighted_sum(group_feats, self.weights[group])
+                feats = group_feats if feats is None else _add(feats, group_feats)
+        return logits, feats
+
+
+def get_ensemble_members(cfg, pretrained=True):
+    """
+        The teachers of DISTILLER.TEACHERS, eg: ["resnet32x4", "resnet32x4:noaug"],
+        where ":aug"/":noaug" selects the checkpoint instead of DISTILLER.AUG_TEACHER.
+    """
+    teachers = []
+    for spec in cfg.DISTILLER.TEACHERS:
+        name, _, variant = spec.partition(":")
+        member_cfg = cfg
+        if variant != "":
+            if variant not in ["aug", "noaug"]:
+                raise ValueError(f"Unknown teacher checkpoint {spec}, expected name[:aug|:noaug]")
+            member_cfg = cfg.clone()
+            member_cfg.defrost()
+            member_cfg.DISTILLER.AUG_TEACHER = variant == "aug"
+        teachers.append(get_model(member_cfg, name, pretrained=pretrained))
+    return teachers
+
+
+def get_ensemble_teacher(cfg, pretrained=True, teachers=None):
+    """
+        The EnsembleTeacher of DISTILLER.TEACHERS by DISTILLER.ENSEMBLE.
+    """
+    if cfg.TEACHER.OPTIMIZE or cfg.TEACHER.QUANT.ENABLE:
+        raise ValueError("DISTILLER.TEACHERS can not be combined with TEACHER.OPTIMIZE or TEACHER.QUANT")
+    if teachers is None:
+        teachers = get_ensemble_members(cfg, pretrained=pretrained)
+    ensemble = cfg.DISTILLER.ENSEMBLE
+    return EnsembleTeacher(
+        teachers,
+        weights=list(ensemble.WEIGHTS) or None,
+        logit_agg=ensemble.LOGIT_AGG,
+        feat_agg=ensemble.FEAT_AGG,
+        temperature=ensemble.TEMPERATURE,
+        stack=ensemble.STACK,
+        concurrent=ensemble.CONCURRENT,
+    )
+
+
+def get_teacher(cfg, pretrained=True):
+    # DISTILLER.TEACHER, or the ensemble of DISTILLER.TEACHERS
+    if len(cfg.DISTILLER.TEACHERS) > 0:
+        return get_ensemble_teacher(cfg, pretrained=pretrained)
+    return get_model(cfg, cfg.DISTILLER.TEACHER, pretrained=pretrained)
@@ -5,78 +5,31 @@ import torch.nn.functional as F
 import numpy as np
 
 from .._base import Distiller
-from ..utils import kl_div, validate
+from ..utils import validate, autocast_fp32, partition_kl
 
 from mdistiller.dataset import get_dataset
+from mdistiller.engine.device import get_device
 
 
 import math
 
-MASK_MAGNITUDE = 1000.0
-
-
-def get_top1_masks(logits, target):
-    # top1 mask
-    max_indices = logits.argmax(dim=1, keepdim=True)
-    mask_u1 = torch.zeros_like(
-        logits, dtype=torch.bool).scatter_(1, max_indices, 1)
-
-    # other mask
-    mask_u2 = torch.ones_like(
-        logits, dtype=torch.bool).scatter_(1, max_indices, 0)
-
-    return max_indices, mask_u1, mask_u2
-
 
 def get_target_masks(logits, target):
     # target mask
     target = target.unsqueeze(1)
-    mask_u1 = torch.zeros_like(
+    return torch.zeros_like(
         logits, dtype=torch.bool).scatter_(1, target, 1)
 
-    # other mask
-    mask_u2 = torch.ones_like(
-        logits, dtype=torch.bool).scatter_(1, target, 0)
-
-    return mask_u1, mask_u2
-
-
-def cat_mask(t, mask1, mask2):
-    t1 = (t * mask1).sum(dim=1, keepdims=True)
-    t2 = (t * mask2).sum(dim=1, keepdims=True)
-    rt = torch.cat([t1, t2], dim=1)  # [B, 2]
-    return rt
-
 
+@autocast_fp32
 def dkd_loss(logits_student, logits_teacher, target, alpha, beta, gamma, temperature, kl_type):
-    mask_u1, mask_u2 = get_target_masks(logits_teacher, target)
-
-    soft_logits_student = logits_student / temperature
-    soft_logits_teacher = logits_teacher / temperature
-
-    p_student = F.softmax(soft_logits_student, dim=1)
-    p_teacher = F.softmax(soft_logits_teacher, dim=1)
+    mask_u1 = get_target_masks(logits_teacher, target)
 
-    # accumulated term
-    p0_student = cat_mask(p_student, mask_u1, mask_u2)
-    p0_teacher = cat_mask(p_teacher, mask_u1, mask_u2)
-
-    log_p0_student = torch.log(p0_student)
-    tckd_loss = (
-        F.kl_div(log_p0_student, p0_teacher, reduction="batchmean")
-        * (temperature**2)
-    )
-
-    log_p2_student = F.log_softmax(
-        soft_logits_student - MASK_MAGNITUDE * mask_u1, dim=1
-    )
-    log_p2_teacher = F.log_softmax(
-        soft_logits_teacher - MASK_MAGNITUDE * mask_u1, dim=1
-    )
-    nckd = kl_div(log_p2_student, log_p2_teacher, temperature,
-                  kl_type, reduction="none")  # [B]
-    # nckd = kl_div(log_p2_student, log_p2_teacher, temperature,
-    #               kl_type)
+    # per-sample losses of the partitions (target, other), see partition_kl
+    tckd, low, _ = partition_kl(
+        logits_student, logits_teacher.detach(), mask_u1, temperature, kl_type)
+    tckd_loss = tckd.mean()
+    nckd = low[:, 1]  # [B]
 
     # TODO: decay gamma
     # adaptive beta based on teacher logits:
@@ -91,9 +44,6 @@ def dkd_loss(logits_student, logits_teacher, target, alpha, beta, gamma, tempera
     )
 
 
-
-
-
 def prebuild_beta(teacher, cfg, T=4.0, preload_path=None):
     # logits_dict = np.load(f"exp/{dataset}_{model}_logits.npz")
     if preload_path:
@@ -102,7 +52,8 @@ def prebuild_beta(teacher, cfg, T=4.0, preload_path=None):
     print("Prebuilding beta...")
     train_loader, val_loader, num_data, num_classes = get_dataset(cfg)
 
-    logits_arr = validate(train_loader, teacher, num_classes)
+    logits_arr = validate(train_loader, teacher, num_classes,
+                          device=get_device(cfg))
 
     beta = torch.zeros(num_classes)
     for i, logits in enumerate(logits_arr):
@@ -130,6 +81,10 @@ class ADKD(Distiller):
         DKD with auto adjusted beta.
         beta = (max_prob/2nd_prob).mean()
     """
+
+    # only the teacher logits are used
+    requires_teacher_features = False
+
     def __init__(self, student, teacher, cfg):
         super(ADKD, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.ADKD.CE_WEIGHT
@@ -150,9 +105,8 @@ class ADKD(Distiller):
         )
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         epoch = kwargs["epoch"]
 
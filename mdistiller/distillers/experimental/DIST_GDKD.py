@@ -1,4 +1,3 @@
-import torch
 import torch.nn.functional as F
 
 from ..DIST import DIST, inter_class_relation, intra_class_relation
@@ -16,9 +15,8 @@ class DIST_GDKD(DIST):
         self.k = cfg.GDKD.TOPK
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
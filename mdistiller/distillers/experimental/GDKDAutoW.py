@@ -3,9 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from .._base import Distiller
-from ..utils import kl_div
-
-MASK_MAGNITUDE = 1000.0
+from ..utils import autocast_fp32, partition_kl
 
 
 def get_masks(logits, k=5, strategy="best"):
@@ -28,75 +26,30 @@ def get_masks(logits, k=5, strategy="best"):
     return mask_u1, mask_u2
 
 
-def cat_mask(t, mask1, mask2):
-    t1 = (t * mask1).sum(dim=1, keepdims=True)
-    t2 = (t * mask2).sum(dim=1, keepdims=True)
-    rt = torch.cat([t1, t2], dim=1)  # [B, 2]
-    return rt
-
-
+@autocast_fp32
 def gdkd_loss_autow(logits_student, logits_teacher, k, m1, m2, w1, w2, T, mode="v1"):
-    mask_u1, mask_u2 = get_masks(logits_teacher, k, "best")
-
-    soft_logits_student = logits_student / T
-    soft_logits_teacher = logits_teacher / T
-
-    p_student = F.softmax(soft_logits_student, dim=1)
-    p_teacher = F.softmax(soft_logits_teacher, dim=1)
+    mask_u1, _ = get_masks(logits_teacher, k, "best")
 
     # Notation: high_loss: level 0 loss; low_loss: level 1 loss
-    # accumulated term
-    p0_student = cat_mask(p_student, mask_u1, mask_u2)
-    p0_teacher = cat_mask(p_teacher, mask_u1, mask_u2)
-
-    log_p0_student = torch.log(p0_student)
-    high_loss = (
-        F.kl_div(log_p0_student, p0_teacher, reduction="batchmean")
-        * (T**2)
-    )
+    # per-sample losses of the partitions (topk, other), see partition_kl
+    high, low, log_mass_teacher = partition_kl(
+        logits_student, logits_teacher.detach(), mask_u1, T)
+    high_loss = high.mean()
 
-    b_t = p0_teacher[:, 0]
-    b_o = p0_teacher[:, 1]
+    b_t = log_mass_teacher[:, 0].exp()
+    b_o = log_mass_teacher[:, 1].exp()
 
     # topk loss
-    log_p1_student = F.log_softmax(
-        soft_logits_student - MASK_MAGNITUDE * mask_u2, dim=1
-    )
-    log_p1_teacher = F.log_softmax(
-        soft_logits_teacher - MASK_MAGNITUDE * mask_u2, dim=1
-    )
-
     if mode == "v2":
-        low_top_loss = kl_div(
-            log_p1_student, log_p1_teacher,
-            T, reduction='batchmean'
-        )
+        low_top_loss = low[:, 0].mean()
     else:
-        low_top_loss = b_t * kl_div(
-            log_p1_student, log_p1_teacher,
-            T, reduction='none'
-        )
-        low_top_loss = low_top_loss.mean()
+        low_top_loss = (b_t * low[:, 0]).mean()
 
     # other classes loss
-    log_p2_student = F.log_softmax(
-        soft_logits_student - MASK_MAGNITUDE * mask_u1, dim=1
-    )
-    log_p2_teacher = F.log_softmax(
-        soft_logits_teacher - MASK_MAGNITUDE * mask_u1, dim=1
-    )
-
     if mode == "v3":
-        low_other_loss = kl_div(
-            log_p2_student, log_p2_teacher,
-            T, reduction='batchmean'
-        )
+        low_other_loss = low[:, 1].mean()
     else:
-        low_other_loss = b_o * kl_div(
-            log_p2_student, log_p2_teacher,
-            T, reduction='none'
-        )
-        low_other_loss = low_other_loss.mean()
+        low_other_loss = (b_o * low[:, 1]).mean()
 
     if mode == 'v1':
         loss = high_loss + m1*low_top_loss + m2*low_other_loss
@@ -125,6 +78,9 @@ class GDKDAutoW(Distiller):
         v3: loss = high_loss + m1 * b_t * low_top_loss + w2 * low_other_loss
     """
 
+    # only the teacher logits are used
+    requires_teacher_features = False
+
     def __init__(self, student, teacher, cfg):
         super(GDKDAutoW, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.GDKDAutoW.CE_WEIGHT
@@ -140,9 +96,8 @@ class GDKDAutoW(Distiller):
         self.k = cfg.GDKDAutoW.TOPK
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
@@ -1,117 +1,24 @@
-import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from .._base import Distiller
-from ..utils import kl_div, validate
+from ..utils import autocast_fp32, partition_kd_loss, get_topk_mask, calc_topk
 
 from mdistiller.dataset import get_dataset
 
 import yaml
 
-MASK_MAGNITUDE = 1000.0
-
-
-def get_masks(logits, topks):
-    maxk = topks.max()
-    ranks = torch.topk(logits, maxk, dim=-1,
-                       largest=True,
-                       sorted=True).indices
-
-    for i in range(logits.shape[0]):
-        ranks[i, topks[i]:] = ranks[i][0]
-    # ranks = ranks.to(device)
-
-    # topk mask
-    mask_u1 = torch.zeros_like(logits, dtype=torch.bool).scatter_(1, ranks, 1)
-    # other mask
-    mask_u2 = torch.logical_not(mask_u1)
-
-    return mask_u1, mask_u2
-
-
-def cat_mask(t, mask1, mask2):
-    t1 = (t * mask1).sum(dim=1, keepdims=True)
-    t2 = (t * mask2).sum(dim=1, keepdims=True)
-    rt = torch.cat([t1, t2], dim=1)  # [B, 2]
-    return rt
-
-
-def calc_topk(probs, topk_th, ratio_th):
-    num_classes = probs.shape[1]
-    x = torch.arange(1, num_classes+1).to(probs.device)
-
-    probs = probs.sort(dim=1, descending=False).values
-
-    cumavg = probs.cumsum(dim=1)/x
-    ratio = probs/cumavg
-
-    topk_arr = []
-    for r in ratio:
-        idx = torch.nonzero(r >= ratio_th).squeeze(1)
-        if len(idx):
-            topk = 100-idx[0].item()
-        else:
-            topk = 1
-
-        topk = min(topk, topk_th)
-
-        topk_arr.append(topk)
-
-    topk_arr = torch.as_tensor(topk_arr)
-
-    return topk_arr
-
 
+@autocast_fp32
 def gdkd_loss(logits_student, logits_teacher, target, topk_th, ratio_th, w0, w1, w2, temperature, kl_type):
-
-    soft_logits_student = logits_student / temperature
-    soft_logits_teacher = logits_teacher / temperature
-
-    p_student = F.softmax(soft_logits_student, dim=1)
-    p_teacher = F.softmax(soft_logits_teacher, dim=1)
-
+    p_teacher = F.softmax(logits_teacher / temperature, dim=1)
     topks = calc_topk(p_teacher, topk_th, ratio_th)
 
-    mask_u1, mask_u2 = get_masks(logits_teacher, topks)
-
-    # accumulated term
-    p0_student = cat_mask(p_student, mask_u1, mask_u2)
-    p0_teacher = cat_mask(p_teacher, mask_u1, mask_u2)
-
-    log_p0_student = torch.log(p0_student)
-    high_loss = (
-        F.kl_div(log_p0_student, p0_teacher, reduction="batchmean")
-        * (temperature**2)
-    )
-
-    # topk loss
-    log_p1_student = F.log_softmax(
-        soft_logits_student - MASK_MAGNITUDE * mask_u2, dim=1
-    )
-    log_p1_teacher = F.log_softmax(
-        soft_logits_teacher - MASK_MAGNITUDE * mask_u2, dim=1
-    )
-
-    low_top_loss = kl_div(log_p1_student, log_p1_teacher, temperature, kl_type)
-
-    # other classes loss
-    log_p2_student = F.log_softmax(
-        soft_logits_student - MASK_MAGNITUDE * mask_u1, dim=1
-    )
-    log_p2_teacher = F.log_softmax(
-        soft_logits_teacher - MASK_MAGNITUDE * mask_u1, dim=1
-    )
-
-    low_other_loss = kl_div(
-        log_p2_student, log_p2_teacher, temperature, kl_type)
-
-    return (
-        w0 * high_loss + w1 * low_top_loss + w2 * low_other_loss,
-        high_loss.detach(),
-        low_top_loss.detach(),
-        low_other_loss.detach()
-    )
+    mask_u1 = get_topk_mask(logits_teacher, topks, max_k=topk_th)
+    # the partitions (topk, other), see partition_kd_loss
+    loss, high_loss, low_losses = partition_kd_loss(
+        logits_student, logits_teacher, mask_u1, w0, [w1, w2], temperature, kl_type)
+    return loss, high_loss, low_losses[0], low_losses[1]
 
 
 class GDKDAutok(Distiller):
@@ -119,6 +26,10 @@ class GDKDAutok(Distiller):
         GDKD with autok: k is determined by each sample,
         which is controled by topk_th and ratio_th.
     """
+
+    # only the teacher logits are used
+    requires_teacher_features = False
+
     def __init__(self, student, teacher, cfg):
         super(GDKDAutok, self).__init__(student, teacher)
         self.ce_loss_weight = cfg.GDKDAUTOK.CE_WEIGHT
@@ -133,9 +44,8 @@ class GDKDAutok(Distiller):
         self.ratio_th = cfg.GDKDAUTOK.RATIO_TH
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_loss_weight * F.cross_entropy(logits_student, target)
@@ -1,4 +1,3 @@
-import torch
 import torch.nn.functional as F
 
 from ..ReviewKD import ReviewKD, hcl_loss
@@ -18,9 +17,8 @@ class ReviewKD_GDKD(ReviewKD):
 
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, features_student = self.student(image)
-        with torch.no_grad():
-            logits_teacher, features_teacher = self.teacher(image)
+        logits_student, features_student = self.forward_student(image, **kwargs)
+        logits_teacher, features_teacher = self.forward_teacher(image, **kwargs)
 
         # get features
         if self.stu_preact:
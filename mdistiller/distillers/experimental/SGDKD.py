@@ -3,9 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from .._base import Distiller
-from ..utils import kl_div
-
-MASK_MAGNITUDE = 1000.0
+from ..utils import autocast_fp32, partition_kd_loss
 
 
 def get_masks(logits, target, eta=0.1):
@@ -37,51 +35,16 @@ def get_masks(logits, target, eta=0.1):
     return mask_u0, mask_u1, mask_u2
 
 
-def cat_mask(t, *masks):
-    res = [
-        (t * mask).sum(dim=1, keepdims=True)
-        for mask in masks
-    ]
-
-    rt = torch.cat(res, dim=1)  # [B, k]
-    return rt
-
-
+@autocast_fp32
 def gdkd_loss(logits_student, logits_teacher, target, eta, w0, w1, temperature, kl_type):
-    mask_u0, mask_u1, mask_u2 = get_masks(logits_teacher, target, eta)
-
-    soft_logits_student = logits_student / temperature
-    soft_logits_teacher = logits_teacher / temperature
-
-    p_student = F.softmax(soft_logits_student, dim=1)
-    p_teacher = F.softmax(soft_logits_teacher, dim=1)
+    _, mask_u1, mask_u2 = get_masks(logits_teacher, target, eta)
+    # partition ids: 0: target, 1: other, 2: ignore
+    partition = mask_u1.long() + 2 * mask_u2.long()
 
-    # accumulated term
-    p0_student = cat_mask(p_student, mask_u0, mask_u1, mask_u2)
-    p0_teacher = cat_mask(p_teacher, mask_u0, mask_u1, mask_u2)
-
-    # Caution: p0_student.sum(1)!=1
-    log_p0_student = torch.log(p0_student)
-    high_loss = (
-        F.kl_div(log_p0_student, p0_teacher, reduction="batchmean")
-        * (temperature**2)
-    )
-
-    # low loss
-    log_p1_student = F.log_softmax(
-        soft_logits_student - MASK_MAGNITUDE * ~mask_u1, dim=1
-    )
-    log_p1_teacher = F.log_softmax(
-        soft_logits_teacher - MASK_MAGNITUDE * ~mask_u1, dim=1
-    )
-
-    low_loss = kl_div(log_p1_student, log_p1_teacher, temperature, kl_type)
-
-    return (
-        w0 * high_loss + w1 * low_loss,
-        high_loss.detach(),
-        low_loss.detach()
-    )
+    # the low loss of the ignore partition is not used
+    loss, high_loss, low_losses = partition_kd_loss(
+        logits_student, logits_teacher, partition, w0, [0.0, w1, 0.0], temperature, kl_type)
+    return loss, high_loss, low_losses[1]
 
 
 class SGDKD(Distiller):
@@ -89,6 +52,10 @@ class SGDKD(Distiller):
         Stocastic GDKD with 3 splits: target, other, ignore.
         low_ignore_loss is not used.
     """
+
+    # only the teacher logits are used
+    requires_teacher_features = False
+
     def __init__(self, student, teacher, cfg):
         super(SGDKD, self).__init__(student, teacher)
         self.ce_weight = cfg.SGDKD.CE_WEIGHT
@@ -100,9 +67,8 @@ class SGDKD(Distiller):
         self.kl_type = cfg.SGDKD.KL_TYPE
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_weight * F.cross_entropy(logits_student, target)
@@ -3,9 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from .._base import Distiller
-from ..utils import kl_div
-
-MASK_MAGNITUDE = 1000.0
+from ..utils import autocast_fp32, partition_kd_loss
 
 
 def get_masks(logits, target, eta=0.1):
@@ -14,20 +12,12 @@ def get_masks(logits, target, eta=0.1):
     return mask
 
 
+@autocast_fp32
 def kd_loss(logits_student, logits_teacher, target, eta, temperature, kl_type):
     mask = get_masks(logits_teacher, target, eta)
-    soft_logits_student = logits_student / temperature
-    soft_logits_teacher = logits_teacher / temperature
-
-    # topk loss
-    log_p1_student = F.log_softmax(
-        soft_logits_student - MASK_MAGNITUDE * ~mask, dim=1
-    )
-    log_p1_teacher = F.log_softmax(
-        soft_logits_teacher - MASK_MAGNITUDE * ~mask, dim=1
-    )
-
-    loss = kl_div(log_p1_student, log_p1_teacher, temperature, kl_type)
+    # only the KL within the sampled classes, see partition_kd_loss
+    loss, _, _ = partition_kd_loss(
+        logits_student, logits_teacher, mask, 0.0, [1.0, 0.0], temperature, kl_type)
 
     return (
         loss,
@@ -39,6 +29,10 @@ class SKD(Distiller):
     """
         KD with stochastic partial logits distillation
     """
+
+    # only the teacher logits are used
+    requires_teacher_features = False
+
     def __init__(self, student, teacher, cfg):
         super(SKD, self).__init__(student, teacher)
         self.ce_weight = cfg.SKD.CE_WEIGHT
@@ -49,9 +43,8 @@ class SKD(Distiller):
         self.kl_type = cfg.SKD.KL_TYPE
 
     def forward_train(self, image, target, **kwargs):
-        logits_student, _ = self.student(image)
-        with torch.no_grad():
-            logits_teacher, _ = self.teacher(image)
+        logits_student, _ = self.forward_student(image, **kwargs)
+        logits_teacher, _ = self.forward_teacher(image, **kwargs)
 
         # losses
         loss_ce = self.ce_weight * F.cross_entropy(logits_student, target)
@@ -0,0 +1,317 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from mdistiller.engine.utils import log_msg, local_print
+
+
+class FoldedBatchNorm(nn.Module):
+    """
+        Identity in place of a BatchNorm2d folded into the previous conv.
+        Keeps the BN statistics as buffers, eg: for `get_bn_before_relu()` of OFD.
+    """
+
+    def __init__(self, bn):
+        super(FoldedBatchNorm, self).__init__()
+        self.num_features = bn.num_features
+        self.eps = bn.eps
+        for name in ["weight", "bias", "running_mean", "running_var"]:
+            value = getattr(bn, name)
+            self.register_buffer(
+                name, value.detach().clone() if value is not None else None)
+
+    def forward(self, x):
+        return x
+
+
+def _flatten_tensors(x):
+    if isinstance(x, torch.Tensor):
+        return [x]
+    elif isinstance(x, (list, tuple)):
+        return [t for v in x for t in _flatten_tensors(v)]
+    elif isinstance(x, dict):
+        return [t for v in x.values() for t in _flatten_tensors(v)]
+    return []
+
+
+def find_conv_bn_pairs(model, example):
+    """
+        Find the (conv, bn) module names where the bn is applied directly on
+        the output of the conv, by tracing one forward with hooks. The conv
+        output must only be used by the bn: a folded bn returns its input, eg:
+        an inplace relu after it would also overwrite the other uses.
+    """
+    conv_outputs = {}
+    calls = {}
+    uses = {}
+    pairs = []
+
+    def conv_hook(name):
+        def hook(module, input, output):
+            calls[name] = calls.get(name, 0) + 1
+            # keep the output alive, so that its id is not reused
+            conv_outputs[id(output)] = (name, output)
+        return hook
+
+    def bn_hook(name):
+        def hook(module, input):
+            calls[name] = calls.get(name, 0) + 1
+            if id(input[0]) in conv_outputs:
+                pairs.append((conv_outputs[id(input[0])][0], name, id(input[0])))
+        return hook
+
+    def use_hook(module, input):
+        for x in _flatten_tensors(input):
+            uses[id(x)] = uses.get(id(x), 0) + 1
+
+    handles = []
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Conv2d):
+            handles.append(module.register_forward_hook(conv_hook(name)))
+        elif isinstance(module, nn.BatchNorm2d):
+            handles.append(module.register_forward_pre_hook(bn_hook(name)))
+        # the uses by the leaf modules, the containers pass their inputs on
+        if len(module._modules) == 0:
+            handles.append(module.register_forward_pre_hook(use_hook))
+    try:
+        with torch.no_grad():
+            outputs = model(example)
+    finally:
+        for handle in handles:
+            handle.remove()
+    # the conv outputs returned by the model, eg: the stem feature of WRN
+    for x in _flatten_tensors(outputs):
+        uses[id(x)] = uses.get(id(x), 0) + 1
+
+    # shared modules can not be folded
+    return [
+        (conv, bn) for conv, bn, output_id in pairs
+        if calls[conv] == 1 and calls[bn] == 1 and uses[output_id] == 1
+    ]
+
+
+@torch.no_grad()
+def fold_conv_bn(conv, bn):
+    scale = bn.running_var.add(bn.eps).rsqrt()
+    if bn.weight is not None:
+        scale = scale * bn.weight
+    bias = -bn.running_mean * scale
+    if bn.bias is not None:
+        bias = bias + bn.bias
+    if conv.bias is not None:
+        bias = bias + conv.bias * scale
+    conv.weight.mul_(scale.view(-1, 1, 1, 1))
+    conv.bias = nn.Parameter(bias)
+
+
+def _set_module(model, name, module):
+    parent_name, _, attr = name.rpartition(".")
+    parent = model.get_submodule(parent_name) if parent_name else model
+    setattr(parent, attr, module)
+
+
+def _fold_pair(model, conv, bn, bn_name):
+    # Returns: the conv weight & bias to undo the fold
+    state = (conv.weight.detach().clone(), conv.bias)
+    fold_conv_bn(conv, bn)
+    _set_module(model, bn_name, FoldedBatchNorm(bn))
+    return state
+
+
+@torch.no_grad()
+def _unfold_pair(model, conv, bn, bn_name, state):
+    weight, bias = state
+    conv.weight.copy_(weight)
+    conv.bias = bias
+    _set_module(model, bn_name, bn)
+
+
+def _fold_error(model, example, ref_outputs):
+    with torch.no_grad():
+        outputs = model(example)
+    return max(get_parity_errors(outputs, ref_outputs).values())
+
+
+def fold_bn(model, example, rtol=1e-4):
+    """
+        Fold the eval-mode BatchNorm2d into the previous conv in place.
+        The outputs on `example` must not change (rtol): otherwise, eg: the conv
+        output is also used by a function, each fold is checked & undone on
+        its own.
+        Returns: the number of folded BNs.
+    """
+    model.eval()
+    modules = dict(model.named_modules())
+    pairs = find_conv_bn_pairs(model, example)
+    with torch.no_grad():
+        ref_outputs = _clone_outputs(model(example))
+
+    states = [
+        _fold_pair(model, modules[conv_name], modules[bn_name], bn_name)
+        for conv_name, bn_name in pairs
+    ]
+    if _fold_error(model, example, ref_outputs) <= rtol:
+        return len(pairs)
+
+    for (conv_name, bn_name), state in reversed(list(zip(pairs, states))):
+        _unfold_pair(model, modules[conv_name], modules[bn_name], bn_name, state)
+    num_folded = 0
+    for conv_name, bn_name in pairs:
+        state = _fold_pair(model, modules[conv_name], modules[bn_name], bn_name)
+        if _fold_error(model, example, ref_outputs) <= rtol:
+            num_folded += 1
+        else:
+            _unfold_pair(model, modules[conv_name], modules[bn_name], bn_name, state)
+            local_print(log_msg("Teacher: {} is not folded into {}, the outputs change".format(
+                bn_name, conv_name), "INFO"))
+    return num_folded
+
+
+def _clone_outputs(x):
+    # inference tensors can not be saved for backward, eg: as the target of kl_div
+    if isinstance(x, torch.Tensor):
+        return x.clone()
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_clone_outputs(v) for v in x)
+    elif isinstance(x, dict):
+        return {k: _clone_outputs(v) for k, v in x.items()}
+    return x
+
+
+def _relative_error(x, ref):
+    x, ref = x.float(), ref.float()
+    return ((x - ref).abs().max() / ref.abs().max().clamp_min(1e-6)).item()
+
+
+def get_parity_errors(outputs, ref_outputs, prefix="logits"):
+    """
+        Returns: {name: max relative error} over the logits & all the feature taps.
+    """
+    if isinstance(ref_outputs, torch.Tensor):
+        return {prefix: _relative_error(outputs, ref_outputs)}
+    elif isinstance(ref_outputs, (list, tuple)):
+        errors = {}
+        for i, (x, ref) in enumerate(zip(outputs, ref_outputs)):
+            errors.update(get_parity_errors(x, ref, f"{prefix}.{i}"))
+        return errors
+    elif isinstance(ref_outputs, dict):
+        errors = {}
+        for k, ref in ref_outputs.items():
+            errors.update(get_parity_errors(outputs[k], ref, k))
+        return errors
+    return {}
+
+
+class FrozenTeacher(nn.Module):
+    """
+        Inference-only teacher: BN folded into the convs, run under
+        `torch.inference_mode`, optionally frozen by TorchScript or torch.compile
+        and in channels_last. The outputs (logits, feats) are the same as the
+        eager teacher, incl. `feats` & `preact_feats`.
+
+        Tracing/compiling and the parity check are done at the first forward,
+        ie: on the final device, under the autocast context of training.
+    """
+
+    def __init__(self, model, freeze="none", inference_mode=True,
+                 channels_last=False, eager_model=None, parity_rtol=None):
+        super(FrozenTeacher, self).__init__()
+        if freeze not in ["none", "script", "compile"]:
+            raise ValueError(f"Unknown TEACHER.FREEZE: {freeze}")
+        self.model = model
+        self.freeze = freeze
+        self.inference_mode = inference_mode
+        self.memory_format = torch.channels_last if channels_last else None
+        # not registered as a submodule: only used once for the parity check
+        self._eager_model = [eager_model] if eager_model is not None else []
+        self.parity_rtol = parity_rtol
+        # not registered either, the traced/compiled model shares the weights of `model`
+        self._frozen_model = []
+        self._prepared = False
+
+    def __getattr__(self, name):
+        # forward the model methods, eg: get_bn_before_relu, get_stage_channels
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if "model" not in self._modules:
+                raise
+            return getattr(self._modules["model"], name)
+
+    def train(self, mode=True):
+        # the teacher is always in eval mode
+        return super().train(False)
+
+    def _prepare(self, x):
+        if self.memory_format is not None:
+            self.model.to(memory_format=self.memory_format)
+        if self.freeze == "script":
+            with torch.no_grad():
+                model = torch.jit.trace(self.model, x, strict=False)
+            self._frozen_model.append(torch.jit.freeze(model))
+        elif self.freeze == "compile":
+            self._frozen_model.append(torch.compile(self.model))
+        self._prepared = True
+
+    def _run(self, model, x):
+        if self.inference_mode:
+            with torch.inference_mode():
+                outputs = model(x)
+            return _clone_outputs(outputs)
+        with torch.no_grad():
+            return model(x)
+
+    def check_parity(self, x, outputs):
+        eager_model = self._eager_model.pop().to(x.device)
+        eager_model.eval()
+        with torch.no_grad():
+            ref_outputs = eager_model(x)
+        del eager_model
+        errors = get_parity_errors(outputs, ref_outputs)
+        rtol = self.parity_rtol
+        if rtol is None:
+            # fp32 vs reduced precision under autocast
+            rtol = 1e-3 if outputs[0].dtype == torch.float32 else 5e-2
+        failed = {k: v for k, v in errors.items() if not v <= rtol}
+        if len(failed) > 0:
+            raise RuntimeError(
+                "Teacher parity check failed (rtol={}): {}".format(rtol, failed))
+        local_print(log_msg("Teacher parity check passed, max relative error: {:.2e}".format(
+            max(errors.values())), "INFO"))
+
+    def forward(self, x):
+        if self.memory_format is not None:
+            x = x.contiguous(memory_format=self.memory_format)
+        if not self._prepared:
+            self._prepare(x)
+        model = self._frozen_model[0] if len(self._frozen_model) > 0 else self.model
+        outputs = self._run(model, x)
+        if len(self._eager_model) > 0:
+            self.check_parity(x, outputs)
+        return outputs
+
+
+def get_input_size(cfg):
+    return (32, 32) if cfg.DATASET.TYPE == "cifar100" else (224, 224)
+
+
+def prepare_teacher(teacher, cfg):
+    """
+        Build the FrozenTeacher from the eager teacher by cfg.TEACHER.
+    """
+    eager_teacher = copy.deepcopy(teacher) if cfg.TEACHER.CHECK_PARITY else None
+    teacher.eval()
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    if cfg.TEACHER.FOLD_BN:
+        example = torch.randn(2, 3, *get_input_size(cfg))
+        num_folded = fold_bn(teacher, example)
+        local_print(log_msg("Teacher: folded {} BNs into convs".format(num_folded), "INFO"))
+    return FrozenTeacher(
+        teacher,
+        freeze=cfg.TEACHER.FREEZE,
+        inference_mode=cfg.TEACHER.INFERENCE_MODE,
+        channels_last=cfg.TEACHER.CHANNELS_LAST,
+        eager_model=eager_teacher,
+    )
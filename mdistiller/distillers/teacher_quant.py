@@ -0,0 +1,90 @@
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from mdistiller.engine.utils import log_msg, local_print
+from mdistiller.engine.device import get_device
+from .teacher import get_input_size, _clone_outputs
+
+
+def calibrate(model, loader, num_batches):
+    """
+        Run the observed model on the first `num_batches` batches of the
+        (DevicePrefetcher) loader. Returns: the number of calibration images.
+    """
+    num_images = 0
+    with torch.no_grad():
+        for idx, data in enumerate(loader):
+            if idx >= num_batches:
+                break
+            image = data[0].float().cpu()
+            model(image)
+            num_images += image.shape[0]
+    return num_images
+
+
+def quantize_model(model, loader, example, backend="fbgemm", num_batches=200):
+    """
+        Post-training static int8 quantization (FX graph mode) of an eval model,
+        calibrated on the images of `loader`. Conv-BN(-ReLU) are fused by
+        prepare_fx. The modules of `model` are reused, so it should not be
+        used afterwards (deepcopy it to compare with the float model).
+        The quantized model returns the same (logits, feats) structure as the
+        float model, with the tensors dequantized to fp32.
+    """
+    if backend not in torch.backends.quantized.supported_engines:
+        raise ValueError("Unsupported quantization backend {}, available: {}".format(
+            backend, torch.backends.quantized.supported_engines))
+    torch.backends.quantized.engine = backend
+    model.eval()
+    try:
+        prepared = prepare_fx(
+            model, get_default_qconfig_mapping(backend), example_inputs=(example,))
+    except Exception as e:
+        raise RuntimeError(
+            "Can not trace {} for the int8 quantization: {}".format(type(model).__name__, e)) from e
+    num_images = calibrate(prepared, loader, num_batches)
+    local_print(log_msg("Teacher: calibrated the int8 quantization on {} images".format(
+        num_images), "INFO"))
+    return convert_fx(prepared)
+
+
+class QuantizedTeacher(nn.Module):
+    """
+        Int8 teacher for the CPU distillation. The quantized model is run in
+        fp32 (autocast disabled) under `torch.inference_mode`.
+    """
+
+    def __init__(self, model):
+        super(QuantizedTeacher, self).__init__()
+        self.model = model
+
+    def train(self, mode=True):
+        # the teacher is always in eval mode
+        return super().train(False)
+
+    def forward(self, x):
+        with torch.autocast(device_type="cpu", enabled=False), torch.inference_mode():
+            outputs = self.model(x.float())
+        return _clone_outputs(outputs)
+
+
+def quantize_teacher(teacher, loader, cfg):
+    """
+        Build the QuantizedTeacher by cfg.TEACHER.QUANT, with the feature taps
+        already set on the float teacher (see mdistiller.models.taps).
+    """
+    if get_device(cfg).type != "cpu":
+        raise ValueError("TEACHER.QUANT requires the cpu device")
+    if cfg.TEACHER.OPTIMIZE or cfg.TEACHER.SERVER.ENABLE:
+        raise ValueError("TEACHER.QUANT can not be combined with TEACHER.OPTIMIZE or TEACHER.SERVER")
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    example = torch.randn(2, 3, *get_input_size(cfg))
+    model = quantize_model(
+        teacher, loader, example,
+        backend=cfg.TEACHER.QUANT.BACKEND,
+        num_batches=cfg.TEACHER.QUANT.CALIB_BATCHES,
+    )
+    return QuantizedTeacher(model)
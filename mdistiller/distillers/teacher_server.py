@@ -0,0 +1,278 @@
+import os
+import time
+import queue
+import threading
+from multiprocessing.connection import Listener, Client
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing
+
+from mdistiller.engine.utils import log_msg
+from mdistiller.engine.cfg import get_teacher_tag
+from mdistiller.models.taps import merge_feature_taps
+
+
+def get_server_meta(cfg):
+    # the clients must use the same teacher
+    return dict(
+        dataset=cfg.DATASET.TYPE,
+        teacher=get_teacher_tag(cfg),
+        aug_teacher=cfg.DISTILLER.AUG_TEACHER,
+    )
+
+
+def _to_device(x, device, non_blocking=False):
+    if isinstance(x, torch.Tensor):
+        return x.to(device, non_blocking=non_blocking)
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_to_device(v, device, non_blocking) for v in x)
+    elif isinstance(x, dict):
+        return {k: _to_device(v, device, non_blocking) for k, v in x.items()}
+    return x
+
+
+def _split(x, sizes):
+    """
+        Split the tensors in nested lists & dicts along the batch dim.
+        Returns: a list of len(sizes) nested structures.
+    """
+    if isinstance(x, torch.Tensor):
+        return list(x.split(sizes))
+    elif isinstance(x, (list, tuple)):
+        parts = [_split(v, sizes) for v in x]
+        return [type(x)(p[i] for p in parts) for i in range(len(sizes))]
+    elif isinstance(x, dict):
+        parts = {k: _split(v, sizes) for k, v in x.items()}
+        return [{k: p[i] for k, p in parts.items()} for i in range(len(sizes))]
+    return [x] * len(sizes)
+
+
+def _select_taps(feats, taps):
+    if taps is None:
+        return feats
+    return {k: v for k, v in feats.items() if k in taps}
+
+
+class TeacherServer():
+    """
+        Hold one teacher for several local training processes (TeacherProxy).
+        The clients write their image batches into shared memory buffers; the
+        requests are dynamically batched (up to `max_batch_size` images, or
+        waiting at most `max_wait_ms` for more requests) and the outputs
+        are returned through shared memory.
+    """
+
+    def __init__(self, teacher, device, meta, address, authkey,
+                 amp_dtype=None, max_batch_size=1024, max_wait_ms=5.0):
+        self.teacher = teacher
+        self.device = device
+        self.meta = meta
+        self.address = address
+        self.authkey = authkey
+        self.amp_dtype = amp_dtype
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self._pending = None
+        self.num_batches = 0
+        self.num_images = 0
+
+    def serve_forever(self, log_freq=1000):
+        torch.multiprocessing.set_sharing_strategy("file_system")
+        if os.path.exists(self.address):
+            try:
+                Client(self.address, family="AF_UNIX").close()
+                raise RuntimeError(
+                    "Another teacher server is listening on {}".format(self.address))
+            except ConnectionRefusedError:
+                # stale socket file of a dead server
+                os.remove(self.address)
+        listener = Listener(self.address, family="AF_UNIX",
+                            authkey=self.authkey.encode())
+        threading.Thread(target=self._accept_loop,
+                         args=(listener,), daemon=True).start()
+        print(log_msg("Teacher server is listening on {}".format(self.address), "INFO"))
+        try:
+            while True:
+                self._infer(self._get_batch())
+                if self.num_batches % log_freq == 0:
+                    print(log_msg("Teacher server: {} batches, avg batch size {:.1f}".format(
+                        self.num_batches, self.num_images / self.num_batches), "INFO"))
+        finally:
+            listener.close()
+
+    def _accept_loop(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                # eg: failed authentication, or the probe of serve_forever()
+                continue
+            threading.Thread(target=self._recv_loop,
+                             args=(conn,), daemon=True).start()
+
+    def _recv_loop(self, conn):
+        buffer = None
+        try:
+            kind, meta = conn.recv()
+            if kind != "hello" or meta != self.meta:
+                conn.send(("error", "teacher server mismatch: {}, expected {}".format(
+                    meta, self.meta)))
+                return
+            conn.send(("ok",))
+            while True:
+                msg = conn.recv()
+                if msg[0] == "buffer":
+                    buffer = msg[1]
+                elif msg[0] == "infer":
+                    _, shape, feature_taps = msg
+                    numel = torch.Size(shape).numel()
+                    self.requests.put(
+                        (conn, buffer[:numel].view(shape), feature_taps))
+        except (EOFError, OSError):
+            # the client exits
+            pass
+        finally:
+            conn.close()
+
+    def _get_batch(self):
+        if self._pending is not None:
+            batch, self._pending = [self._pending], None
+        else:
+            batch = [self.requests.get()]
+        num_images = batch[0][1].shape[0]
+        deadline = time.perf_counter() + self.max_wait
+        while num_images < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if num_images + request[1].shape[0] > self.max_batch_size:
+                self._pending = request
+                break
+            batch.append(request)
+            num_images += request[1].shape[0]
+        return batch
+
+    def _infer(self, batch):
+        sizes = [image.shape[0] for _, image, _ in batch]
+        try:
+            # copy the images out of the shared buffers before replying
+            image = torch.cat([image for _, image, _ in batch]).to(self.device)
+            with torch.no_grad(), torch.autocast(
+                    device_type=self.device.type, dtype=self.amp_dtype,
+                    enabled=self.amp_dtype is not None):
+                logits, feats = self.teacher(image)
+            # only copy the taps requested by the clients
+            taps = merge_feature_taps(*[feature_taps for _, _, feature_taps in batch])
+            outputs = _to_device((logits, _select_taps(feats, taps)), "cpu")
+            outputs = _split(outputs, sizes)
+        except Exception as e:
+            outputs = None
+            error = "{}: {}".format(type(e).__name__, e)
+
+        for i, (conn, _, feature_taps) in enumerate(batch):
+            try:
+                if outputs is None:
+                    conn.send(("error", error))
+                else:
+                    logits, feats = outputs[i]
+                    conn.send(("ok", logits, _select_taps(feats, feature_taps)))
+            except OSError:
+                # the client exits
+                pass
+        self.num_batches += 1
+        self.num_images += sum(sizes)
+
+
+class _ProxyState(object):
+    """
+        The connection & the shared memory buffer of a TeacherProxy. It is not a
+        module attribute, so the DataParallel replicas share it by reference &
+        use one connection in turns.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.buffer = None
+        self.lock = threading.Lock()
+
+
+class TeacherProxy(nn.Module):
+    """
+        Client of TeacherServer with the same (logits, feats) interface as the
+        teacher. The images are sent through a shared memory buffer.
+    """
+
+    def __init__(self, address, authkey, meta, feature_taps=None, timeout=60.0):
+        super(TeacherProxy, self).__init__()
+        self.address = address
+        self.authkey = authkey
+        self.meta = meta
+        # the requested taps of the teacher features, None: all
+        self.feature_taps = feature_taps
+        self.timeout = timeout
+        self._state = _ProxyState()
+
+    def train(self, mode=True):
+        # the teacher is always in eval mode
+        return super().train(False)
+
+    def _connect(self):
+        torch.multiprocessing.set_sharing_strategy("file_system")
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                conn = Client(self.address, family="AF_UNIX",
+                              authkey=self.authkey.encode())
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # the server may be still loading the teacher
+                if time.time() > deadline:
+                    raise RuntimeError(
+                        "Can not connect to the teacher server at {}".format(self.address))
+                time.sleep(1)
+        conn.send(("hello", self.meta))
+        reply = conn.recv()
+        if reply[0] == "error":
+            raise RuntimeError(reply[1])
+        return conn
+
+    def forward(self, x):
+        x = x.detach()
+        numel = x.numel()
+        state = self._state
+        # the replicas of DataParallel run in threads & share the state
+        with state.lock:
+            if state.conn is None:
+                state.conn = self._connect()
+            if state.buffer is None or state.buffer.numel() < numel or state.buffer.dtype != x.dtype:
+                state.buffer = torch.empty(numel, dtype=x.dtype).share_memory_()
+                state.conn.send(("buffer", state.buffer))
+            state.buffer[:numel].view(x.shape).copy_(x)
+            state.conn.send(("infer", tuple(x.shape), self.feature_taps))
+            reply = state.conn.recv()
+        if reply[0] == "error":
+            raise RuntimeError("Teacher server: {}".format(reply[1]))
+        _, logits, feats = reply
+        return (_to_device(logits, x.device, non_blocking=True),
+                _to_device(feats, x.device, non_blocking=True))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_state"] = _ProxyState()
+        return state
+
+    @classmethod
+    def from_cfg(cls, cfg, feature_taps=None):
+        return cls(
+            cfg.TEACHER.SERVER.ADDRESS,
+            cfg.TEACHER.SERVER.AUTHKEY,
+            get_server_meta(cfg),
+            feature_taps=feature_taps,
+            timeout=cfg.TEACHER.SERVER.TIMEOUT,
+        )
@@ -1,3 +1,5 @@
+import functools
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -41,6 +43,35 @@ def get_feat_shapes(student, teacher, input_size):
     return feat_s_shapes, feat_t_shapes
 
 
+def autocast_fp32(func):
+    """
+        Run a loss function in fp32 even under fp16/bf16 autocast.
+        The partitioned KD losses mask logits with a large magnitude
+        (eg: `logits - 1000 * mask`) and take logs of summed probabilities,
+        which overflow or underflow in reduced precision.
+    """
+
+    def _to_fp32(x):
+        if isinstance(x, torch.Tensor) and x.is_floating_point():
+            return x.float()
+        return x
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        device_type = "cpu"
+        for x in list(args) + list(kwargs.values()):
+            if isinstance(x, torch.Tensor):
+                device_type = x.device.type
+                break
+
+        args = [_to_fp32(x) for x in args]
+        kwargs = {k: _to_fp32(v) for k, v in kwargs.items()}
+        with torch.autocast(device_type=device_type, enabled=False):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
 def kl_div(log_p, log_q, T, kl_type="forward", reduction="batchmean"):
     if kl_type == "forward":
         res = F.kl_div(log_p, log_q, reduction=reduction,
@@ -64,16 +95,269 @@ def kl_div(log_p, log_q, T, kl_type="forward", reduction="batchmean"):
     return res
 
 
-def validate(dataloader, model, num_classes):
+def _two_partition_log_softmax(x, mask):
+    """
+        The log_softmax of x [B, C] within the partitions mask / ~mask, with one
+        logsumexp per partition (each shifted by its own max).
+        Returns: log_p [B, C], log_mass [B, 2]: the log of the partition masses.
+    """
+    neg_inf = float("-inf")
+    m1 = torch.where(mask, x, neg_inf).amax(1, keepdim=True)
+    m2 = torch.where(mask, neg_inf, x).amax(1, keepdim=True)
+    log_p = x - torch.where(mask, m1, m2)
+    e = log_p.exp()
+    # the max of each partition is 1 after its shift: no cancellation in sum2
+    sum1 = torch.where(mask, e, 0.0).sum(1, keepdim=True)
+    sum2 = e.sum(1, keepdim=True) - sum1
+    log_sum1, log_sum2 = sum1.log(), sum2.log()
+    log_p.sub_(torch.where(mask, log_sum1, log_sum2))
+    lse = torch.cat([m1 + log_sum1, m2 + log_sum2], dim=1)
+    return log_p, lse - torch.logsumexp(lse, dim=1, keepdim=True)
+
+
+def _partition_sum(x, mask):
+    # [B, C] -> [B, 2]: the sums over mask / ~mask
+    x1 = torch.where(mask, x, 0.0).sum(1, keepdim=True)
+    x2 = torch.where(mask, 0.0, x).sum(1, keepdim=True)
+    return torch.cat([x1, x2], dim=1)
+
+
+def _xlogy_kl(log_q, log_p):
+    # KL(q||p) terms of the partition masses [B, 2], 0 for the empty partitions
+    return torch.where(log_q > float("-inf"), log_q.exp() * (log_q - log_p), 0.0)
+
+
+class DecoupledKDLoss(torch.autograd.Function):
+    """
+        Fused decoupled KD loss of two partitions (mask / ~mask) of the classes:
+            w0 * KL(Q||P) + w1 * KL_1 + w2 * KL_2
+        where P, Q are the student/teacher partition masses and KL_g the KL
+        (kl_type) of the student/teacher distributions within partition g, at
+        `temperature`, averaged over the batch and scaled by temperature**2.
+        The same losses as partition_kl with the two partitions (and as the masked
+        log_softmax passes `logits - 1000 * mask`), but from one logsumexp per
+        partition and with a hand-written backward, which only keeps the two
+        [B, C] log_softmax.
+        The teacher logits are constants (no gradient).
+        Returns: (loss, high_loss, low_loss_1, low_loss_2), the last three are
+            not differentiable.
+    """
+
+    @staticmethod
+    def forward(ctx, logits_student, logits_teacher, mask, w0, w1, w2, temperature, kl_type):
+        if kl_type not in ["forward", "reverse", "both"]:
+            raise ValueError(f"Unknown kl_type: {kl_type}")
+        batch_size = logits_student.shape[0]
+        log_p, log_mass_p = _two_partition_log_softmax(logits_student / temperature, mask)
+        log_q, log_mass_q = _two_partition_log_softmax(logits_teacher / temperature, mask)
+
+        scale = temperature**2 / batch_size
+        high_loss = _xlogy_kl(log_mass_q, log_mass_p).sum() * scale
+
+        diff = log_q - log_p
+        low_losses = 0.0
+        low_reverse = None
+        if kl_type in ["forward", "both"]:
+            low_losses = _partition_sum(log_q.exp() * diff, mask)
+        if kl_type in ["reverse", "both"]:
+            # KL(p||q) of each partition [B, 2], also used by the backward
+            low_reverse = _partition_sum(log_p.exp() * diff, mask).neg_()
+            low_losses = low_losses + low_reverse
+        if kl_type == "both":
+            low_losses = 0.5 * low_losses
+        low_loss_1, low_loss_2 = (low_losses.sum(0) * scale).unbind()
+        loss = w0 * high_loss + w1 * low_loss_1 + w2 * low_loss_2
+
+        ctx.save_for_backward(log_p, log_q, mask, log_mass_p, log_mass_q, low_reverse)
+        ctx.params = (w0, w1, w2, temperature, kl_type)
+        ctx.mark_non_differentiable(high_loss, low_loss_1, low_loss_2)
+        return loss, high_loss, low_loss_1, low_loss_2
+
+    @staticmethod
+    def backward(ctx, grad_loss, *unused_grads):
+        log_p, log_q, mask, log_mass_p, log_mass_q, low_reverse = ctx.saved_tensors
+        w0, w1, w2, temperature, kl_type = ctx.params
+        p = log_p.exp()
+
+        def per_partition(x):
+            # [B, 2] -> [B, C], the value of the partition of each class
+            return torch.where(mask, x[:, :1], x[:, 1:])
+
+        # d KL(Q||P) / d s_i = p_i * (P_g - Q_g), with p_i within the partition g
+        grad = p * per_partition(w0 * (log_mass_p.exp() - log_mass_q.exp()))
+        w = torch.where(mask, p.new_tensor(w1), p.new_tensor(w2))
+        if kl_type in ["forward", "both"]:
+            # d KL(q||p) / d s_i = p_i - q_i
+            grad_low = p - log_q.exp()
+            if kl_type == "both":
+                grad_low.mul_(0.5)
+            grad.add_(w * grad_low)
+        if kl_type in ["reverse", "both"]:
+            # d KL(p||q) / d s_i = p_i * (log p_i - log q_i - KL(p||q))
+            grad_low = p * (log_p - log_q - per_partition(low_reverse))
+            if kl_type == "both":
+                grad_low.mul_(0.5)
+            grad.add_(w * grad_low)
+        # s = logits / T: the scale is T**2 / B / T
+        grad.mul_(grad_loss * temperature / log_p.shape[0])
+        return grad, None, None, None, None, None, None, None
+
+
+def _as_partition_ids(partition, num_groups):
+    # a bool mask is the two partitions (mask, ~mask), ie: the ids 0 & 1
+    if partition.dtype == torch.bool:
+        return partition.logical_not().long(), 2
+    if num_groups is None:
+        raise ValueError("num_groups is required for the partition ids")
+    return partition, num_groups
+
+
+def partition_log_softmax(x, partition, num_groups):
+    """
+        The log_softmax of x [B, C] within each partition, by segment reductions:
+        O(B*C) for any number of partitions.
+        partition: [B, C] int64 partition ids in [0, num_groups)
+        Returns: log_p [B, C], log_mass [B, num_groups]: the log of the partition
+            masses, -inf for the empty partitions.
+    """
+    batch_size = x.shape[0]
+    # the max of each partition, the shift has no gradient
+    m = x.new_full((batch_size, num_groups), float("-inf")).scatter_reduce_(
+        1, partition, x.detach(), "amax")
+    shifted = x - m.gather(1, partition)
+    log_sum = x.new_zeros(batch_size, num_groups).scatter_add_(
+        1, partition, shifted.exp()).log()
+    log_p = shifted - log_sum.gather(1, partition)
+    lse = m + log_sum
+    return log_p, lse - torch.logsumexp(lse, dim=1, keepdim=True)
+
+
+@autocast_fp32
+def partition_kl(logits_student, logits_teacher, partition, temperature, kl_type="forward", num_groups=None):
+    """
+        The decoupled KD losses of a partition of the classes, at `temperature`:
+        the top-level KL(Q||P) of the student/teacher partition masses P & Q, and
+        the KL (kl_type) of the student/teacher distributions within each partition.
+        partition: [B, C] int64 partition ids in [0, num_groups), or a bool mask
+            for the two partitions (mask, ~mask).
+        Returns: (high [B], low [B, G], log_mass_teacher [B, G]), high & low are
+            scaled by temperature**2, the empty partitions have 0 losses.
+    """
+    partition, num_groups = _as_partition_ids(partition, num_groups)
+    log_p, log_mass_p = partition_log_softmax(logits_student / temperature, partition, num_groups)
+    log_q, log_mass_q = partition_log_softmax(logits_teacher / temperature, partition, num_groups)
+    high, low = partition_kl_from_log_probs(
+        log_p, log_mass_p, log_q, log_mass_q, partition, num_groups, kl_type)
+    scale = temperature**2
+    return high * scale, low * scale, log_mass_q
+
+
+def partition_kl_from_log_probs(log_p, log_mass_p, log_q, log_mass_q, partition, num_groups, kl_type="forward"):
+    """
+        The unscaled losses of partition_kl from the student/teacher log probs
+        within the partitions [B, C] & the log partition masses [B, G]
+        (see partition_log_softmax).
+        Returns: (high [B], low [B, G])
+    """
+    # the empty partitions are skipped, also in the backward
+    valid = log_mass_q > float("-inf")
+    log_mass_q_safe = torch.where(valid, log_mass_q, 0.0)
+    log_mass_p_safe = torch.where(valid, log_mass_p, 0.0)
+    high = torch.where(
+        valid, log_mass_q_safe.exp() * (log_mass_q_safe - log_mass_p_safe), 0.0).sum(1)
+
+    def segment_sum(x):
+        return x.new_zeros(x.shape[0], num_groups).scatter_add_(1, partition, x)
+
+    diff = log_q - log_p
+    if kl_type == "forward":
+        low = segment_sum(log_q.exp() * diff)
+    elif kl_type == "reverse":
+        low = -segment_sum(log_p.exp() * diff)
+    elif kl_type == "both":
+        low = 0.5 * segment_sum((log_q.exp() - log_p.exp()) * diff)
+    else:
+        raise ValueError(f"Unknown kl_type: {kl_type}")
+    return high, low
+
+
+@autocast_fp32
+def partition_kd_loss(logits_student, logits_teacher, partition, w0, weights, temperature, kl_type="forward"):
+    """
+        w0 * KL(Q||P) + sum_g weights[g] * KL_g, averaged over the batch (see partition_kl),
+        eg: GDKD with the topk mask of the teacher, DKD with the gt mask.
+        partition: [B, C] int64 partition ids in [0, len(weights)), or a bool mask
+            for the two partitions (mask, ~mask), which runs the fused DecoupledKDLoss.
+        Returns: (loss, high_loss, low_losses [G]), the last two are detached.
+    """
+    logits_teacher = logits_teacher.detach()
+    if partition.dtype == torch.bool:
+        if len(weights) != 2:
+            raise ValueError(f"A bool partition mask has 2 weights, got {weights}")
+        loss, high_loss, low_loss_1, low_loss_2 = DecoupledKDLoss.apply(
+            logits_student, logits_teacher, partition, w0, *weights, temperature, kl_type)
+        return loss, high_loss, torch.stack([low_loss_1, low_loss_2])
+    high, low, _ = partition_kl(
+        logits_student, logits_teacher, partition, temperature, kl_type, num_groups=len(weights))
+    high_loss, low_losses = high.mean(), low.mean(0)
+    loss = w0 * high_loss + (low_losses * low_losses.new_tensor(weights)).sum()
+    return loss, high_loss.detach(), low_losses.detach()
+
+
+def get_topk_mask(logits, topks, max_k=None):
+    """
+        The bool mask of the topks[i] largest logits of each row, with a variable
+        k per row and no host synchronization: the rank of each class is compared
+        to its row k after one sort.
+        topks: [B] int64, 1 <= topks[i] <= num_classes
+        max_k: an upper bound of topks, which only sorts the max_k largest logits.
+    """
+    num_classes = logits.shape[1]
+    if max_k is None or max_k >= num_classes:
+        order = logits.argsort(dim=1, descending=True)
+    else:
+        order = torch.topk(logits, max_k, dim=1, largest=True, sorted=True).indices
+    rank = torch.arange(order.shape[1], device=logits.device)
+    keep = rank < topks.to(logits.device).unsqueeze(1)
+    # the indices of a row are distinct
+    return torch.zeros_like(logits, dtype=torch.bool).scatter_(1, order, keep)
+
+
+def calc_topk(probs, topk_th, ratio_th):
+    """
+        The k of each row of probs [B, C] by the ratio threshold: with the probs
+        sorted in ascending order, the first position where prob / (the mean of
+        the probs up to it) >= ratio_th starts the topk, ie: k = C - position;
+        k = 1 when there is no such position; k is clipped to topk_th.
+        Returns: topks [B] int64
+    """
+    num_classes = probs.shape[1]
+    x = torch.arange(1, num_classes+1, device=probs.device)
+
+    probs = probs.sort(dim=1, descending=False).values
+
+    cumavg = probs.cumsum(dim=1)/x
+    ratio = probs/cumavg
+
+    hit = ratio >= ratio_th
+    # argmax returns the first max
+    first = hit.byte().argmax(dim=1)
+    topks = torch.where(hit.any(dim=1), num_classes - first, 1)
+    return topks.clamp(max=topk_th)
+
+
+def validate(dataloader, model, num_classes, device="cuda"):
     logits_dict = [[] for _ in range(num_classes)]
 
-    model = model.cuda()
+    device = torch.device(device)
+    non_blocking = device.type == "cuda"
+    model = model.to(device)
     model.eval()
     with torch.no_grad():
         for i, (image, target, index) in tqdm(enumerate(dataloader), total=len(dataloader)):
             image = image.float()
-            image = image.cuda(non_blocking=True)
-            target = target.cuda(non_blocking=True)
+            image = image.to(device, non_blocking=non_blocking)
+            target = target.to(device, non_blocking=non_blocking)
             logits, _ = model(image)
 
             for j in range(num_classes):
@@ -1,2 +1,3 @@
 from .trainer import Trainer
+from .multi_trainer import MultiStudentTrainer
 from .validate import validate  
\ No newline at end of file
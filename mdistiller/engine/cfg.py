@@ -8,6 +8,10 @@ def dump_cfg(cfg):
     dumped_cfg.DISTILLER = cfg.DISTILLER
     dumped_cfg.SOLVER = cfg.SOLVER
     dumped_cfg.LOG = cfg.LOG
+    dumped_cfg.DEVICE = cfg.DEVICE
+    dumped_cfg.TEACHER_CACHE = cfg.TEACHER_CACHE
+    dumped_cfg.REGION_LABELS = cfg.REGION_LABELS
+    dumped_cfg.TEACHER = cfg.TEACHER
     if cfg.DISTILLER.TYPE in cfg:
         dumped_cfg.update({cfg.DISTILLER.TYPE: cfg.get(cfg.DISTILLER.TYPE)})
     return dumped_cfg
@@ -16,6 +20,15 @@ def show_cfg(cfg):
     dumped_cfg = dump_cfg(cfg)
     print(log_msg("CONFIG:\n{}".format(dumped_cfg.dump()), "INFO"))
 
+def get_teacher_tag(cfg):
+    # identify the teacher outputs, eg: for the teacher cache & server
+    if len(cfg.DISTILLER.TEACHERS) == 0:
+        return cfg.DISTILLER.TEACHER
+    ensemble = cfg.DISTILLER.ENSEMBLE
+    return "ensemble({}|logit:{},feat:{},T:{},weights:{})".format(
+        ",".join(cfg.DISTILLER.TEACHERS), ensemble.LOGIT_AGG, ensemble.FEAT_AGG,
+        ensemble.TEMPERATURE, list(ensemble.WEIGHTS))
+
 
 CFG = CN()
 
@@ -32,6 +45,90 @@ CFG.DATASET.NUM_WORKERS = 2
 CFG.DATASET.TEST = CN()
 CFG.DATASET.TEST.BATCH_SIZE = 64
 CFG.DATASET.ENHANCE_AUGMENT = False
+CFG.DATASET.PIN_MEMORY = True
+CFG.DATASET.PERSISTENT_WORKERS = True
+CFG.DATASET.PREFETCH_FACTOR = 2
+# copy the next batch to the device while the current batch is computed
+CFG.DATASET.DEVICE_PREFETCH = True
+# load uint8 images and normalize them on the device (cifar100 only)
+CFG.DATASET.DEVICE_NORMALIZE = False
+
+# Offline teacher logits, see tools/teacher_cache.py
+CFG.TEACHER_CACHE = CN()
+CFG.TEACHER_CACHE.ENABLE = False
+CFG.TEACHER_CACHE.PATH = ""
+# the augmentations of each sample are seeded by (SEED, view, index)
+CFG.TEACHER_CACHE.SEED = 0
+# epoch e replays the augmentation view (e-1) % NUM_VIEWS, used when building the cache
+CFG.TEACHER_CACHE.NUM_VIEWS = 1
+# "dense": fp16 logits; "topk": TOPK logits + int16 indices + fp16 tail mass, for large class counts
+CFG.TEACHER_CACHE.FORMAT = "dense"
+CFG.TEACHER_CACHE.TOPK = 20
+# the tail mass is exact at this temperature, use the T of the distiller
+CFG.TEACHER_CACHE.TEMPERATURE = 4.0
+# False: the train set uses the test transforms, ie: no augmentations
+CFG.TEACHER_CACHE.AUGMENT = True
+# the teacher features used by the feature distillers (see Distiller.get_teacher_feature_keys),
+# quantized per channel to "int8" or "fp16", in memmap files of CHUNK_SIZE samples
+CFG.TEACHER_CACHE.FEATURE_DTYPE = "int8"
+CFG.TEACHER_CACHE.CHUNK_SIZE = 8192
+
+# Offline spatial teacher logit maps for the RandomResizedCrop datasets (imagenet & TL),
+# see tools/region_labels.py: the teacher logits of a crop are the map pooled over its box
+CFG.REGION_LABELS = CN()
+CFG.REGION_LABELS.ENABLE = False
+CFG.REGION_LABELS.PATH = ""
+# the map has GRID x GRID cells, from the full image resized to RESOLUTION x RESOLUTION;
+# the last teacher feature map size (eg: RESOLUTION / 32) should be a multiple of GRID
+CFG.REGION_LABELS.GRID = 7
+CFG.REGION_LABELS.RESOLUTION = 224
+# "dense": fp16 logits; "topk": TOPK logits + int16 indices + one fp16 fill logit per cell
+CFG.REGION_LABELS.FORMAT = "topk"
+CFG.REGION_LABELS.TOPK = 10
+
+# Inference-optimized frozen teacher, see mdistiller/distillers/teacher.py
+CFG.TEACHER = CN()
+CFG.TEACHER.OPTIMIZE = False
+CFG.TEACHER.FOLD_BN = True
+CFG.TEACHER.INFERENCE_MODE = True
+CFG.TEACHER.FREEZE = "none" # "none", "script" (TorchScript trace & freeze), "compile" (torch.compile)
+CFG.TEACHER.CHANNELS_LAST = False
+# compare the outputs with the eager teacher at the first forward
+CFG.TEACHER.CHECK_PARITY = True
+# a local teacher server (tools/teacher_server.py) shared by several training processes
+CFG.TEACHER.SERVER = CN()
+CFG.TEACHER.SERVER.ENABLE = False
+CFG.TEACHER.SERVER.ADDRESS = "/tmp/mdistiller_teacher.sock"
+CFG.TEACHER.SERVER.AUTHKEY = "mdistiller"
+CFG.TEACHER.SERVER.TIMEOUT = 300.0 # seconds to wait for the server at the first forward
+CFG.TEACHER.SERVER.MAX_BATCH_SIZE = 1024
+CFG.TEACHER.SERVER.MAX_WAIT_MS = 5.0
+# post-training static int8 quantization of the teacher, for the CPU distillation,
+# see mdistiller/distillers/teacher_quant.py & tools/teacher_quant_report.py
+CFG.TEACHER.QUANT = CN()
+CFG.TEACHER.QUANT.ENABLE = False
+CFG.TEACHER.QUANT.BACKEND = "fbgemm" # "fbgemm", "x86", "onednn", "qnnpack"
+# calibrate on the first batches of the train loader
+CFG.TEACHER.QUANT.CALIB_BATCHES = 200
+# compute the teacher outputs of the next batch during the student step of the current one,
+# see mdistiller/engine/pipeline.py
+CFG.TEACHER.PIPELINE = CN()
+CFG.TEACHER.PIPELINE.MODE = "none" # "none", "stream" (side cuda stream), "device" (another device), "thread" (eg: cpu)
+CFG.TEACHER.PIPELINE.DEVICE = "cuda:1" # the teacher device of "device"
+CFG.TEACHER.PIPELINE.NUM_THREADS = 0 # intra-op threads of the teacher worker thread, 0: unchanged
+# reuse the cached teacher logits of each sample (by dataset index) for the logit distillers,
+# and only re-query the teacher for a fraction of each batch, see mdistiller/engine/teacher_query.py
+CFG.TEACHER.QUERY = CN()
+CFG.TEACHER.QUERY.ENABLE = False
+# re-queried fraction of each batch, besides the missing & stale entries
+CFG.TEACHER.QUERY.FRACTION = 0.25
+# the entries of MAX_STALENESS epochs ago are always re-queried
+CFG.TEACHER.QUERY.MAX_STALENESS = 4
+CFG.TEACHER.QUERY.POLICY = "disagreement" # "disagreement", "oldest", "random"
+# the temperature of the teacher_drift statistic
+CFG.TEACHER.QUERY.TEMPERATURE = 4.0
+# the device of the cache, eg: "cpu" for large datasets; "": the training device
+CFG.TEACHER.QUERY.STORAGE_DEVICE = ""
 
 # Distiller
 CFG.DISTILLER = CN()
@@ -39,6 +136,18 @@ CFG.DISTILLER.TYPE = "NONE"  # Vanilla as default
 CFG.DISTILLER.TEACHER = "ResNet50"
 CFG.DISTILLER.STUDENT = "resnet32"
 CFG.DISTILLER.AUG_TEACHER = True
+# an ensemble of teachers instead of DISTILLER.TEACHER, see mdistiller/distillers/ensemble.py,
+# eg: ["resnet32x4", "resnet32x4:noaug", "wrn_40_2"] (":aug"/":noaug" overrides AUG_TEACHER)
+CFG.DISTILLER.TEACHERS = []
+CFG.DISTILLER.ENSEMBLE = CN()
+CFG.DISTILLER.ENSEMBLE.LOGIT_AGG = "mean" # "mean" (logits), "prob" (probabilities at TEMPERATURE)
+CFG.DISTILLER.ENSEMBLE.FEAT_AGG = "mean" # "mean" (same feature shapes), "first" (the first teacher)
+CFG.DISTILLER.ENSEMBLE.TEMPERATURE = 4.0
+CFG.DISTILLER.ENSEMBLE.WEIGHTS = [] # uniform by default
+# run the teachers of the same architecture as one vmapped forward
+CFG.DISTILLER.ENSEMBLE.STACK = True
+# run the groups of different architectures on concurrent cuda streams
+CFG.DISTILLER.ENSEMBLE.CONCURRENT = True
 
 # Solver
 CFG.SOLVER = CN()
@@ -53,16 +162,43 @@ CFG.SOLVER.WEIGHT_DECAY = 0.0001
 CFG.SOLVER.MOMENTUM = 0.9
 CFG.SOLVER.TYPE = "SGD"
 CFG.SOLVER.SGD_NESTEROV = False
+CFG.SOLVER.ACCUM_STEPS = 1 # split each batch into micro-batches and accumulate the gradients
+CFG.SOLVER.AMP = CN()
+CFG.SOLVER.AMP.ENABLE = False
+CFG.SOLVER.AMP.DTYPE = "auto" # "auto": float16 on cuda, bfloat16 on cpu; or "float16", "bfloat16"
 
 # Log
 CFG.LOG = CN()
 CFG.LOG.TENSORBOARD_FREQ = 500
 CFG.LOG.SAVE_CHECKPOINT_FREQ = 40
+# profile the phases of the training steps in [WAIT+WARMUP, WAIT+WARMUP+ACTIVE)
+CFG.LOG.PROFILE = CN()
+CFG.LOG.PROFILE.ENABLE = False
+CFG.LOG.PROFILE.WAIT = 10
+CFG.LOG.PROFILE.WARMUP = 5
+CFG.LOG.PROFILE.ACTIVE = 10
+CFG.LOG.PROFILE.RECORD_SHAPES = False
+CFG.LOG.EVAL_FREQ = 1 # unit: #epoch
+CFG.LOG.EVAL_DENSE_LAST = 0 # evaluate every epoch in the last K epochs
+CFG.LOG.ASYNC_EVAL = False # evaluate a snapshot of the student in a background thread (not for DDP)
+CFG.LOG.SAVE_ITER_FREQ = 0 # unit: #batch, save a resumable latest.pth in the middle of epochs, 0 means disabled
+CFG.LOG.KEEP_CHECKPOINTS = 0 # number of periodic checkpoints to keep, <=0 means all
+CFG.LOG.ASYNC_CHECKPOINT = True # write the checkpoints on a background thread
 CFG.LOG.PREFIX = "./output"
 CFG.LOG.WANDB = True
 CFG.LOG.WANDB_MODEL_LOG = False
 CFG.LOG.WANDB_MODEL_LOG_FREQ = 100 # unit: #batch
 CFG.LOG.ENABLE_PROGRESS_BAR = True
+CFG.LOG.METRIC_SYNC_FREQ = 20 # unit: #batch, fetch the device metrics for the progress bar
+
+# Device
+CFG.DEVICE = CN()
+CFG.DEVICE.TYPE = "auto" # support "auto", "cuda", "cpu"
+CFG.DEVICE.MEMORY_FORMAT = "auto" # "auto": channels_last on cpu, contiguous on cuda
+CFG.DEVICE.CPU = CN()
+CFG.DEVICE.CPU.NUM_THREADS = 0 # 0: all cores except those for dataloader workers
+CFG.DEVICE.CPU.NUM_INTEROP_THREADS = 0 # 0: torch default
+CFG.DEVICE.CPU.PIN_THREADS = True # pin compute threads and dataloader workers to disjoint cores
 
 # Distillation Methods
 
@@ -182,6 +318,7 @@ CFG.DKDMOD.ALPHA = 1.0
 CFG.DKDMOD.BETA = 8.0
 CFG.DKDMOD.T = 4.0
 CFG.DKDMOD.WARMUP = 20
+# unused: the partitions are exact (see partition_kl), kept for the old configs
 CFG.DKDMOD.MASK_MAGNITUDE = 1000.0
 CFG.DKDMOD.KL_TYPE = "forward"
 CFG.DKDMOD.STRATEGY = "target" # or "top1"
@@ -0,0 +1,182 @@
+import os
+import re
+import atexit
+import queue
+import shutil
+import threading
+from collections import OrderedDict
+
+import torch
+
+from .utils import save_checkpoint
+
+
+def snapshot_to_host(obj, memo=None):
+    """
+        Copy all tensors in obj to host memory, so that training can
+        continue while the snapshot is serialized.
+        Tensors that share the same memory (eg: the student weights in
+        both the distiller and the student state) are copied only once.
+    """
+    if memo is None:
+        memo = {}
+
+    if isinstance(obj, torch.Tensor):
+        key = (obj.device, obj.data_ptr(), obj.dtype,
+               tuple(obj.shape), obj.stride())
+        if key not in memo:
+            if obj.device.type == "cpu":
+                # state_dict() returns views of the live parameters on cpu
+                memo[key] = obj.detach().clone()
+            else:
+                memo[key] = obj.detach().to("cpu")
+        return memo[key]
+    elif isinstance(obj, OrderedDict):
+        return OrderedDict((k, snapshot_to_host(v, memo)) for k, v in obj.items())
+    elif isinstance(obj, dict):
+        return {k: snapshot_to_host(v, memo) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [snapshot_to_host(v, memo) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(snapshot_to_host(v, memo) for v in obj)
+    else:
+        return obj
+
+
+def _atomic_save(obj, path):
+    tmp_path = path + ".tmp"
+    save_checkpoint(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _atomic_link(src, dst):
+    tmp_path = dst + ".tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        # hardlinks are not supported on some filesystems
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class CheckpointWriter():
+    """
+        Write checkpoints on a background thread.
+
+        Each payload is written once to a temp file and atomically renamed,
+        the other names of the same payload (eg: latest.pth & best.pth) are
+        hardlinks of it. Files are never modified in place, so replacing
+        latest.pth does not affect its hardlinks.
+
+        keep_checkpoints: number of periodic `epoch_N.pth` & `student_N.pth`
+            to keep, <=0 means keep all.
+    """
+
+    _periodic_patterns = [
+        re.compile(r"^epoch_(\d+)\.pth$"),
+        re.compile(r"^student_(\d+)\.pth$"),
+    ]
+
+    def __init__(self, log_path, keep_checkpoints=0, async_write=True):
+        self.log_path = log_path
+        self.keep_checkpoints = keep_checkpoints
+        self.async_write = async_write
+
+        self._error = None
+        self._closed = False
+        if async_write:
+            # at most one pending snapshot besides the one being written
+            self._queue = queue.Queue(maxsize=1)
+            self._thread = threading.Thread(
+                target=self._worker, name="CheckpointWriter", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def save(self, checkpoints):
+        """
+            checkpoints: list of (obj, [filenames]), the obj is written
+                to the first filename and linked to the others.
+        """
+        memo = {}
+        jobs = [
+            (snapshot_to_host(obj, memo), list(names))
+            for obj, names in checkpoints if len(names) > 0
+        ]
+        self._submit(self._write, jobs)
+
+    def link(self, src_name, dst_names):
+        """
+            Link an existing checkpoint to other names, after all pending writes.
+        """
+        self._submit(self._link, src_name, list(dst_names))
+
+    def _submit(self, fn, *args):
+        self._raise_error()
+        if self.async_write:
+            self._queue.put((fn, args))
+        else:
+            fn(*args)
+
+    def _write(self, jobs):
+        for obj, names in jobs:
+            paths = [os.path.join(self.log_path, name) for name in names]
+            _atomic_save(obj, paths[0])
+            for path in paths[1:]:
+                _atomic_link(paths[0], path)
+        self._apply_retention()
+
+    def _link(self, src_name, dst_names):
+        src = os.path.join(self.log_path, src_name)
+        for name in dst_names:
+            _atomic_link(src, os.path.join(self.log_path, name))
+
+    def _apply_retention(self):
+        if self.keep_checkpoints <= 0:
+            return
+
+        for pattern in self._periodic_patterns:
+            ckpts = []
+            for name in os.listdir(self.log_path):
+                match = pattern.match(name)
+                if match:
+                    ckpts.append((int(match.group(1)), name))
+            ckpts.sort()
+            for _, name in ckpts[:-self.keep_checkpoints]:
+                os.remove(os.path.join(self.log_path, name))
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    fn, args = job
+                    fn(*args)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise RuntimeError("Failed to write checkpoint") from error
+
+    def wait(self):
+        """block until all pending checkpoints are written"""
+        if self.async_write:
+            self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.async_write:
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
@@ -0,0 +1,202 @@
+import os
+
+import torch
+import torch.nn as nn
+
+from .utils import log_msg, local_print
+
+
+def get_device(cfg):
+    device_type = cfg.DEVICE.TYPE
+    if device_type == "auto":
+        device_type = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if device_type == "cuda":
+        if not torch.cuda.is_available():
+            raise RuntimeError("DEVICE.TYPE is cuda, but cuda is not available")
+        return torch.device("cuda", torch.cuda.current_device())
+    elif device_type == "cpu":
+        return torch.device("cpu")
+    else:
+        raise ValueError(f"Unknown device type: {cfg.DEVICE.TYPE}")
+
+
+def get_memory_format(cfg, device):
+    memory_format = cfg.DEVICE.MEMORY_FORMAT
+    if memory_format == "auto":
+        # oneDNN convolutions prefer NHWC on cpu
+        memory_format = "channels_last" if device.type == "cpu" else "contiguous"
+
+    if memory_format == "channels_last":
+        return torch.channels_last
+    elif memory_format == "contiguous":
+        return torch.contiguous_format
+    else:
+        raise ValueError(f"Unknown memory format: {cfg.DEVICE.MEMORY_FORMAT}")
+
+
+def get_amp_dtype(cfg, device):
+    """
+        Returns: the autocast dtype, or None if AMP is disabled.
+    """
+    if not cfg.SOLVER.AMP.ENABLE:
+        return None
+
+    dtype = cfg.SOLVER.AMP.DTYPE
+    if dtype == "auto":
+        dtype = "float16" if device.type == "cuda" else "bfloat16"
+
+    if dtype == "float16":
+        if device.type != "cuda":
+            raise ValueError("float16 autocast is only supported on cuda")
+        return torch.float16
+    elif dtype == "bfloat16":
+        return torch.bfloat16
+    else:
+        raise ValueError(f"Unknown AMP dtype: {cfg.SOLVER.AMP.DTYPE}")
+
+
+def autocast(device, amp_dtype):
+    return torch.autocast(
+        device_type=device.type,
+        dtype=amp_dtype,
+        enabled=amp_dtype is not None
+    )
+
+
+_available_cores = None
+
+
+def _get_available_cores():
+    # cache the affinity before setup_device() pins the main process
+    global _available_cores
+    if _available_cores is None:
+        if hasattr(os, "sched_getaffinity"):
+            _available_cores = sorted(os.sched_getaffinity(0))
+        else:
+            _available_cores = list(range(os.cpu_count() or 1))
+    return _available_cores
+
+
+def plan_cpu_threads(cfg):
+    """
+        Split the available cores into compute cores (intra-op threads)
+        and dataloader worker cores.
+        Returns: (compute_cores, worker_cores)
+    """
+    cores = _get_available_cores()
+    num_workers = cfg.DATASET.NUM_WORKERS
+
+    # split the cores among the processes launched by torchrun on this node
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    if local_world_size > 1 and len(cores) >= local_world_size:
+        num_local_cores = len(cores) // local_world_size
+        cores = cores[local_rank * num_local_cores:
+                      (local_rank + 1) * num_local_cores]
+
+    num_threads = cfg.DEVICE.CPU.NUM_THREADS
+    if num_threads <= 0:
+        # leave one core per dataloader worker
+        num_threads = max(len(cores) - num_workers, 1)
+    num_threads = min(num_threads, len(cores))
+
+    compute_cores = cores[:num_threads]
+    worker_cores = cores[num_threads:]
+    if len(worker_cores) == 0:
+        # not enough cores: workers share the cores with compute threads
+        worker_cores = cores
+
+    return compute_cores, worker_cores
+
+
+def setup_device(cfg):
+    """
+        Init the execution backend. Must be called before any parallel work.
+    """
+    device = get_device(cfg)
+
+    if device.type == "cpu":
+        compute_cores, worker_cores = plan_cpu_threads(cfg)
+        torch.set_num_threads(len(compute_cores))
+
+        num_interop_threads = cfg.DEVICE.CPU.NUM_INTEROP_THREADS
+        if num_interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:
+                # interop threads can only be set once before parallel work starts
+                local_print(log_msg(
+                    "Failed to set num_interop_threads, use default", "INFO"))
+
+        if cfg.DEVICE.CPU.PIN_THREADS and hasattr(os, "sched_setaffinity"):
+            # dataloader workers re-pin themselves in worker_init_fn
+            os.sched_setaffinity(0, compute_cores)
+
+        local_print(log_msg(
+            "CPU backend: {} compute threads on cores {}, dataloader workers on cores {}".format(
+                len(compute_cores), compute_cores, worker_cores),
+            "INFO"))
+
+    return device
+
+
+def get_worker_init_fn(cfg):
+    device = get_device(cfg)
+    if device.type != "cpu" or not cfg.DEVICE.CPU.PIN_THREADS:
+        return None
+    if not hasattr(os, "sched_setaffinity"):
+        return None
+
+    _, worker_cores = plan_cpu_threads(cfg)
+    return _WorkerInitFn(worker_cores)
+
+
+class _WorkerInitFn():
+    """pin each dataloader worker to cores away from the compute threads"""
+
+    def __init__(self, cores):
+        self.cores = cores
+
+    def __call__(self, worker_id):
+        core = self.cores[worker_id % len(self.cores)]
+        os.sched_setaffinity(0, [core])
+        # avoid oversubscription by intra-op threads in workers
+        torch.set_num_threads(1)
+
+
+def configure_dataloader(loader, cfg):
+    device = get_device(cfg)
+    worker_init_fn = get_worker_init_fn(cfg)
+    if worker_init_fn is not None and loader.num_workers > 0:
+        loader.worker_init_fn = worker_init_fn
+    if device.type != "cuda":
+        # pinned memory is only useful for host->cuda copies
+        loader.pin_memory = False
+    return loader
+
+
+class ModuleWrapper(nn.Module):
+    """
+        Keep the `.module` interface of DataParallel/DDP for single device runs.
+    """
+
+    def __init__(self, module):
+        super(ModuleWrapper, self).__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        return self.module(*args, **kwargs)
+
+
+def wrap_distiller(distiller, cfg, device):
+    memory_format = get_memory_format(cfg, device)
+    distiller = distiller.to(device, memory_format=memory_format)
+
+    if device.type == "cuda":
+        # backward compatibility for `.module`:
+        # We recommend to use one GPU since DP is deprecated:
+        # https://github.com/pytorch/pytorch/issues/65936
+        return nn.DataParallel(distiller)
+    else:
+        return ModuleWrapper(distiller)
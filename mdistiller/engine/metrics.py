@@ -0,0 +1,152 @@
+from collections import OrderedDict, defaultdict
+
+import torch
+import torch.distributed as dist
+
+from .utils import AverageMeter, is_distributed
+
+
+class _MeterView():
+    def __init__(self, group, name):
+        self.group = group
+        self.name = name
+
+    @property
+    def avg(self):
+        return self.group.avg(self.name)
+
+    @property
+    def sum(self):
+        return self.group.sum(self.name)
+
+    @property
+    def count(self):
+        return self.group.count(self.name)
+
+
+class DeviceMeterGroup():
+    """
+        Named running averages whose sums are kept in one preallocated
+        device buffer. `update()` never synchronizes with the host;
+        values are only fetched (with a single all_reduce of the packed
+        buffer under DDP) when an average is read after new updates.
+
+        Non-tensor values (eg: python floats from timers) are tracked
+        locally by plain AverageMeter.
+    """
+
+    def __init__(self, device, capacity=16):
+        self.device = torch.device(device)
+        self._slots = OrderedDict()
+        # row 0: sum, row 1: count
+        self._buffer = torch.zeros(
+            2, capacity, dtype=self._get_dtype(), device=self.device)
+        self._host_meters = defaultdict(AverageMeter)
+        # cache the index tensors: building them from lists is a blocking h2d copy
+        self._index_cache = {}
+
+        self._synced = {}
+        self._dirty = False
+
+    def _get_dtype(self):
+        # mps does not support float64
+        if self.device.type == "mps":
+            return torch.float32
+        return torch.float64
+
+    def _get_slot(self, name):
+        if name not in self._slots:
+            slot = len(self._slots)
+            if slot >= self._buffer.shape[1]:
+                # grow the buffer, only happens in the first iterations
+                extra = torch.zeros_like(self._buffer)
+                self._buffer = torch.cat([self._buffer, extra], dim=1)
+            self._slots[name] = slot
+        return self._slots[name]
+
+    def _get_index(self, slots):
+        if slots not in self._index_cache:
+            self._index_cache[slots] = torch.as_tensor(
+                slots, dtype=torch.long, device=self.device)
+        return self._index_cache[slots]
+
+    def update(self, values: dict, n=1):
+        """
+            values: {name: value}, tensor values are averaged into scalars.
+        """
+        slots = []
+        tensors = []
+        for name, val in values.items():
+            if isinstance(val, torch.Tensor):
+                slots.append(self._get_slot(name))
+                tensors.append(val.detach().float().mean())
+            else:
+                self._host_meters[name].update(val, n)
+
+        if len(tensors) > 0:
+            index = self._get_index(tuple(slots))
+            vals = torch.stack(tensors).to(self._buffer.dtype) * n
+            self._buffer[0].index_add_(0, index, vals)
+            self._buffer[1].index_add_(
+                0, index, torch.full_like(vals, float(n)))
+            self._dirty = True
+
+        return self
+
+    def flush(self):
+        """
+            Fetch the device sums to the host, with one all_reduce of the
+            packed buffer under DDP.
+        """
+        if not self._dirty:
+            return
+        num_slots = len(self._slots)
+        buffer = self._buffer[:, :num_slots]
+        if is_distributed():
+            buffer = buffer.clone()
+            dist.all_reduce(buffer, dist.ReduceOp.SUM)
+        sums, counts = buffer.tolist()
+        self._synced = {
+            name: (sums[slot], counts[slot])
+            for name, slot in self._slots.items()
+        }
+        self._dirty = False
+
+    def sum(self, name):
+        if name in self._host_meters:
+            return self._host_meters[name].sum
+        self.flush()
+        return self._synced[name][0]
+
+    def count(self, name):
+        if name in self._host_meters:
+            return self._host_meters[name].count
+        self.flush()
+        return self._synced[name][1]
+
+    def avg(self, name):
+        if name in self._host_meters:
+            return self._host_meters[name].avg
+        self.flush()
+        total, count = self._synced[name]
+        return total / count if count > 0 else 0
+
+    def reset(self):
+        self._buffer.zero_()
+        self._host_meters.clear()
+        self._synced = {}
+        self._dirty = False
+
+    def keys(self):
+        return list(self._slots.keys()) + list(self._host_meters.keys())
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def __contains__(self, name):
+        return name in self._slots or name in self._host_meters
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return _MeterView(self, name)
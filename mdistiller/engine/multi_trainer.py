@@ -0,0 +1,217 @@
+import copy
+
+from tqdm import tqdm
+import torch
+from torch.func import functional_call, vmap
+
+from .device import autocast
+from .profiler import record_phase
+from .trainer import Trainer
+from .utils import log_msg, is_distributed, Timer
+
+
+def get_cfg(cfg, key):
+    for k in key.split("."):
+        cfg = cfg[k]
+    return cfg
+
+
+def _select(x, i):
+    # the i-th output of the stacked students, in nested tuples & dicts
+    if isinstance(x, torch.Tensor):
+        return x[i]
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_select(v, i) for v in x)
+    elif isinstance(x, dict):
+        return {k: _select(v, i) for k, v in x.items()}
+    return x
+
+
+class StackedStudents():
+    """
+        Run N students of the same architecture as one vmapped forward over
+        their stacked weights. The weights are stacked with autograd, so the
+        gradients still flow to each student (and its own optimizer); the
+        updated BN buffers are copied back after the forward.
+    """
+
+    def __init__(self, students):
+        self.students = students
+        # stateless template, the weights are given by functional_call
+        self.base = copy.deepcopy(students[0]).to("meta")
+        # the union of the students' feature taps (see mdistiller.models.taps)
+        taps = [getattr(s, "feature_taps", None) for s in students]
+        self.base.feature_taps = None if None in taps else frozenset().union(*taps)
+        self.param_names = [name for name, _ in students[0].named_parameters()]
+        self.params = [dict(s.named_parameters()) for s in students]
+        self.buffers = [dict(s.named_buffers()) for s in students]
+
+    @staticmethod
+    def can_stack(students):
+        def signature(model):
+            return type(model), [(k, v.shape, v.dtype) for k, v in model.state_dict().items()]
+        return all(signature(s) == signature(students[0]) for s in students[1:])
+
+    def train(self, mode=True):
+        self.base.train(mode)
+
+    def __call__(self, image):
+        buffers = {
+            name: torch.stack([b[name] for b in self.buffers])
+            for name in self.buffers[0]
+        }
+        params = {
+            name: torch.stack([p[name] for p in self.params])
+            for name in self.param_names
+        }
+
+        def forward(params, buffers, image):
+            return functional_call(self.base, (params, buffers), (image,))
+
+        outputs = vmap(forward, in_dims=(0, 0, None), randomness="different")(
+            params, buffers, image)
+
+        with torch.no_grad():
+            for i, student_buffers in enumerate(self.buffers):
+                for name, buffer in student_buffers.items():
+                    buffer.copy_(buffers[name][i])
+        return [_select(outputs, i) for i in range(len(self.students))]
+
+
+class MultiStudentTrainer():
+    """
+        Train N (student, distiller, optimizer, lr_scheduler) runs against one
+        dataloader and one teacher forward per batch. Each run is a Trainer with
+        its own cfg, meters, logs and checkpoints; the runs must share the
+        dataset, teacher and solver schedule. Students of the same architecture
+        are batched by StackedStudents.
+    """
+
+    def __init__(self, experiment_names, distillers, train_loader, val_loader, cfgs, stack_students=True):
+        if is_distributed():
+            raise NotImplementedError("MultiStudentTrainer does not support DDP")
+        for cfg in cfgs:
+            if cfg.SOLVER.ACCUM_STEPS > 1:
+                raise NotImplementedError("MultiStudentTrainer does not support SOLVER.ACCUM_STEPS")
+            if cfg.TEACHER.PIPELINE.MODE != "none":
+                raise NotImplementedError("MultiStudentTrainer does not support TEACHER.PIPELINE")
+            if cfg.TEACHER.QUERY.ENABLE:
+                raise NotImplementedError("MultiStudentTrainer does not support TEACHER.QUERY")
+            for key in ["DATASET", "SOLVER.EPOCHS", "SOLVER.BATCH_SIZE",
+                        "DISTILLER.TEACHER", "DISTILLER.TEACHERS", "DISTILLER.ENSEMBLE", "REGION_LABELS"]:
+                if get_cfg(cfg, key) != get_cfg(cfgs[0], key):
+                    raise ValueError(f"The runs must share {key}")
+
+        self.trainers = [
+            Trainer(name, distiller, train_loader, val_loader, cfg)
+            for name, distiller, cfg in zip(experiment_names, distillers, cfgs)
+        ]
+        self.cfg = cfgs[0]
+        self.train_loader = self.trainers[0].train_loader
+        self.device = self.trainers[0].device
+        self.amp_dtype = self.trainers[0].amp_dtype
+        self.enable_progress_bar = self.cfg.LOG.ENABLE_PROGRESS_BAR
+
+        # one teacher forward for all runs, by the first run with a teacher
+        self.teacher_distiller = None
+        for trainer, cfg in zip(self.trainers, cfgs):
+            if cfg.DISTILLER.TYPE != "NONE":
+                self.teacher_distiller = trainer.distiller.module
+                break
+
+        students = [t.distiller.module.student for t in self.trainers]
+        self.stacked_students = None
+        if stack_students and len(students) > 1 and StackedStudents.can_stack(students):
+            self.stacked_students = StackedStudents(students)
+        print(log_msg("MultiStudentTrainer: {} runs, stacked students: {}".format(
+            len(self.trainers), self.stacked_students is not None), "INFO"))
+
+    def train(self, resume=False):
+        epoch = 1
+        start_iter = 0
+        if resume:
+            states = [t.load_state() for t in self.trainers]
+            if any(state != states[0] for state in states):
+                raise ValueError(f"The runs are resumed from different iterations: {states}")
+            epoch, start_iter = states[0]
+        while epoch < self.cfg.SOLVER.EPOCHS + 1:
+            self.train_epoch(epoch, start_iter)
+            start_iter = 0
+            epoch += 1
+        for trainer in self.trainers:
+            trainer.finish()
+
+    def train_epoch(self, epoch, start_iter=0):
+        num_iters = start_iter
+        for trainer in self.trainers:
+            # the shared sampler is set repeatedly to the same state
+            num_iters = trainer.begin_epoch(epoch, start_iter)
+        if self.stacked_students is not None:
+            self.stacked_students.train()
+        if self.enable_progress_bar:
+            pbar = tqdm(range(num_iters), initial=start_iter)
+
+        for idx, data in enumerate(self.train_loader, start=start_iter):
+            for trainer in self.trainers:
+                trainer.train_meters.update(
+                    {"data_time": self.train_loader.wait_time})
+            with record_phase("step"):
+                self.train_iter(data, epoch)
+
+            if self.enable_progress_bar:
+                if (idx + 1) % self.cfg.LOG.METRIC_SYNC_FREQ == 0 or idx + 1 == num_iters:
+                    # the first run & the best top-1 among the runs
+                    msg = self.trainers[0].get_train_msg(epoch)
+                    best_top1 = max(t.train_meters["top1"].avg for t in self.trainers)
+                    pbar.set_description(log_msg(
+                        "{}| Best Top-1 of {} runs:{:.3f}".format(
+                            msg, len(self.trainers), best_top1), "TRAIN"))
+                pbar.update()
+
+        if self.enable_progress_bar:
+            pbar.close()
+
+        for trainer in self.trainers:
+            trainer.end_epoch(epoch)
+
+    def train_iter(self, data, epoch):
+        with Timer() as train_timer:
+            with record_phase("optimizer"):
+                for trainer in self.trainers:
+                    trainer.optimizer.zero_grad()
+
+            with record_phase("forward"), autocast(self.device, self.amp_dtype):
+                image, _, other_data_dict = self.trainers[0]._preprocess_data(data)
+                teacher_outputs = other_data_dict.get("teacher_outputs")
+                if teacher_outputs is None and self.teacher_distiller is not None:
+                    teacher_outputs = self.teacher_distiller.forward_teacher(image)
+                student_outputs = None
+                if self.stacked_students is not None:
+                    with record_phase("student_forward"):
+                        student_outputs = self.stacked_students(image)
+
+                losses = []
+                for i, trainer in enumerate(self.trainers):
+                    image, target, other_data_dict = trainer._preprocess_data(data)
+                    other_data_dict["teacher_outputs"] = teacher_outputs
+                    if student_outputs is not None:
+                        other_data_dict["student_outputs"] = student_outputs[i]
+                    preds, losses_dict = trainer.distiller(
+                        image=image, target=target, epoch=epoch, **other_data_dict)
+                    loss = sum([l.mean() for l in losses_dict.values()])
+                    losses.append(trainer.scaler.scale(loss))
+                    trainer._update_train_meters(
+                        preds, target, loss, losses_dict, image.size(0))
+
+            # one backward through the shared (vmapped) graph;
+            # each run's loss only reaches its own parameters
+            with record_phase("backward"):
+                sum(losses).backward()
+
+            with record_phase("optimizer"):
+                for trainer in self.trainers:
+                    trainer.scaler.step(trainer.optimizer)
+                    trainer.scaler.update()
+
+        for trainer in self.trainers:
+            trainer.train_meters.update({"training_time": train_timer.interval})
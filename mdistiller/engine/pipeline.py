@@ -0,0 +1,148 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+
+from .device import autocast
+from .utils import log_msg, local_print
+
+
+def _to_device(x, device, non_blocking=False):
+    if isinstance(x, torch.Tensor):
+        return x.to(device, non_blocking=non_blocking)
+    elif isinstance(x, (list, tuple)):
+        return type(x)(_to_device(v, device, non_blocking) for v in x)
+    elif isinstance(x, dict):
+        return {k: _to_device(v, device, non_blocking) for k, v in x.items()}
+    return x
+
+
+def _record_stream(x, stream):
+    if isinstance(x, torch.Tensor):
+        if x.is_cuda:
+            x.record_stream(stream)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _record_stream(v, stream)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _record_stream(v, stream)
+
+
+class DeviceTeacher(nn.Module):
+    """
+        The teacher on another device (TEACHER.PIPELINE.MODE "device"). The outputs
+        stay on the teacher device, TeacherPipeline copies them back.
+        Not registered as a submodule: the training device module (eg: DataParallel)
+        only holds the student; like TeacherProxy, the teacher is not checkpointed.
+    """
+
+    def __init__(self, teacher, device):
+        super(DeviceTeacher, self).__init__()
+        self.device = torch.device(device)
+        self._teacher = [teacher.to(self.device)]
+
+    def __getattr__(self, name):
+        # forward the model methods, eg: get_bn_before_relu, get_stage_channels
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            if "_teacher" not in self.__dict__:
+                raise
+            return getattr(self.__dict__["_teacher"][0], name)
+
+    def train(self, mode=True):
+        # the teacher is always in eval mode
+        self._teacher[0].eval()
+        return super().train(False)
+
+    def forward(self, x):
+        return self._teacher[0](x.to(self.device, non_blocking=True))
+
+
+class TeacherPipeline():
+    """
+        Compute the teacher outputs of batch N+1 while the student of batch N runs
+        its forward, backward and optimizer step. The outputs are passed to the
+        distiller by the standard `teacher_outputs` argument (Distiller.forward_teacher).
+
+        mode:
+            "stream": the teacher runs on a side cuda stream of the training device.
+            "device": the teacher runs on another device (eg: "cuda:1"), see DeviceTeacher.
+            "thread": the teacher runs in a worker thread, eg: for the CPU training,
+                with `num_threads` intra-op threads (0: unchanged).
+    """
+
+    def __init__(self, distiller, mode, device, amp_dtype,
+                 teacher_device=None, teacher_amp_dtype=None, num_threads=0):
+        if mode not in ["stream", "device", "thread"]:
+            raise ValueError(f"Unknown TEACHER.PIPELINE.MODE: {mode}")
+        self.distiller = distiller
+        self.mode = mode
+        self.device = device
+        self.amp_dtype = amp_dtype
+        self.stream = None
+        self.executor = None
+
+        if mode == "stream":
+            if device.type != "cuda":
+                raise ValueError("TEACHER.PIPELINE.MODE stream requires cuda")
+            self.stream = torch.cuda.Stream(device)
+        else:
+            if mode == "device":
+                teacher_device = torch.device(teacher_device)
+                distiller.teacher = DeviceTeacher(distiller.teacher, teacher_device)
+                self.device = teacher_device
+                self.amp_dtype = teacher_amp_dtype
+            # the teacher forward is issued from a worker thread
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="TeacherPipeline",
+                initializer=torch.set_num_threads if num_threads > 0 else None,
+                initargs=(num_threads,) if num_threads > 0 else ())
+        local_print(log_msg("Teacher pipeline: {} on {}".format(mode, self.device), "INFO"))
+
+    def _forward(self, image):
+        with autocast(self.device, self.amp_dtype):
+            return self.distiller.forward_teacher(image)
+
+    def _launch(self, image):
+        if self.stream is not None:
+            # the image is ready on the current stream
+            self.stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self.stream):
+                return self._forward(image)
+        return self.executor.submit(self._forward, image)
+
+    def _collect(self, handle, device):
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(device)
+            current_stream.wait_stream(self.stream)
+            # allocated on the side stream, used on the current stream
+            _record_stream(handle, current_stream)
+            return handle
+        outputs = handle.result()
+        if self.mode == "device":
+            outputs = _to_device(outputs, device, non_blocking=True)
+        return outputs
+
+    def iterate(self, loader, device):
+        """
+            Yields: (data, teacher_outputs) of the batches of loader, the teacher
+            of the next batch is launched before the current batch is yielded.
+        """
+        loader_iter = iter(loader)
+        data = next(loader_iter, None)
+        if data is None:
+            return
+        handle = self._launch(data[0])
+        while data is not None:
+            teacher_outputs = self._collect(handle, device)
+            next_data = next(loader_iter, None)
+            if next_data is not None:
+                handle = self._launch(next_data[0])
+            yield data, teacher_outputs
+            data = next_data
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
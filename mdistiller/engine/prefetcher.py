@@ -0,0 +1,121 @@
+import time
+
+import torch
+
+
+class DevicePrefetcher():
+    """
+        Wrap a dataloader and move the batches to the device.
+        On cuda, batch N+1 is copied (and converted/normalized) on a side
+        stream while batch N is computed on the current stream.
+
+        `wait_time` is the time the last batch spent waiting for the
+        dataloader, ie: the real data loading stall of the training loop.
+    """
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format, normalize=None, use_stream=True):
+        """
+            normalize: None or (mean, std); if set, the loader is expected to
+                return uint8 images, which are converted and normalized on the device.
+            use_stream: copy the batches on a side stream (cuda only),
+                otherwise the copies are issued on the current stream.
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.memory_format = memory_format
+        self.use_stream = use_stream and self.device.type == "cuda"
+        self.non_blocking = self.device.type == "cuda"
+
+        if normalize is not None:
+            mean, std = normalize
+            # scale from [0, 255]
+            self.mean = torch.as_tensor(
+                mean, dtype=torch.float32, device=self.device).view(1, -1, 1, 1) * 255
+            self.std = torch.as_tensor(
+                std, dtype=torch.float32, device=self.device).view(1, -1, 1, 1) * 255
+        else:
+            self.mean = None
+            self.std = None
+
+        self.stream = torch.cuda.Stream(self.device) if self.use_stream else None
+        self.wait_time = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def _to_device(self, data):
+        if isinstance(data, torch.Tensor):
+            return data.to(self.device, non_blocking=self.non_blocking)
+        elif isinstance(data, (list, tuple)):
+            return type(data)(self._to_device(x) for x in data)
+        elif isinstance(data, dict):
+            return {k: self._to_device(v) for k, v in data.items()}
+        else:
+            return data
+
+    def _preprocess_image(self, image):
+        if self.mean is not None:
+            image = image.float().sub_(self.mean).div_(self.std)
+        else:
+            image = image.float()
+        return image.contiguous(memory_format=self.memory_format)
+
+    def _load(self, loader_iter):
+        """
+            Fetch the next batch and issue its copy & preprocess.
+            Returns None at the end of the loader.
+        """
+        start = time.perf_counter()
+        try:
+            data = next(loader_iter)
+        except StopIteration:
+            return None
+        wait_time = time.perf_counter() - start
+
+        if self.use_stream:
+            with torch.cuda.stream(self.stream):
+                data = self._to_device(data)
+                data = [self._preprocess_image(data[0])] + list(data[1:])
+        else:
+            data = self._to_device(data)
+            data = [self._preprocess_image(data[0])] + list(data[1:])
+
+        return data, wait_time
+
+    def _record_stream(self, data):
+        # the tensors are allocated on the side stream but used on the current stream
+        current_stream = torch.cuda.current_stream(self.device)
+        if isinstance(data, torch.Tensor):
+            if data.is_cuda:
+                data.record_stream(current_stream)
+        elif isinstance(data, (list, tuple)):
+            for x in data:
+                self._record_stream(x)
+        elif isinstance(data, dict):
+            for x in data.values():
+                self._record_stream(x)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        batch = self._load(loader_iter)
+        while batch is not None:
+            data, self.wait_time = batch
+            if self.use_stream:
+                torch.cuda.current_stream(self.device).wait_stream(self.stream)
+                self._record_stream(data)
+            yield data
+            # the kernels of this step are already queued (no host syncs in
+            # train_iter), so the copy of the next batch overlaps with them
+            batch = self._load(loader_iter)
@@ -0,0 +1,228 @@
+import os
+import json
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from .utils import log_msg, get_rank, is_main_process
+
+# the active PhaseProfiler, None if profiling is disabled
+_profiler = None
+
+
+@contextmanager
+def record_phase(name):
+    """
+        Mark a phase of the training step, eg: teacher_forward.
+        It is a no-op unless a PhaseProfiler is active.
+    """
+    profiler = _profiler
+    if profiler is None or not profiler.recording:
+        yield
+        return
+    with profiler.phase(name):
+        yield
+
+
+class PhaseProfiler():
+    """
+        Profile the phases of the training steps in the window
+        [WAIT+WARMUP, WAIT+WARMUP+ACTIVE): the time and memory of each
+        phase in `record_phase`, and a chrome trace of `torch.profiler`.
+
+        The kd loss is not wrapped in the distillers, its time is
+        reported as "loss": forward - teacher_forward - student_forward.
+    """
+
+    def __init__(self, cfg, log_path, device):
+        self.log_path = log_path
+        os.makedirs(log_path, exist_ok=True)
+        self.device = device
+        self.wait = cfg.LOG.PROFILE.WAIT
+        self.warmup = cfg.LOG.PROFILE.WARMUP
+        self.active = cfg.LOG.PROFILE.ACTIVE
+        self.use_cuda = device.type == "cuda"
+
+        self.step_num = 0
+        self.recording = False
+        self.finished = False
+
+        self._records = []
+        self._step_times = defaultdict(list)
+        self._step_mems = defaultdict(list)
+        self._peak_mems = []
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.use_cuda:
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.torch_profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=self.wait, warmup=self.warmup, active=self.active, repeat=1),
+            on_trace_ready=self._export_trace,
+            record_shapes=cfg.LOG.PROFILE.RECORD_SHAPES,
+            profile_memory=True,
+            with_stack=False
+        )
+
+    def start(self):
+        global _profiler
+        _profiler = self
+        self.torch_profiler.start()
+        self._update_recording()
+
+    def _update_recording(self):
+        start = self.wait + self.warmup
+        self.recording = start <= self.step_num < start + self.active
+        if self.recording and self.use_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    @contextmanager
+    def phase(self, name):
+        with torch.profiler.record_function(name):
+            record = self._begin(name)
+            try:
+                yield
+            finally:
+                self._end(record)
+
+    def _memory_allocated(self):
+        if self.use_cuda:
+            return torch.cuda.memory_allocated(self.device)
+        return 0
+
+    def _begin(self, name):
+        record = {
+            "name": name,
+            "mem_start": self._memory_allocated(),
+        }
+        if self.use_cuda:
+            record["start"] = torch.cuda.Event(enable_timing=True)
+            record["start"].record()
+        else:
+            record["start"] = time.perf_counter()
+        return record
+
+    def _end(self, record):
+        if self.use_cuda:
+            record["end"] = torch.cuda.Event(enable_timing=True)
+            record["end"].record()
+        else:
+            record["end"] = time.perf_counter()
+        record["mem_end"] = self._memory_allocated()
+        self._records.append(record)
+
+    def add(self, name, interval):
+        """add a host-side phase time (in seconds), eg: data loading"""
+        if self.recording:
+            self._records.append({"name": name, "time": interval * 1000})
+
+    def step(self):
+        if self.finished:
+            return
+
+        if self.recording:
+            self._collect_step()
+        self.torch_profiler.step()
+        self.step_num += 1
+        self._update_recording()
+
+        if self.step_num >= self.wait + self.warmup + self.active:
+            self.stop()
+
+    def _collect_step(self):
+        if self.use_cuda:
+            # resolve the cuda events, only once per step
+            torch.cuda.synchronize(self.device)
+
+        times = defaultdict(float)
+        mems = defaultdict(float)
+        for record in self._records:
+            name = record["name"]
+            if "time" in record:
+                times[name] += record["time"]
+                continue
+            if self.use_cuda:
+                times[name] += record["start"].elapsed_time(record["end"])
+            else:
+                times[name] += (record["end"] - record["start"]) * 1000
+            mems[name] += record["mem_end"] - record["mem_start"]
+        self._records = []
+
+        if "forward" in times:
+            times["loss"] = times["forward"] - \
+                times.get("teacher_forward", 0) - times.get("student_forward", 0)
+
+        for name, t in times.items():
+            self._step_times[name].append(t)
+        for name, m in mems.items():
+            self._step_mems[name].append(m)
+        if self.use_cuda:
+            self._peak_mems.append(torch.cuda.max_memory_allocated(self.device))
+
+    def stop(self):
+        global _profiler
+        if self.finished:
+            return
+        self.finished = True
+        self.recording = False
+        self.torch_profiler.stop()
+        if _profiler is self:
+            _profiler = None
+        self._export_summary()
+
+    def _export_trace(self, prof):
+        path = os.path.join(
+            self.log_path, "trace_rank{}.json".format(get_rank()))
+        prof.export_chrome_trace(path)
+        if is_main_process():
+            print(log_msg("Chrome trace is saved to {}".format(path), "INFO"))
+
+    def summary(self):
+        step_time = np.sum([
+            np.mean(times) for name, times in self._step_times.items()
+            if name in ["data", "step"]
+        ])
+        summary = OrderedDict()
+        for name, times in self._step_times.items():
+            mean_time = float(np.mean(times))
+            summary[name] = {
+                "time_ms": mean_time,
+                "time_p50_ms": float(np.percentile(times, 50)),
+                "time_p90_ms": float(np.percentile(times, 90)),
+                "ratio": mean_time / step_time if step_time > 0 else 0,
+                "mem_delta_mb": float(np.mean(self._step_mems[name])) / 2**20
+                if name in self._step_mems else None,
+            }
+        result = {
+            "num_steps": len(self._step_times.get("step", [])),
+            "phases": summary,
+        }
+        if self.use_cuda and len(self._peak_mems) > 0:
+            result["peak_mem_mb"] = float(np.max(self._peak_mems)) / 2**20
+        return result
+
+    def _export_summary(self):
+        result = self.summary()
+        path = os.path.join(
+            self.log_path, "profile_summary_rank{}.json".format(get_rank()))
+        with open(path, "w") as f:
+            json.dump(result, f, indent=4)
+
+        if is_main_process():
+            lines = ["Profile summary ({} steps):".format(result["num_steps"])]
+            for name, stat in result["phases"].items():
+                line = "{:>16}: {:9.3f} ms ({:5.1%})".format(
+                    name, stat["time_ms"], stat["ratio"])
+                if stat["mem_delta_mb"] is not None and self.use_cuda:
+                    line += " mem delta: {:9.2f} MB".format(
+                        stat["mem_delta_mb"])
+                lines.append(line)
+            if "peak_mem_mb" in result:
+                lines.append("peak memory: {:.2f} MB".format(
+                    result["peak_mem_mb"]))
+            lines.append("saved to {}".format(path))
+            print(log_msg(os.linesep.join(lines), "INFO"))
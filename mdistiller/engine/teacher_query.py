@@ -0,0 +1,138 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from .utils import log_msg, local_print
+
+
+class TeacherQueryCache():
+    """
+        Per-sample cache of the last teacher logits, keyed by the dataset index.
+        Each batch only re-queries the teacher for a fraction of its samples:
+        the missing & stale entries (older than `max_staleness` epochs), then
+        up to `fraction` of the batch by `policy`:
+            "disagreement": the samples with the highest KL(teacher||student)
+                at their last step;
+            "oldest": the samples with the oldest entries;
+            "random": random samples.
+        The other samples reuse their cached logits.
+
+        get_train_info:
+            teacher_query_rate: the fraction of re-queried samples.
+            teacher_hit_rate: the fraction of reused samples.
+            teacher_staleness: the mean age (epochs) of the reused logits.
+            teacher_drift: the mean KL(fresh||cached) at `temperature` of the
+                re-queried samples with an entry, ie: the drift of the loss targets.
+    """
+
+    def __init__(self, num_data, fraction=0.25, max_staleness=4, policy="disagreement",
+                 temperature=4.0, storage_device=None):
+        if policy not in ["disagreement", "oldest", "random"]:
+            raise ValueError(f"Unknown TEACHER.QUERY.POLICY: {policy}")
+        if not 0 <= fraction <= 1:
+            raise ValueError(f"TEACHER.QUERY.FRACTION must be in [0, 1], got {fraction}")
+        self.num_data = num_data
+        self.fraction = fraction
+        self.max_staleness = max_staleness
+        self.policy = policy
+        self.temperature = temperature
+        self.storage_device = storage_device
+        # allocated at the first query, when the number of classes is known
+        self.logits = None
+        self.epochs = None
+        self.disagreement = None
+        self.train_info = {}
+
+    def _init_storage(self, num_classes, device):
+        device = self.storage_device or device
+        self.logits = torch.zeros(
+            self.num_data, num_classes, dtype=torch.float16, device=device)
+        # the epoch of each entry, 0: missing (epoch starts from 1)
+        self.epochs = torch.zeros(self.num_data, dtype=torch.int32, device=device)
+        self.disagreement = torch.zeros(self.num_data, dtype=torch.float32, device=device)
+        local_print(log_msg("Teacher query cache: {} samples x {} classes on {}".format(
+            self.num_data, num_classes, device), "INFO"))
+
+    def _select(self, index, epoch):
+        """
+            Returns: the bool mask [B] of the samples to re-query.
+        """
+        batch_size = index.shape[0]
+        if self.epochs is None:
+            return torch.ones(batch_size, dtype=torch.bool, device=index.device)
+        entry_epochs = self.epochs[index.to(self.epochs.device)].to(index.device)
+        mask = (entry_epochs == 0) | (epoch - entry_epochs >= self.max_staleness)
+        budget = math.ceil(self.fraction * batch_size) - int(mask.sum())
+        if budget <= 0:
+            return mask
+        if self.policy == "disagreement":
+            score = self.disagreement[index.to(self.disagreement.device)].to(index.device)
+        elif self.policy == "oldest":
+            score = -entry_epochs.float()
+        else:
+            score = torch.rand(batch_size, device=index.device)
+        # the mandatory samples are already selected
+        score = score.masked_fill(mask, float("-inf"))
+        mask[score.topk(budget).indices] = True
+        return mask
+
+    def query(self, teacher, image, index, epoch):
+        """
+            teacher: image -> (logits, feats)
+            Returns: (logits, {}) of the batch, the re-queried & cached logits.
+        """
+        mask = self._select(index, epoch)
+        query_index = index[mask]
+        fresh_logits = None
+        if query_index.numel() > 0:
+            with torch.no_grad():
+                fresh_logits = teacher(image[mask])[0].float()
+        if self.logits is None:
+            # the first batch queries all its samples
+            self._init_storage(fresh_logits.shape[1], fresh_logits.device)
+
+        storage_device = self.logits.device
+        logits = self.logits[index.to(storage_device)].to(image.device).float()
+        entry_epochs = self.epochs[index.to(storage_device)].to(image.device)
+        if fresh_logits is None:
+            fresh_logits = logits[mask]
+
+        # statistics, before the entries are updated
+        hit = ~mask
+        num_hits = hit.sum()
+        has_entry = mask & (entry_epochs > 0)
+        drift = F.kl_div(
+            F.log_softmax(logits[has_entry] / self.temperature, dim=1),
+            F.log_softmax(fresh_logits[has_entry[mask]] / self.temperature, dim=1),
+            reduction="sum", log_target=True,
+        ) * self.temperature**2
+        self.train_info = {
+            "teacher_query_rate": mask.float().mean(),
+            "teacher_hit_rate": hit.float().mean(),
+            "teacher_staleness": ((epoch - entry_epochs) * hit).sum() / num_hits.clamp(min=1),
+            "teacher_drift": drift / has_entry.sum().clamp(min=1),
+        }
+
+        logits[mask] = fresh_logits
+        self.logits[query_index.to(storage_device)] = fresh_logits.to(storage_device, torch.float16)
+        self.epochs[query_index.to(storage_device)] = epoch
+        return logits, {}
+
+    def update(self, index, logits_student, logits_teacher):
+        """
+            Record the per-sample KL(teacher||student) of the last step,
+            for the "disagreement" policy.
+        """
+        if self.policy != "disagreement":
+            return
+        with torch.no_grad():
+            disagreement = F.kl_div(
+                F.log_softmax(logits_student.float(), dim=1),
+                F.log_softmax(logits_teacher.float(), dim=1),
+                reduction="none", log_target=True,
+            ).sum(1)
+        self.disagreement[index.to(self.disagreement.device)] = disagreement.to(self.disagreement.device)
+
+    def get_train_info(self):
+        return self.train_info
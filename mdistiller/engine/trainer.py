@@ -1,51 +1,142 @@
 import os
 import time
+import copy
+import random
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from tqdm import tqdm
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 from tensorboardX import SummaryWriter
 
 from .validate import validate
+from .device import get_device, get_memory_format, get_amp_dtype, autocast
+from .metrics import DeviceMeterGroup
+from .prefetcher import DevicePrefetcher
+from .pipeline import TeacherPipeline
+from .teacher_query import TeacherQueryCache
+from .checkpoint import CheckpointWriter
+from .profiler import PhaseProfiler, record_phase
 from .utils import (
-    AverageMeter,
     accuracy,
     adjust_learning_rate,
-    save_checkpoint,
     load_checkpoint,
     log_msg,
     reduce_tensor,
     is_distributed,
     is_main_process,
+    get_rank,
     Timer
 )
 
 
+class _StudentEvalWrapper(nn.Module):
+    """same interface as Distiller.forward_test"""
+
+    def __init__(self, student):
+        super(_StudentEvalWrapper, self).__init__()
+        self.student = student
+
+    def forward(self, image):
+        return self.student(image)[0]
+
+
 class Trainer():
     def __init__(self, experiment_name, distiller, train_loader, val_loader, cfg):
         self.cfg = cfg
+        self.device = get_device(cfg)
+        self.memory_format = get_memory_format(cfg, self.device)
+        self.amp_dtype = get_amp_dtype(cfg, self.device)
+        # loss scaling is only needed for float16
+        self.scaler = torch.cuda.amp.GradScaler(
+            enabled=self.amp_dtype == torch.float16)
         self.distiller = distiller
+        if not isinstance(train_loader, DevicePrefetcher):
+            train_loader = DevicePrefetcher(
+                train_loader, self.device, self.memory_format)
+        if not isinstance(val_loader, DevicePrefetcher):
+            val_loader = DevicePrefetcher(
+                val_loader, self.device, self.memory_format)
         self.train_loader = train_loader
         self.val_loader = val_loader
+        self.feature_cache = None
+        if cfg.TEACHER_CACHE.ENABLE:
+            self.feature_cache = self.check_teacher_cache(cfg)
+        if cfg.REGION_LABELS.ENABLE:
+            self.check_logit_teacher(cfg, "REGION_LABELS")
+        self.teacher_pipeline = None
+        if cfg.TEACHER.PIPELINE.MODE != "none" and cfg.DISTILLER.TYPE != "NONE":
+            if cfg.TEACHER_CACHE.ENABLE or cfg.REGION_LABELS.ENABLE:
+                raise ValueError("TEACHER.PIPELINE can not be used with TEACHER_CACHE or REGION_LABELS")
+            teacher_device = torch.device(cfg.TEACHER.PIPELINE.DEVICE)
+            self.teacher_pipeline = TeacherPipeline(
+                self.distiller.module,
+                cfg.TEACHER.PIPELINE.MODE,
+                self.device,
+                self.amp_dtype,
+                teacher_device=teacher_device,
+                teacher_amp_dtype=get_amp_dtype(cfg, teacher_device),
+                num_threads=cfg.TEACHER.PIPELINE.NUM_THREADS,
+            )
+        self.teacher_query = None
+        if cfg.TEACHER.QUERY.ENABLE and cfg.DISTILLER.TYPE != "NONE":
+            if cfg.TEACHER_CACHE.ENABLE or cfg.REGION_LABELS.ENABLE or self.teacher_pipeline is not None:
+                raise ValueError(
+                    "TEACHER.QUERY can not be used with TEACHER_CACHE, REGION_LABELS or TEACHER.PIPELINE")
+            self.check_logit_teacher(cfg, "TEACHER.QUERY")
+            self.teacher_query = TeacherQueryCache(
+                len(self.train_loader.dataset),
+                fraction=cfg.TEACHER.QUERY.FRACTION,
+                max_staleness=cfg.TEACHER.QUERY.MAX_STALENESS,
+                policy=cfg.TEACHER.QUERY.POLICY,
+                temperature=cfg.TEACHER.QUERY.TEMPERATURE,
+                storage_device=cfg.TEACHER.QUERY.STORAGE_DEVICE or None,
+            )
         self.optimizer = self.init_optimizer(cfg)
         self.lr_scheduler = self.init_lr_scheduler(cfg, self.optimizer)
         self.best_acc = -1
         self.is_distributed = is_distributed()
 
         self.enable_progress_bar = cfg.LOG.ENABLE_PROGRESS_BAR
+        self.metric_sync_freq = cfg.LOG.METRIC_SYNC_FREQ
 
         self.train_meters = None
         self.train_info_meters = None
 
+        self.save_iter_freq = cfg.LOG.SAVE_ITER_FREQ
+
+        self.eval_freq = cfg.LOG.EVAL_FREQ
+        self.eval_dense_last = cfg.LOG.EVAL_DENSE_LAST
+        # the collectives of DDP eval cannot run concurrently with training
+        self.async_eval = cfg.LOG.ASYNC_EVAL and not self.is_distributed
+        self.pending_eval = None
+        if self.async_eval:
+            self.eval_executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="AsyncEval")
+            self.eval_stream = torch.cuda.Stream(
+                self.device) if self.device.type == "cuda" else None
+
+        # all ranks need the log path to resume
+        self.log_path = os.path.join(
+            cfg.LOG.PREFIX, cfg.EXPERIMENT.PROJECT, experiment_name)
         if is_main_process():
             # init loggers
-            self.log_path = os.path.join(
-                cfg.LOG.PREFIX, cfg.EXPERIMENT.PROJECT, experiment_name)
             if not os.path.exists(self.log_path):
                 os.makedirs(self.log_path)
             self.tf_writer = SummaryWriter(
                 os.path.join(self.log_path, "train.events"))
+            self.checkpoint_writer = CheckpointWriter(
+                self.log_path,
+                keep_checkpoints=cfg.LOG.KEEP_CHECKPOINTS,
+                async_write=cfg.LOG.ASYNC_CHECKPOINT
+            )
+
+        self.profiler = None
+        if cfg.LOG.PROFILE.ENABLE:
+            self.profiler = PhaseProfiler(cfg, self.log_path, self.device)
 
     def init_optimizer(self, cfg):
         if cfg.SOLVER.TYPE == "SGD":
@@ -82,10 +173,10 @@ class Trainer():
             if self.cfg.LOG.WANDB:
                 import wandb
 
-                wandb_log_dict = {"current lr": lr, **log_dict}
+                wandb_log_dict = {"epoch": epoch, "current lr": lr, **log_dict}
 
                 wandb.log(wandb_log_dict)
-            if log_dict["test_acc"] > self.best_acc:
+            if "test_acc" in log_dict and log_dict["test_acc"] > self.best_acc:
                 self.best_acc = log_dict["test_acc"]
                 if self.cfg.LOG.WANDB:
                     wandb.run.summary["best_acc"] = self.best_acc
@@ -103,52 +194,203 @@ class Trainer():
 
     def train(self, resume=False):
         epoch = 1
+        start_iter = 0
         if resume:
-            state = torch.load(os.path.join(self.log_path, "latest"))
-            epoch = state["epoch"] + 1
-            self.distiller.load_state_dict(state["model"])
-            self.optimizer.load_state_dict(state["optimizer"])
-            self.best_acc = state["best_acc"]
+            epoch, start_iter = self.load_state()
+        if self.profiler is not None:
+            self.profiler.start()
         while epoch < self.cfg.SOLVER.EPOCHS + 1:
-            self.train_epoch(epoch)
+            self.train_epoch(epoch, start_iter)
+            start_iter = 0
             epoch += 1
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.finish()
+
+    def load_state(self):
+        """
+            Load latest.pth.
+            Returns: (epoch, start_iter) to resume from.
+        """
+        state = torch.load(os.path.join(
+            self.log_path, "latest.pth"), map_location=self.device)
+        # state["epoch"] is the last finished epoch,
+        # state["iter"] is the number of finished iterations of the next epoch
+        epoch = state["epoch"] + 1
+        start_iter = state.get("iter", 0)
+        self.distiller.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        if "lr_scheduler" in state:
+            self.lr_scheduler.load_state_dict(state["lr_scheduler"])
+        else:
+            # old checkpoints: replay the scheduler
+            for _ in range(state["epoch"]):
+                self.lr_scheduler.step()
+        if "scaler" in state:
+            self.scaler.load_state_dict(state["scaler"])
+        if "rng_states" in state:
+            self.set_rng_state(state["rng_states"])
+        sampler = self.train_loader.sampler
+        if hasattr(sampler, "seed"):
+            # the data order of the run, old checkpoints: the default seed 0
+            sampler.seed = state.get("sampler_seed", 0)
+        self.best_acc = state["best_acc"]
+        if is_main_process():
+            print(log_msg("Resume from epoch {} iter {}".format(
+                epoch, start_iter), "INFO"))
+        return epoch, start_iter
+
+    def finish(self):
+        if self.async_eval:
+            self.collect_async_eval()
+            self.eval_executor.shutdown()
+        if self.teacher_pipeline is not None:
+            self.teacher_pipeline.shutdown()
 
         if is_main_process():
+            self.checkpoint_writer.close()
             print(log_msg("Best accuracy:{}".format(self.best_acc), "EVAL"))
             with open(os.path.join(self.log_path, "worklog.txt"), "a") as writer:
                 writer.write("best_acc\t" +
                              "{:.2f}".format(float(self.best_acc)))
 
-    def train_epoch(self, epoch):
+    def get_rng_state(self):
+        """
+            Returns: the rng states of all ranks.
+        """
+        rng_state = {
+            "python": random.getstate(),
+            "numpy": np.random.get_state(),
+            "torch": torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            rng_state["cuda"] = torch.cuda.get_rng_state()
+        if self.is_distributed:
+            rng_states = [None] * torch.distributed.get_world_size()
+            torch.distributed.all_gather_object(rng_states, rng_state)
+        else:
+            rng_states = [rng_state]
+        return rng_states
+
+    def set_rng_state(self, rng_states):
+        rank = get_rank()
+        if rank >= len(rng_states):
+            # the world size is changed
+            print(log_msg(
+                "No rng state for rank {}, skip restoring".format(rank), "INFO"))
+            return
+        rng_state = rng_states[rank]
+        random.setstate(rng_state["python"])
+        np.random.set_state(rng_state["numpy"])
+        torch.set_rng_state(rng_state["torch"])
+        if "cuda" in rng_state and torch.cuda.is_available():
+            torch.cuda.set_rng_state(rng_state["cuda"])
+
+    def get_state(self, epoch, iter=0):
+        """
+            epoch: the last finished epoch
+            iter: the number of finished iterations of the next epoch
+        """
+        # NOTE: collective op under DDP, must be called on all ranks
+        rng_states = self.get_rng_state()
+        return {
+            "epoch": epoch,
+            "iter": iter,
+            "model": self.distiller.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "lr_scheduler": self.lr_scheduler.state_dict(),
+            "scaler": self.scaler.state_dict(),
+            "rng_states": rng_states,
+            "sampler_seed": getattr(self.train_loader.sampler, "seed", None),
+            "best_acc": self.best_acc,
+        }
+
+    def begin_epoch(self, epoch, start_iter=0):
+        """
+            Returns: the number of iterations of the epoch.
+        """
         # lr = adjust_learning_rate(epoch, self.cfg, self.optimizer)
 
-        self.train_meters = defaultdict(AverageMeter)
-        self.train_info_meters = defaultdict(AverageMeter)
+        self.train_meters = DeviceMeterGroup(self.device)
+        self.train_info_meters = DeviceMeterGroup(self.device)
 
-        if self.is_distributed:
-            self.train_loader.sampler.set_epoch(epoch)
+        sampler = self.train_loader.sampler
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+        if start_iter > 0:
+            if not hasattr(sampler, "set_start_index"):
+                raise ValueError(
+                    "Resuming from the middle of an epoch requires ResumableSampler")
+            # fast-forward: the skipped samples are not loaded
+            sampler.set_start_index(start_iter * self.train_loader.batch_size)
+
+        self.distiller.train()
+        return start_iter + len(self.train_loader)
 
+    def train_epoch(self, epoch, start_iter=0):
+        num_iters = self.begin_epoch(epoch, start_iter)
         if self.enable_progress_bar and is_main_process():
-            pbar = tqdm(range(len(self.train_loader)))
+            pbar = tqdm(range(num_iters), initial=start_iter)
+
+        loader = self.train_loader
+        if self.teacher_pipeline is not None:
+            loader = self.teacher_pipeline.iterate(self.train_loader, self.device)
 
         # train loops
-        self.distiller.train()
-        for idx, data in enumerate(self.train_loader):
-            msg = self.train_iter(data, epoch)
-            if self.enable_progress_bar and is_main_process():
-                pbar.set_description(log_msg(msg, "TRAIN"))
-                pbar.update()
+        for idx, data in enumerate(loader, start=start_iter):
+            teacher_outputs = None
+            if self.teacher_pipeline is not None:
+                data, teacher_outputs = data
+            # the time blocked on the dataloader, the h2d copy is overlapped
+            self.train_meters.update({"data_time": self.train_loader.wait_time})
+            if self.profiler is not None:
+                self.profiler.add("data", self.train_loader.wait_time)
+            with record_phase("step"):
+                self.train_iter(data, epoch, teacher_outputs)
+            if self.profiler is not None:
+                self.profiler.step()
+
+            if self.save_iter_freq > 0 and (idx + 1) % self.save_iter_freq == 0 and idx + 1 < num_iters:
+                state = self.get_state(epoch - 1, idx + 1)
+                if is_main_process():
+                    self.checkpoint_writer.save([(state, ["latest.pth"])])
+            if self.enable_progress_bar:
+                # only sync the metrics when the progress bar needs them;
+                # NOTE: all ranks must flush at the same iterations under DDP
+                if (idx + 1) % self.metric_sync_freq == 0 or idx + 1 == num_iters:
+                    msg = self.get_train_msg(epoch)
+                    if is_main_process():
+                        pbar.set_description(log_msg(msg, "TRAIN"))
+                if is_main_process():
+                    pbar.update()
 
         if self.enable_progress_bar and is_main_process():
             pbar.close()
 
-        # validate
-        test_acc, test_acc_top5, test_loss = validate(
-            self.val_loader, self.distiller)
+        self.end_epoch(epoch)
+
+    def end_epoch(self, epoch):
+        # sync the metrics on all ranks
+        self.train_meters.flush()
+        self.train_info_meters.flush()
 
         lr = self.lr_scheduler.get_last_lr()[0]
+
+        # validate
+        do_eval = self.should_eval(epoch)
+        test_results = None
+        if do_eval:
+            if self.async_eval:
+                # log the previous results before its checkpoint is overwritten
+                self.collect_async_eval()
+            else:
+                test_results = self.evaluate(self.distiller)
+
         self.lr_scheduler.step()
 
+        # collect the rng states on all ranks
+        state = self.get_state(epoch)
+
         # log
         if is_main_process():
             log_dict = OrderedDict(
@@ -157,11 +399,10 @@ class Trainer():
                     "train_acc_top5": self.train_meters["top5"].avg,
                     "train_loss": self.train_meters["losses"].avg,
                     "train_loss_ce": self.train_meters["loss_ce"].avg,
-                    "test_acc": test_acc,
-                    "test_acc_top5": test_acc_top5,
-                    "test_loss": test_loss,
                 }
             )
+            if test_results is not None:
+                log_dict.update(test_results)
             if "loss_kd" in self.train_meters:
                 log_dict["train_loss_kd"] = self.train_meters["loss_kd"].avg
 
@@ -171,78 +412,198 @@ class Trainer():
             self.log(lr, epoch, log_dict)
 
             # saving checkpoint
-            state = {
-                "epoch": epoch,
-                "model": self.distiller.state_dict(),
-                "optimizer": self.optimizer.state_dict(),
-                "best_acc": self.best_acc,
-            }
+            state["best_acc"] = self.best_acc
             student_state = {
                 "model": self.distiller.module.student.state_dict()}
-            save_checkpoint(state, os.path.join(self.log_path, "latest.pth"))
-            save_checkpoint(
-                student_state, os.path.join(
-                    self.log_path, "student_latest.pth")
-            )
+            # identical payloads are written once and hardlinked
+            names = ["latest.pth"]
+            student_names = ["student_latest.pth"]
             if epoch % self.cfg.LOG.SAVE_CHECKPOINT_FREQ == 0:
-                save_checkpoint(
-                    state, os.path.join(self.log_path, f"epoch_{epoch}.pth")
-                )
-                save_checkpoint(
-                    student_state,
-                    os.path.join(self.log_path, f"student_{epoch}.pth"),
-                )
+                names.append(f"epoch_{epoch}.pth")
+                student_names.append(f"student_{epoch}.pth")
             # update the best
-            if test_acc >= self.best_acc:
-                save_checkpoint(state, os.path.join(self.log_path, "best.pth"))
-                save_checkpoint(
-                    student_state, os.path.join(
-                        self.log_path, "student_best.pth")
-                )
+            if test_results is not None and test_results["test_acc"] >= self.best_acc:
+                names.append("best.pth")
+                student_names.append("student_best.pth")
+            if do_eval and self.async_eval:
+                # linked to best.pth when the async results arrive
+                names.append("eval_pending.pth")
+                student_names.append("student_eval_pending.pth")
+            self.checkpoint_writer.save([
+                (state, names),
+                (student_state, student_names),
+            ])
+
+        if do_eval and self.async_eval:
+            self.submit_async_eval(epoch, lr)
+
+    def should_eval(self, epoch):
+        num_epochs = self.cfg.SOLVER.EPOCHS
+        return (
+            epoch % self.eval_freq == 0
+            or epoch > num_epochs - self.eval_dense_last
+            or epoch == num_epochs
+        )
 
-    def train_iter(self, data, epoch):
-        self.optimizer.zero_grad()
+    def evaluate(self, model, progress_bar=True):
+        test_acc, test_acc_top5, test_loss = validate(
+            self.val_loader, model,
+            device=self.device, memory_format=self.memory_format,
+            metric_sync_freq=self.metric_sync_freq, amp_dtype=self.amp_dtype,
+            progress_bar=progress_bar)
+        return OrderedDict(
+            {
+                "test_acc": test_acc,
+                "test_acc_top5": test_acc_top5,
+                "test_loss": test_loss,
+            }
+        )
+
+    def submit_async_eval(self, epoch, lr):
+        # evaluate a snapshot of the student while training continues
+        model = _StudentEvalWrapper(
+            copy.deepcopy(self.distiller.module.student))
+        model.eval()
+
+        if self.eval_stream is not None:
+            # wait for the snapshot copy
+            self.eval_stream.wait_stream(
+                torch.cuda.current_stream(self.device))
+        future = self.eval_executor.submit(self._run_async_eval, model)
+        self.pending_eval = (epoch, lr, future)
+
+    def _run_async_eval(self, model):
+        if self.eval_stream is not None:
+            stream_context = torch.cuda.stream(self.eval_stream)
+        else:
+            stream_context = nullcontext()
+        with stream_context:
+            return self.evaluate(model, progress_bar=False)
+
+    def collect_async_eval(self):
+        if self.pending_eval is None:
+            return
+        epoch, lr, future = self.pending_eval
+        self.pending_eval = None
+        test_results = future.result()
+
+        print(log_msg("Epoch:{}| Top-1:{:.3f}| Top-5:{:.3f}".format(
+            epoch, test_results["test_acc"], test_results["test_acc_top5"]), "EVAL"))
+        self.log(lr, epoch, test_results)
+        if test_results["test_acc"] >= self.best_acc:
+            self.checkpoint_writer.link("eval_pending.pth", ["best.pth"])
+            self.checkpoint_writer.link(
+                "student_eval_pending.pth", ["student_best.pth"])
+
+    def train_iter(self, data, epoch, teacher_outputs=None):
+        """
+            teacher_outputs: precomputed by the teacher pipeline, if any
+        """
+        with record_phase("optimizer"):
+            self.optimizer.zero_grad()
 
         train_meters = self.train_meters
 
         with Timer() as train_timer:
-            with Timer() as data_timer:
-                image, target, other_data_dict = self._preprocess_data(data)
-            train_meters["data_time"].update(data_timer.interval)
-
-            # forward
-            preds, losses_dict = self.distiller(
-                image=image, target=target, epoch=epoch, **other_data_dict)
-
-            # backward
-            loss = sum([l.mean() for l in losses_dict.values()])
-            loss.backward()
-            self.optimizer.step()
-
-        train_meters["training_time"].update(train_timer.interval)
-        # collect info
-        batch_size = image.size(0)
+            image, target, other_data_dict = self._preprocess_data(data)
+            if teacher_outputs is not None:
+                other_data_dict["teacher_outputs"] = teacher_outputs
+            elif self.teacher_query is not None:
+                # only a fraction of the batch runs the teacher, the rest reuses its logits
+                with autocast(self.device, self.amp_dtype):
+                    other_data_dict["teacher_outputs"] = self.teacher_query.query(
+                        self.distiller.module.forward_teacher, image, data[2], epoch)
+                logits_teacher = other_data_dict["teacher_outputs"][0]
+                logits_student = []
+
+            batch_size = image.size(0)
+            micro_batches = self._split_micro_batches(
+                image, target, other_data_dict)
+            num_micro_batches = len(micro_batches)
+
+            for i, (image, target, other_data_dict) in enumerate(micro_batches):
+                micro_batch_size = image.size(0)
+                # only sync the gradients at the last micro-batch under DDP
+                if i < num_micro_batches - 1 and hasattr(self.distiller, "no_sync"):
+                    sync_context = self.distiller.no_sync()
+                else:
+                    sync_context = nullcontext()
+
+                with sync_context:
+                    # forward
+                    with record_phase("forward"), autocast(self.device, self.amp_dtype):
+                        preds, losses_dict = self.distiller(
+                            image=image, target=target, epoch=epoch, **other_data_dict)
+                        loss = sum([l.mean() for l in losses_dict.values()])
+
+                    # backward: the accumulated gradients equal to the full batch ones
+                    with record_phase("backward"):
+                        self.scaler.scale(
+                            loss * (micro_batch_size / batch_size)).backward()
+
+                self._update_train_meters(
+                    preds, target, loss, losses_dict, micro_batch_size)
+                if self.teacher_query is not None:
+                    logits_student.append(preds.detach())
+
+            if self.teacher_query is not None:
+                self.teacher_query.update(data[2], torch.cat(logits_student), logits_teacher)
+
+            with record_phase("optimizer"):
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+
+        train_meters.update({"training_time": train_timer.interval})
+
+    def _split_micro_batches(self, image, target, other_data_dict):
+        accum_steps = self.cfg.SOLVER.ACCUM_STEPS
+        if accum_steps <= 1:
+            return [(image, target, other_data_dict)]
+
+        # NOTE: stateful distillers (eg: CRD's memory bank) are updated per micro-batch
+        def get_chunk(x, i):
+            # split the tensors in nested tuples & dicts, eg: teacher_outputs
+            if isinstance(x, torch.Tensor):
+                return x.chunk(accum_steps)[i]
+            elif isinstance(x, (list, tuple)):
+                return type(x)(get_chunk(v, i) for v in x)
+            elif isinstance(x, dict):
+                return {k: get_chunk(v, i) for k, v in x.items()}
+            return x
+
+        num_chunks = len(image.chunk(accum_steps))
+        return [
+            (get_chunk(image, i), get_chunk(target, i), get_chunk(other_data_dict, i))
+            for i in range(num_chunks)
+        ]
+
+    def _update_train_meters(self, preds, target, loss, losses_dict, batch_size):
+        # collect info: all tensors stay on the device, no host sync here
         acc1, acc5 = accuracy(preds, target, topk=(1, 5))
 
         train_info = self.distiller.module.get_train_info()
-        for key, info in train_info.items():
-            if isinstance(info, torch.Tensor):
-                self.train_info_meters[key].update(
-                    info.item(), batch_size
-                ).all_reduce()
-            else:
-                # for non-tensor info, just update on the local process
-                self.train_info_meters[key].update(info)
-
-        train_meters["losses"].update(loss.tolist(), batch_size).all_reduce()
-        train_meters["top1"].update(acc1.item(), batch_size).all_reduce()
-        train_meters["top5"].update(acc5.item(), batch_size).all_reduce()
+        if self.teacher_query is not None:
+            train_info = {**train_info, **self.teacher_query.get_train_info()}
+        self.train_info_meters.update({
+            key: info for key, info in train_info.items()
+            if isinstance(info, torch.Tensor)
+        }, batch_size)
+        # for non-tensor info, just update on the local process
+        self.train_info_meters.update({
+            key: info for key, info in train_info.items()
+            if not isinstance(info, torch.Tensor)
+        })
 
         # record "loss_ce" & "loss_kd"
-        for name, loss in losses_dict.items():
-            train_meters[name].update(loss.item(), batch_size).all_reduce()
-
-        # print info
+        self.train_meters.update({
+            "losses": loss,
+            "top1": acc1,
+            "top5": acc5,
+            **{name: l.mean() for name, l in losses_dict.items()}
+        }, batch_size)
+
+    def get_train_msg(self, epoch):
+        train_meters = self.train_meters
         msg = "Epoch:{}| Time(data):{:.3f}| Time(train):{:.3f}| Loss:{:.4f}| Top-1:{:.3f}| Top-5:{:.3f}".format(
             epoch,
             train_meters["data_time"].avg,
@@ -253,18 +614,86 @@ class Trainer():
         )
         return msg
 
+    def check_teacher_cache(self, cfg):
+        """
+            Returns: the teacher feature cache of the train loader, or None
+                if the distiller only uses the teacher logits.
+        """
+        cache = self.train_loader.dataset.cache
+        if cache.meta.get("format") == "topk":
+            self.check_topk_teacher_cache(cfg, cache.meta)
+        keys = type(self.distiller.module).get_teacher_feature_keys(cfg)
+        if keys is None:
+            raise ValueError(
+                "TEACHER_CACHE: {} does not declare its teacher features".format(cfg.DISTILLER.TYPE))
+        if len(keys) == 0:
+            return None
+        feature_cache = getattr(self.train_loader.dataset, "feature_cache", None)
+        if feature_cache is None:
+            raise ValueError(
+                "TEACHER_CACHE has no teacher features, {} needs {}".format(cfg.DISTILLER.TYPE, keys))
+        missing_keys = feature_cache.missing_keys(keys)
+        if len(missing_keys) > 0:
+            raise ValueError(
+                "TEACHER_CACHE misses the teacher features {} of {}".format(missing_keys, cfg.DISTILLER.TYPE))
+        return feature_cache
+
+    def check_topk_teacher_cache(self, cfg, meta):
+        # the tail logit only keeps the GDKD partitions (topk of the teacher vs
+        # other) exact, for topk <= the stored topk & at the cache temperature
+        if cfg.DISTILLER.TYPE != "GDKD":
+            raise ValueError(
+                "A topk TEACHER_CACHE only supports GDKD, got {}".format(cfg.DISTILLER.TYPE))
+        if cfg.GDKD.STRATEGY != "best":
+            raise ValueError(
+                "A topk TEACHER_CACHE requires GDKD.STRATEGY best, got {}".format(cfg.GDKD.STRATEGY))
+        if cfg.GDKD.TOPK > meta["topk"]:
+            raise ValueError("GDKD.TOPK {} > the topk {} of TEACHER_CACHE {}".format(
+                cfg.GDKD.TOPK, meta["topk"], cfg.TEACHER_CACHE.PATH))
+        if cfg.GDKD.T != meta["temperature"]:
+            raise ValueError("GDKD.T {} != the temperature {} of TEACHER_CACHE {}".format(
+                cfg.GDKD.T, meta["temperature"], cfg.TEACHER_CACHE.PATH))
+
+    def check_logit_teacher(self, cfg, name):
+        # the teacher outputs of `name` only have the logits
+        keys = type(self.distiller.module).get_teacher_feature_keys(cfg)
+        if keys is None:
+            raise ValueError(
+                "{}: {} does not declare its teacher features".format(name, cfg.DISTILLER.TYPE))
+        if len(keys) > 0:
+            raise ValueError(
+                "{} has no teacher features, {} needs {}".format(name, cfg.DISTILLER.TYPE, keys))
+
+    def _densify_topk_logits(self, values, indices, tail):
+        # the uniform tail for the classes out of the topk
+        num_classes = self.train_loader.dataset.cache.meta["num_classes"]
+        logits = tail.float().unsqueeze(1).repeat(1, num_classes)
+        return logits.scatter_(1, indices.long(), values.float())
+
     def _preprocess_data(self, data) -> dict:
+        # data is already moved to the device and preprocessed by DevicePrefetcher
         if self.cfg.DISTILLER.TYPE == "CRD":
-            image, target, index, contrastive_index = data
-            image = image.float()
-            image = image.cuda()
-            target = target.cuda()
-            index = index.cuda()
-            contrastive_index = contrastive_index.cuda()
-            return image, target, dict(index=index, contrastive_index=contrastive_index)
+            image, target, index, contrastive_index = data[:4]
+            other_data_dict = dict(index=index, contrastive_index=contrastive_index)
+            cached_data = data[4:]
         else:
-            image, target, index = data
-            image = image.float()
-            image = image.cuda()
-            target = target.cuda()
-            return image, target, {}
+            image, target, index = data[:3]
+            other_data_dict = {}
+            cached_data = data[3:]
+        if self.cfg.TEACHER_CACHE.ENABLE:
+            # cached teacher logits (& dequantized features), the teacher forward is skipped
+            feats = {}
+            if self.feature_cache is not None:
+                feats = self.feature_cache.build_features(cached_data[1])
+            logits = cached_data[0]
+            if isinstance(logits, (list, tuple)):
+                # a topk cache: (values, indices, tail), see gdkd_loss_topk
+                other_data_dict["teacher_topk"] = logits
+                logits = self._densify_topk_logits(*logits)
+            other_data_dict["teacher_outputs"] = (logits.float(), feats)
+        elif self.cfg.REGION_LABELS.ENABLE:
+            # the teacher logits pooled over the crop box, the teacher forward is skipped
+            crop_box, logits = cached_data[:2]
+            other_data_dict["crop_box"] = crop_box
+            other_data_dict["teacher_outputs"] = (logits.float(), {})
+        return image, target, other_data_dict
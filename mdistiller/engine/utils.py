@@ -35,7 +35,7 @@ class AverageMeter():
         if not is_distributed():
             return
 
-        if torch.cuda.is_available():
+        if dist.get_backend() == "nccl":
             device = torch.device("cuda")
         else:
             device = torch.device("cpu")
@@ -134,6 +134,12 @@ def get_rank() -> int:
     return dist.get_rank()
 
 
+def get_world_size() -> int:
+    if not is_distributed():
+        return 1
+    return dist.get_world_size()
+
+
 def is_main_process() -> bool:
     return get_rank() == 0
 
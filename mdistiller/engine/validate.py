@@ -2,13 +2,20 @@ import torch
 import torch.nn as nn
 from tqdm import tqdm
 
-from mdistiller.engine.utils import AverageMeter, Timer, accuracy, log_msg
+from mdistiller.engine.utils import Timer, accuracy, log_msg
+from mdistiller.engine.metrics import DeviceMeterGroup
+from mdistiller.engine.device import autocast
 
 
-def validate(val_loader, distiller):
-    eval_time, losses, top1, top5 = [AverageMeter() for _ in range(4)]
+def validate(val_loader, distiller, device=None, memory_format=torch.contiguous_format, metric_sync_freq=20, amp_dtype=None, progress_bar=True):
+    if device is None:
+        device = next(distiller.parameters()).device
+    non_blocking = device.type == "cuda"
+
+    meters = DeviceMeterGroup(device)
     criterion = nn.CrossEntropyLoss()
-    pbar = tqdm(range(len(val_loader)))
+    num_iters = len(val_loader)
+    pbar = tqdm(range(num_iters), disable=not progress_bar)
 
     distiller.eval()
     with torch.no_grad():
@@ -16,22 +23,29 @@ def validate(val_loader, distiller):
             with Timer() as eval_timer:
                 image, target = data[:2]
                 image = image.float()
-                image = image.cuda(non_blocking=True)
-                target = target.cuda(non_blocking=True)
-                output = distiller(image=image)
-                loss = criterion(output, target)
+                image = image.to(device, non_blocking=non_blocking).contiguous(
+                    memory_format=memory_format)
+                target = target.to(device, non_blocking=non_blocking)
+                with autocast(device, amp_dtype):
+                    output = distiller(image=image)
+                loss = criterion(output.float(), target)
                 acc1, acc5 = accuracy(output, target, topk=(1, 5))
                 batch_size = image.size(0)
 
-                losses.update(loss.item(), batch_size).all_reduce()
-                top1.update(acc1.item(), batch_size).all_reduce()
-                top5.update(acc5.item(), batch_size).all_reduce()
+                meters.update({
+                    "losses": loss,
+                    "top1": acc1,
+                    "top5": acc5
+                }, batch_size)
 
             # measure elapsed time
-            eval_time.update(eval_timer.interval)
+            meters.update({"eval_time": eval_timer.interval})
 
-            msg = f"Time(data):{eval_time.avg:.3f}| Top-1:{top1.avg:.3f}| Top-5:{top5.avg:.3f}"
-            pbar.set_description(log_msg(msg, "EVAL"))
+            # NOTE: all ranks must flush at the same iterations under DDP
+            if (idx + 1) % metric_sync_freq == 0 or idx + 1 == num_iters:
+                msg = "Time(data):{:.3f}| Top-1:{:.3f}| Top-5:{:.3f}".format(
+                    meters["eval_time"].avg, meters["top1"].avg, meters["top5"].avg)
+                pbar.set_description(log_msg(msg, "EVAL"))
             pbar.update()
     pbar.close()
-    return top1.avg, top5.avg, losses.avg
\ No newline at end of file
+    return meters["top1"].avg, meters["top5"].avg, meters["losses"].avg
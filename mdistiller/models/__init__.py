@@ -1,6 +1,7 @@
 from .cifar import get_cifar100_model
 from .imagenet import get_imagenet_model
 from .imagenet_pretrain import get_imagenet_pretrained_model
+from .taps import FEATURE_TAPS, set_feature_taps, merge_feature_taps
 
 model_tag_dict = {
     "resnet32x4": "res32x4",
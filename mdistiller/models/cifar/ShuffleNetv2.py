@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from ..taps import build_feats
+
 
 class ShuffleBlock(nn.Module):
     def __init__(self, groups=2):
@@ -179,10 +181,12 @@ class ShuffleNetV2(nn.Module):
         f4 = out
         out = self.linear(out)
 
-        feats = {}
-        feats["feats"] = [f0, f1, f2, f3]
-        feats["preact_feats"] = [f0, f1_pre, f2_pre, f3_pre]
-        feats["pooled_feat"] = f4
+        feats = build_feats(
+            self,
+            feats=[f0, f1, f2, f3],
+            preact_feats=[f0, f1_pre, f2_pre, f3_pre],
+            pooled_feat=f4,
+        )
 
         return out, feats
 
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import math
 
+from ..taps import build_feats
+
 __all__ = ["mobilenetv2_T_w", "mobile_half"]
 
 BN = None
@@ -156,9 +158,11 @@ class MobileNetV2(nn.Module):
         avg = out
         out = self.classifier(out)
 
-        feats = {}
-        feats["feats"] = [f0, f1, f2, f3, f4]
-        feats["pooled_feat"] = avg
+        feats = build_feats(
+            self,
+            feats=[f0, f1, f2, f3, f4],
+            pooled_feat=avg,
+        )
 
         return out, feats
 
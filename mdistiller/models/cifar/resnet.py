@@ -2,6 +2,8 @@ from __future__ import absolute_import
 import torch.nn as nn
 import torch.nn.functional as F
 
+from ..taps import build_feats
+
 
 __all__ = ["resnet"]
 
@@ -198,10 +200,12 @@ class ResNet(nn.Module):
         avg = x.reshape(x.size(0), -1)
         out = self.fc(avg)
 
-        feats = {}
-        feats["feats"] = [f0, f1, f2, f3]
-        feats["preact_feats"] = [f0, f1_pre, f2_pre, f3_pre]
-        feats["pooled_feat"] = avg
+        feats = build_feats(
+            self,
+            feats=[f0, f1, f2, f3],
+            preact_feats=[f0, f1_pre, f2_pre, f3_pre],
+            pooled_feat=avg,
+        )
 
         return out, feats
 
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from ..taps import build_feats
+
 
 class BasicBlock(nn.Module):
     expansion = 1
@@ -182,10 +184,12 @@ class ResNet(nn.Module):
         avg = out.reshape(out.size(0), -1)
         out = self.linear(avg)
 
-        feats = {}
-        feats["feats"] = [f0, f1, f2, f3, f4]
-        feats["preact_feats"] = [f0, f1_pre, f2_pre, f3_pre, f4_pre]
-        feats["pooled_feat"] = avg
+        feats = build_feats(
+            self,
+            feats=[f0, f1, f2, f3, f4],
+            preact_feats=[f0, f1_pre, f2_pre, f3_pre, f4_pre],
+            pooled_feat=avg,
+        )
 
         return out, feats
 
@@ -2,6 +2,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 
+from ..taps import build_feats
+
 
 __all__ = [
     "VGG",
@@ -98,10 +100,12 @@ class VGG(nn.Module):
         f5 = x
         x = self.classifier(x)
 
-        feats = {}
-        feats["feats"] = [f0, f1, f2, f3, f4]
-        feats["preact_feats"] = [f0, f1_pre, f2_pre, f3_pre, f4_pre]
-        feats["pooled_feat"] = f5
+        feats = build_feats(
+            self,
+            feats=[f0, f1, f2, f3, f4],
+            preact_feats=[f0, f1_pre, f2_pre, f3_pre, f4_pre],
+            pooled_feat=f5,
+        )
 
         return x, feats
 
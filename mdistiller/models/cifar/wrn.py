@@ -3,6 +3,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from ..taps import build_feats
+
 
 __all__ = ["wrn"]
 
@@ -142,10 +144,12 @@ class WideResNet(nn.Module):
         f2_pre = self.block3.layer[0].bn1(f2)
         f3_pre = self.bn1(f3)
 
-        feats = {}
-        feats["feats"] = [f0, f1, f2, f3]
-        feats["preact_feats"] = [f0, f1_pre, f2_pre, f3_pre]
-        feats["pooled_feat"] = f4
+        feats = build_feats(
+            self,
+            feats=[f0, f1, f2, f3],
+            preact_feats=[f0, f1_pre, f2_pre, f3_pre],
+            pooled_feat=f4,
+        )
 
         return out, feats
 
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from mdistiller.engine.utils import load_checkpoint
+from ..taps import build_feats
 
 class MobileNetV1(nn.Module):
     def __init__(self, num_classes=1000, **kwargs):
@@ -53,10 +54,13 @@ class MobileNetV1(nn.Module):
         avg = feat5.reshape(-1, 1024)
         out = self.fc(avg)
 
-        feats = {}
-        feats["pooled_feat"] = avg
-        feats["feats"] = [F.relu(feat1), F.relu(feat2), F.relu(feat3), F.relu(feat4)]
-        feats["preact_feats"] = [feat1, feat2, feat3, feat4]
+        feats = build_feats(
+            self,
+            pooled_feat=avg,
+            # the relu copies are only built on demand
+            feats=lambda: [F.relu(feat1), F.relu(feat2), F.relu(feat3), F.relu(feat4)],
+            preact_feats=[feat1, feat2, feat3, feat4],
+        )
         return out, feats
 
     def get_bn_before_relu(self):
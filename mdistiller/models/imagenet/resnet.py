@@ -4,7 +4,7 @@ import math
 import torch.utils.model_zoo as model_zoo
 import torch.nn.functional as F
 
-
+from ..taps import build_feats
 
 
 __all__ = ["ResNet", "resnet18", "resnet34",
@@ -182,16 +182,19 @@ class ResNet(nn.Module):
         avg = x
         out = self.fc(x)
 
-        feats = {}
-        feats["pooled_feat"] = avg
-        feats["feats"] = [
-            F.relu(stem),
-            F.relu(feat1),
-            F.relu(feat2),
-            F.relu(feat3),
-            F.relu(feat4),
-        ]
-        feats["preact_feats"] = [stem, feat1, feat2, feat3, feat4]
+        feats = build_feats(
+            self,
+            pooled_feat=avg,
+            # the relu copies are only built on demand
+            feats=lambda: [
+                F.relu(stem),
+                F.relu(feat1),
+                F.relu(feat2),
+                F.relu(feat3),
+                F.relu(feat4),
+            ],
+            preact_feats=[stem, feat1, feat2, feat3, feat4],
+        )
 
         return out, feats
 
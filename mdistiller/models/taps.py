@@ -0,0 +1,37 @@
+FEATURE_TAPS = ("feats", "preact_feats", "pooled_feat")
+
+
+def set_feature_taps(model, taps):
+    """
+        Select the feature taps returned by model.forward in the feats dict,
+        eg: ["pooled_feat"]; [] returns the logits only (with an empty dict).
+        None: all the taps (default).
+    """
+    if taps is not None:
+        unknown = set(taps) - set(FEATURE_TAPS)
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown feature taps: {sorted(unknown)}")
+        taps = frozenset(taps)
+    model.feature_taps = taps
+    return model
+
+
+def merge_feature_taps(*taps_list):
+    # the union of the taps, eg: for a teacher shared by several distillers
+    if any(taps is None for taps in taps_list):
+        return None
+    return sorted(set().union(*taps_list))
+
+
+def build_feats(model, **taps):
+    """
+        Build the feats dict of model.forward with the requested taps only.
+        A tap can be given as a callable, so that it is only computed on
+        demand, eg: the relu copies of the preact features.
+    """
+    requested = getattr(model, "feature_taps", None)
+    feats = {}
+    for name, value in taps.items():
+        if requested is None or name in requested:
+            feats[name] = value() if callable(value) else value
+    return feats
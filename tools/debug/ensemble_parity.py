@@ -0,0 +1,87 @@
+"""
+Parity & speed of the stacked ensemble teacher (DISTILLER.TEACHERS) vs the
+sequential forwards of its teachers: the aggregated logits & features.
+
+Example:
+    python tools/debug/ensemble_parity.py --teachers resnet32x4 resnet32x4:noaug wrn_40_2
+    python tools/debug/ensemble_parity.py --teachers resnet56 resnet56 resnet56 resnet56 \\
+        DISTILLER.ENSEMBLE.LOGIT_AGG prob
+"""
+import copy
+import time
+import argparse
+
+import torch
+
+from mdistiller.distillers.ensemble import get_ensemble_members, get_ensemble_teacher
+from mdistiller.distillers.teacher import get_parity_errors, get_input_size
+from mdistiller.engine.cfg import CFG
+from mdistiller.engine.utils import log_msg
+from mdistiller.engine.device import setup_device
+
+
+def bench(fn, x, iters):
+    with torch.no_grad():
+        fn(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main(args):
+    cfg = CFG.clone()
+    cfg.DATASET.TYPE = args.dataset
+    cfg.DISTILLER.TEACHERS = args.teachers
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    device = setup_device(cfg)
+    x = torch.randn(args.batch_size, 3, *get_input_size(cfg), device=device)
+
+    teachers = get_ensemble_members(cfg, pretrained=args.pretrained)
+    # randomize the BN statistics, so that the stacked BN buffers are not trivial
+    if not args.pretrained:
+        for teacher in teachers:
+            for m in teacher.modules():
+                if isinstance(m, torch.nn.BatchNorm2d):
+                    m.running_mean.uniform_(-0.5, 0.5)
+                    m.running_var.uniform_(0.5, 2.0)
+    ensemble = get_ensemble_teacher(
+        cfg, teachers=copy.deepcopy(teachers)).to(device)
+    ensemble.eval()
+
+    # the reference: the same teachers, run one by one
+    ref_cfg = cfg.clone()
+    ref_cfg.defrost()
+    ref_cfg.DISTILLER.ENSEMBLE.STACK = False
+    ref_cfg.DISTILLER.ENSEMBLE.CONCURRENT = False
+    ref_cfg.freeze()
+    reference = get_ensemble_teacher(ref_cfg, teachers=teachers).to(device)
+    reference.eval()
+
+    with torch.no_grad():
+        errors = get_parity_errors(ensemble(x), reference(x))
+    max_error = max(errors.values())
+    print(log_msg("max relative error {:.2e} ({}), sequential {:.2f} ms, stacked {:.2f} ms".format(
+        max_error, max(errors, key=errors.get),
+        bench(reference, x, args.iters), bench(ensemble, x, args.iters)),
+        "INFO" if max_error <= args.rtol else "ERROR"))
+    if max_error > args.rtol:
+        raise SystemExit("parity check failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("parity of the stacked ensemble teacher.")
+    parser.add_argument("--dataset", type=str, default="cifar100", choices=["cifar100", "imagenet"])
+    parser.add_argument("--teachers", type=str, nargs="+", required=True)
+    parser.add_argument("--pretrained", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--rtol", type=float, default=1e-4)
+    parser.add_argument("opts", nargs="*")
+    args = parser.parse_args()
+    main(args)
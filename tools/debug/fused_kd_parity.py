@@ -0,0 +1,250 @@
+"""
+Parity & speed of the fused decoupled KD loss (DecoupledKDLoss, used by gdkd_loss
+& dkd_loss) vs the masked log_softmax implementation (`logits - 1000 * mask`):
+the loss values, the high/low losses, the gradients of the student logits, a
+float64 gradcheck of the hand-written backward, and the forward+backward time &
+peak memory. The same for the partition ids of the segment reduction engine
+(partition_kd_loss) vs one masked log_softmax per partition, with 2 to 32
+partitions.
+
+Example:
+    python tools/debug/fused_kd_parity.py
+    python tools/debug/fused_kd_parity.py --batch-size 512 --num-classes 1000 --iters 50
+"""
+import time
+import argparse
+import itertools
+
+import torch
+import torch.nn.functional as F
+
+from mdistiller.distillers.GDKD import gdkd_loss, get_masks
+from mdistiller.distillers.DKD import dkd_loss, _get_gt_mask
+from mdistiller.distillers.utils import kl_div, DecoupledKDLoss, partition_kd_loss
+from mdistiller.engine.utils import log_msg
+
+
+# the masking of the reference implementations
+MASK_MAGNITUDE = 1000.0
+
+
+def cat_mask(t, mask1, mask2):
+    t1 = (t * mask1).sum(dim=1, keepdims=True)
+    t2 = (t * mask2).sum(dim=1, keepdims=True)
+    rt = torch.cat([t1, t2], dim=1)  # [B, 2]
+    return rt
+
+
+def reference_gdkd_loss(logits_student, logits_teacher, target, k, strategy, w0, w1, w2, temperature, kl_type):
+    # the masked implementation before the fused DecoupledKDLoss
+    mask_u1, mask_u2 = get_masks(logits_teacher, k, strategy)
+    soft_logits_student = logits_student / temperature
+    soft_logits_teacher = logits_teacher / temperature
+    p0_student = cat_mask(F.softmax(soft_logits_student, dim=1), mask_u1, mask_u2)
+    p0_teacher = cat_mask(F.softmax(soft_logits_teacher, dim=1), mask_u1, mask_u2)
+    high_loss = F.kl_div(torch.log(p0_student), p0_teacher, reduction="batchmean") * (temperature**2)
+    low_top_loss = kl_div(
+        F.log_softmax(soft_logits_student - MASK_MAGNITUDE * mask_u2, dim=1),
+        F.log_softmax(soft_logits_teacher - MASK_MAGNITUDE * mask_u2, dim=1),
+        temperature, kl_type)
+    low_other_loss = kl_div(
+        F.log_softmax(soft_logits_student - MASK_MAGNITUDE * mask_u1, dim=1),
+        F.log_softmax(soft_logits_teacher - MASK_MAGNITUDE * mask_u1, dim=1),
+        temperature, kl_type)
+    return (
+        w0 * high_loss + w1 * low_top_loss + w2 * low_other_loss,
+        high_loss.detach(),
+        low_top_loss.detach(),
+        low_other_loss.detach()
+    )
+
+
+def reference_dkd_loss(logits_student, logits_teacher, target, alpha, beta, temperature):
+    gt_mask = _get_gt_mask(logits_student, target)
+    other_mask = gt_mask.logical_not()
+    pred_student = cat_mask(F.softmax(logits_student / temperature, dim=1), gt_mask, other_mask)
+    pred_teacher = cat_mask(F.softmax(logits_teacher / temperature, dim=1), gt_mask, other_mask)
+    tckd_loss = (
+        F.kl_div(torch.log(pred_student), pred_teacher, reduction="sum")
+        * (temperature**2) / target.shape[0]
+    )
+    pred_teacher_part2 = F.softmax(logits_teacher / temperature - 1000.0 * gt_mask, dim=1)
+    log_pred_student_part2 = F.log_softmax(logits_student / temperature - 1000.0 * gt_mask, dim=1)
+    nckd_loss = (
+        F.kl_div(log_pred_student_part2, pred_teacher_part2, reduction="sum")
+        * (temperature**2) / target.shape[0]
+    )
+    return alpha * tckd_loss + beta * nckd_loss
+
+
+def reference_partition_kd_loss(logits_student, logits_teacher, partition, w0, weights, temperature, kl_type):
+    # one masked log_softmax per partition
+    soft_logits_student = logits_student / temperature
+    soft_logits_teacher = logits_teacher / temperature
+    masks = [partition == g for g in range(len(weights))]
+    p0_student = torch.stack([
+        (F.softmax(soft_logits_student, dim=1) * mask).sum(1) for mask in masks], dim=1)
+    p0_teacher = torch.stack([
+        (F.softmax(soft_logits_teacher, dim=1) * mask).sum(1) for mask in masks], dim=1)
+    high_loss = F.kl_div(torch.log(p0_student), p0_teacher, reduction="batchmean") * (temperature**2)
+    low_losses = torch.stack([
+        kl_div(
+            F.log_softmax(soft_logits_student - MASK_MAGNITUDE * ~mask, dim=1),
+            F.log_softmax(soft_logits_teacher - MASK_MAGNITUDE * ~mask, dim=1),
+            temperature, kl_type)
+        for mask in masks])
+    loss = w0 * high_loss + (low_losses * low_losses.new_tensor(weights)).sum()
+    return loss, high_loss.detach(), low_losses.detach()
+
+
+def get_partition(logits, num_groups):
+    # random partition ids, without empty partitions
+    partition = torch.randint_like(logits, num_groups, dtype=torch.long)
+    partition[:, :num_groups] = torch.arange(num_groups, device=logits.device)
+    return partition
+
+
+def relative_error(x, ref):
+    return ((x - ref).abs().max() / ref.abs().max().clamp(min=1e-12)).item()
+
+
+def get_inputs(batch_size, num_classes, device, scale=5.0):
+    logits_student = (scale * torch.randn(batch_size, num_classes, device=device)).requires_grad_()
+    logits_teacher = scale * torch.randn(batch_size, num_classes, device=device)
+    # a confident teacher: the tail of each partition is far below its max
+    logits_teacher[:, 0] += 4 * scale
+    target = torch.randint(num_classes, (batch_size,), device=device)
+    return logits_student, logits_teacher, target
+
+
+def compare(fn, ref_fn, logits_student, logits_teacher, target, *args):
+    """
+        Returns: {name: relative error} of the outputs & the student gradients.
+    """
+    outputs = fn(logits_student, logits_teacher, target, *args)
+    ref_outputs = ref_fn(logits_student, logits_teacher, target, *args)
+    if isinstance(outputs, torch.Tensor):
+        outputs, ref_outputs = (outputs,), (ref_outputs,)
+    grad, = torch.autograd.grad(outputs[0], logits_student)
+    ref_grad, = torch.autograd.grad(ref_outputs[0], logits_student)
+    errors = {f"out.{i}": relative_error(x, ref) for i, (x, ref) in enumerate(zip(outputs, ref_outputs))}
+    errors["grad"] = relative_error(grad, ref_grad)
+    return errors
+
+
+def bench(fn, logits_student, *args, iters=20):
+    device = logits_student.device
+
+    def step():
+        loss = fn(logits_student, *args)
+        loss = loss[0] if isinstance(loss, tuple) else loss
+        torch.autograd.grad(loss, logits_student)
+
+    step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = (time.perf_counter() - start) / iters * 1000
+    peak = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == "cuda" else float("nan")
+    return elapsed, peak
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    failed = False
+
+    # float64 gradcheck of the hand-written backward
+    for kl_type in ["forward", "reverse", "both"]:
+        logits_student, logits_teacher, _ = get_inputs(4, 12, device, scale=2.0)
+        logits_student = logits_student.detach().double().requires_grad_()
+        mask, _ = get_masks(logits_teacher, 3)
+        ok = torch.autograd.gradcheck(
+            lambda s: DecoupledKDLoss.apply(s, logits_teacher.double(), mask, 1.0, 2.0, 8.0, 4.0, kl_type)[0],
+            (logits_student,), raise_exception=False)
+        failed |= not ok
+        print(log_msg("gradcheck kl_type={}: {}".format(kl_type, "ok" if ok else "failed"),
+                      "INFO" if ok else "ERROR"))
+
+    # parity with the masked implementation
+    logits_student, logits_teacher, target = get_inputs(args.batch_size, args.num_classes, device)
+    for kl_type, strategy, temperature in itertools.product(
+            ["forward", "reverse", "both"], ["best", "worst"], [1.0, 4.0]):
+        errors = compare(gdkd_loss, reference_gdkd_loss, logits_student, logits_teacher, target,
+                         args.k, strategy, 1.0, 1.0, 8.0, temperature, kl_type)
+        max_error = max(errors.values())
+        failed |= max_error > args.rtol
+        print(log_msg("gdkd kl_type={} strategy={} T={}: max relative error {:.2e} ({})".format(
+            kl_type, strategy, temperature, max_error, max(errors, key=errors.get)),
+            "INFO" if max_error <= args.rtol else "ERROR"))
+    for temperature in [1.0, 4.0]:
+        errors = compare(dkd_loss, reference_dkd_loss, logits_student, logits_teacher, target,
+                         1.0, 8.0, temperature)
+        max_error = max(errors.values())
+        failed |= max_error > args.rtol
+        print(log_msg("dkd T={}: max relative error {:.2e} ({})".format(
+            temperature, max_error, max(errors, key=errors.get)),
+            "INFO" if max_error <= args.rtol else "ERROR"))
+
+    # the segment reduction engine: the partition ids vs the masks
+    for kl_type, num_groups in itertools.product(["forward", "reverse", "both"], [2, 3, 8]):
+        partition = get_partition(logits_teacher, num_groups)
+        weights = [float(g + 1) for g in range(num_groups)]
+        errors = compare(partition_kd_loss, reference_partition_kd_loss,
+                         logits_student, logits_teacher, partition, 1.0, weights, 4.0, kl_type)
+        max_error = max(errors.values())
+        failed |= max_error > args.rtol
+        print(log_msg("partition kl_type={} groups={}: max relative error {:.2e} ({})".format(
+            kl_type, num_groups, max_error, max(errors, key=errors.get)),
+            "INFO" if max_error <= args.rtol else "ERROR"))
+    # the partition ids of 2 partitions vs the fused bool mask
+    mask, _ = get_masks(logits_teacher, args.k)
+    errors = compare(
+        lambda s, t, m, *args: partition_kd_loss(s, t, m.logical_not().long(), *args),
+        partition_kd_loss, logits_student, logits_teacher, mask, 1.0, [1.0, 8.0], 4.0, "both")
+    max_error = max(errors.values())
+    failed |= max_error > args.rtol
+    print(log_msg("partition ids vs fused mask: max relative error {:.2e} ({})".format(
+        max_error, max(errors, key=errors.get)),
+        "INFO" if max_error <= args.rtol else "ERROR"))
+
+    # speed & memory of the forward + backward
+    gdkd_args = (logits_teacher, target, args.k, "best", 1.0, 1.0, 8.0, 4.0, "forward")
+    dkd_args = (logits_teacher, target, 1.0, 8.0, 4.0)
+    for name, fn, ref_fn, fn_args in [
+            ("gdkd", gdkd_loss, reference_gdkd_loss, gdkd_args),
+            ("dkd", dkd_loss, reference_dkd_loss, dkd_args)]:
+        ref_time, ref_peak = bench(ref_fn, logits_student, *fn_args, iters=args.iters)
+        fused_time, fused_peak = bench(fn, logits_student, *fn_args, iters=args.iters)
+        print(log_msg("{} [{}x{}] fwd+bwd: masked {:.3f} ms ({:.1f} MB), fused {:.3f} ms ({:.1f} MB), {:.2f}x".format(
+            name, args.batch_size, args.num_classes, ref_time, ref_peak, fused_time, fused_peak,
+            ref_time / fused_time), "INFO"))
+
+    for num_groups in [2, 3, 8, 32]:
+        partition = get_partition(logits_teacher, num_groups)
+        fn_args = (logits_teacher, partition, 1.0, [1.0] * num_groups, 4.0, "forward")
+        ref_time, ref_peak = bench(reference_partition_kd_loss, logits_student, *fn_args, iters=args.iters)
+        seg_time, seg_peak = bench(partition_kd_loss, logits_student, *fn_args, iters=args.iters)
+        print(log_msg("partition groups={} [{}x{}] fwd+bwd: masked {:.3f} ms ({:.1f} MB), segment {:.3f} ms ({:.1f} MB), {:.2f}x".format(
+            num_groups, args.batch_size, args.num_classes, ref_time, ref_peak, seg_time, seg_peak,
+            ref_time / seg_time), "INFO"))
+
+    if failed:
+        raise SystemExit("parity check failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("parity of the fused decoupled KD loss.")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch-size", type=int, default=512)
+    parser.add_argument("--num-classes", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--rtol", type=float, default=1e-4)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,153 @@
+"""
+KL error of the topk teacher cache (TEACHER_CACHE.FORMAT topk) vs the dense teacher logits.
+
+The dense logits are recomputed by the teacher on the replayed views, and the
+sparse form is either compressed on the fly (TEACHER_CACHE.TOPK/TEMPERATURE) or
+read from an existing cache (--cache). Reports KL(p_dense || p_sparse) over all
+classes and for the GDKD partitions (GDKD.TOPK, GDKD.T): the topk-vs-other
+level, the topk block and the other block.
+
+Example:
+    python tools/debug/teacher_cache_error.py --cfg configs/imagenet/r34_r18/gdkd.yaml \\
+        --num-batches 20 TEACHER_CACHE.TOPK 20 TEACHER_CACHE.TEMPERATURE 1.0
+"""
+import argparse
+from collections import defaultdict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from mdistiller.models import get_model
+from mdistiller.dataset import get_dataset, get_device_normalize
+from mdistiller.dataset.teacher_cache import (
+    open_teacher_cache,
+    compress_topk_logits,
+    densify_topk_logits,
+    get_topk_partitions,
+    get_replay_loader
+)
+from mdistiller.distillers.GDKD import get_masks
+from mdistiller.engine.cfg import CFG as cfg
+from mdistiller.engine.utils import log_msg
+from mdistiller.engine.device import setup_device, configure_dataloader, get_memory_format
+from mdistiller.engine.prefetcher import DevicePrefetcher
+
+
+# the masked partitions of the GDKD loss
+MASK_MAGNITUDE = 1000.0
+
+
+def cat_mask(t, mask1, mask2):
+    t1 = (t * mask1).sum(dim=1, keepdims=True)
+    t2 = (t * mask2).sum(dim=1, keepdims=True)
+    rt = torch.cat([t1, t2], dim=1)  # [B, 2]
+    return rt
+
+
+def kl(log_p, log_q):
+    # KL(p || q) per sample
+    return (log_p.exp() * (log_p - log_q)).sum(dim=1)
+
+
+def partition_errors(logits, logits_sparse, k, temperature):
+    s = logits / temperature
+    s_sparse = logits_sparse / temperature
+    mask_u1, mask_u2 = get_masks(logits, k)
+    errors = {"full": kl(F.log_softmax(s, dim=1), F.log_softmax(s_sparse, dim=1))}
+
+    p0 = cat_mask(F.softmax(s, dim=1), mask_u1, mask_u2)
+    p0_sparse = cat_mask(F.softmax(s_sparse, dim=1), mask_u1, mask_u2)
+    errors["high"] = kl(p0.log(), p0_sparse.log())
+    for name, mask in [("low_top", mask_u2), ("low_other", mask_u1)]:
+        errors[name] = kl(
+            F.log_softmax(s - MASK_MAGNITUDE * mask, dim=1),
+            F.log_softmax(s_sparse - MASK_MAGNITUDE * mask, dim=1))
+    return errors
+
+
+def main(cfg, args):
+    device = setup_device(cfg)
+    memory_format = get_memory_format(cfg, device)
+    train_loader, val_loader, num_data, num_classes = get_dataset(cfg)
+    if not cfg.TEACHER_CACHE.AUGMENT:
+        # the samples of the cache, TEACHER_CACHE.ENABLE is off here
+        train_loader.dataset.transform = val_loader.dataset.transform
+
+    cache = open_teacher_cache(args.cache) if args.cache else None
+    if cache is not None and cache.meta.get("format") != "topk":
+        raise ValueError("{} is not a topk cache".format(args.cache))
+    topk = cache.meta["topk"] if cache else cfg.TEACHER_CACHE.TOPK
+    cache_temperature = cache.meta["temperature"] if cache else cfg.TEACHER_CACHE.TEMPERATURE
+    k, temperature = cfg.GDKD.TOPK, cfg.GDKD.T
+    if k > topk:
+        raise ValueError(f"GDKD.TOPK {k} > TEACHER_CACHE.TOPK {topk}")
+
+    loader = get_replay_loader(
+        train_loader.loader, cfg.TEACHER_CACHE.SEED,
+        cache.num_views if cache else 1, shuffle=False)
+    loader = configure_dataloader(loader, cfg)
+    loader = DevicePrefetcher(
+        loader, device, memory_format, get_device_normalize(cfg))
+    loader.sampler.set_epoch(args.view + 1)
+
+    teacher = get_model(cfg, cfg.DISTILLER.TEACHER, pretrained=True)
+    teacher = teacher.to(device, memory_format=memory_format)
+    teacher.eval()
+
+    errors = defaultdict(list)
+    with torch.no_grad():
+        for i, data in enumerate(loader):
+            if i >= args.num_batches:
+                break
+            image, index = data[0], data[2]
+            logits, _ = teacher(image)
+            logits = logits.float()
+            if cache is None:
+                values, indices, tail = compress_topk_logits(
+                    logits, topk, cache_temperature)
+                # the same precision as the cache
+                values, indices, tail = values.half(), indices.short(), tail.half()
+                logits_sparse = densify_topk_logits(
+                    values, indices, tail, num_classes)
+            else:
+                logits_sparse = torch.stack([
+                    torch.from_numpy(np.array(cache.get(args.view, j)))
+                    for j in index.tolist()]).to(device).float()
+                values = logits_sparse.topk(topk, dim=1).values
+                tail = logits_sparse.min(dim=1).values
+
+            for name, v in partition_errors(logits, logits_sparse, k, temperature).items():
+                errors[name].append(v.cpu())
+            # the partitions computed directly from the sparse form
+            p0_direct, _ = get_topk_partitions(
+                values, tail, num_classes, k, temperature)
+            p0 = cat_mask(F.softmax(logits / temperature, dim=1), *get_masks(logits, k))
+            errors["high_direct"].append(kl(p0.log(), p0_direct.log()).cpu())
+
+    print(log_msg("topk={} (cache T={}), GDKD.TOPK={}, GDKD.T={}, {} samples".format(
+        topk, cache_temperature, k, temperature, len(torch.cat(errors["full"]))), "INFO"))
+    print(log_msg("bytes/sample: dense fp32 {}, dense fp16 {}, topk {}".format(
+        4 * num_classes, 2 * num_classes, 4 * topk + 2), "INFO"))
+    for name, v in errors.items():
+        v = torch.cat(v)
+        print("{:>12}: KL mean {:.3e}, p99 {:.3e}, max {:.3e}".format(
+            name, v.mean().item(), v.quantile(0.99).item(), v.max().item()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("KL error of the topk teacher cache.")
+    parser.add_argument("--cfg", type=str, default="")
+    parser.add_argument("--cache", type=str, default="",
+                        help="existing topk cache, default: compress on the fly")
+    parser.add_argument("--view", type=int, default=0)
+    parser.add_argument("--num-batches", type=int, default=10)
+    parser.add_argument("opts", nargs="*")
+    args = parser.parse_args()
+
+    cfg.merge_from_file(args.cfg)
+    cfg.merge_from_list(args.opts)
+    cfg.TEACHER_CACHE.ENABLE = False
+    cfg.freeze()
+
+    main(cfg, args)
@@ -0,0 +1,94 @@
+"""
+Parity & speed of the inference-optimized teacher (TEACHER.*) vs the eager teacher,
+over the model zoo: logits and all the feature taps (feats, preact_feats, pooled_feat),
+and the BN statistics of `get_bn_before_relu()`.
+
+Example:
+    python tools/debug/teacher_parity.py --dataset cifar100
+    python tools/debug/teacher_parity.py --dataset imagenet --models ResNet34 ResNet50 \\
+        TEACHER.FREEZE script TEACHER.CHANNELS_LAST True
+"""
+import copy
+import time
+import argparse
+
+import torch
+
+from mdistiller.models import get_model
+from mdistiller.models.cifar import cifar100_model_dict
+from mdistiller.models.imagenet import imagenet_model_dict
+from mdistiller.distillers.teacher import prepare_teacher, get_parity_errors, get_input_size
+from mdistiller.engine.cfg import CFG
+from mdistiller.engine.utils import log_msg
+from mdistiller.engine.device import setup_device
+
+
+def bench(model, x, iters):
+    with torch.no_grad():
+        model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            model(x)
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main(args):
+    cfg = CFG.clone()
+    cfg.DATASET.TYPE = args.dataset
+    cfg.merge_from_list(args.opts)
+    # compared below, instead of at the first forward
+    cfg.TEACHER.CHECK_PARITY = False
+    cfg.freeze()
+    device = setup_device(cfg)
+
+    models = args.models or list(
+        cifar100_model_dict if args.dataset == "cifar100" else imagenet_model_dict)
+    x = torch.randn(args.batch_size, 3, *get_input_size(cfg), device=device)
+
+    failed = []
+    for name in models:
+        eager = get_model(cfg, name, pretrained=args.pretrained).to(device)
+        eager.eval()
+        # randomize the BN statistics, so that the folding is not trivial
+        if not args.pretrained:
+            for m in eager.modules():
+                if isinstance(m, torch.nn.BatchNorm2d):
+                    m.running_mean.uniform_(-0.5, 0.5)
+                    m.running_var.uniform_(0.5, 2.0)
+        teacher = prepare_teacher(copy.deepcopy(eager).cpu(), cfg).to(device)
+
+        with torch.no_grad():
+            errors = get_parity_errors(teacher(x), eager(x))
+        if hasattr(eager, "get_bn_before_relu"):
+            for i, (bn, bn_ref) in enumerate(zip(teacher.get_bn_before_relu(), eager.get_bn_before_relu())):
+                errors[f"bn_before_relu.{i}"] = max(
+                    (bn.weight - bn_ref.weight).abs().max().item(),
+                    (bn.bias - bn_ref.bias).abs().max().item())
+        max_error = max(errors.values())
+        ok = max_error <= args.rtol
+        if not ok:
+            failed.append(name)
+        print(log_msg("{:>14}: max relative error {:.2e} ({}), eager {:.2f} ms, optimized {:.2f} ms".format(
+            name, max_error, max(errors, key=errors.get),
+            bench(eager, x, args.iters), bench(teacher, x, args.iters)),
+            "INFO" if ok else "ERROR"))
+
+    if len(failed) > 0:
+        raise SystemExit("parity check failed: {}".format(failed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("parity of the inference-optimized teacher.")
+    parser.add_argument("--dataset", type=str, default="cifar100", choices=["cifar100", "imagenet"])
+    parser.add_argument("--models", type=str, nargs="+", default=None)
+    parser.add_argument("--pretrained", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--rtol", type=float, default=1e-3)
+    parser.add_argument("opts", nargs="*")
+    args = parser.parse_args()
+    main(args)
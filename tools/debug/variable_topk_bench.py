@@ -0,0 +1,125 @@
+"""
+Parity & speed of the vectorized variable-k topk masks (get_topk_mask) and the
+ratio-threshold k selection (calc_topk), used by GDKDAutok & GDKDPerClassK, vs
+the per-row Python loops they replace: the masks & the ks must be identical,
+and the time per step of the k selection + the masks.
+
+Example:
+    python tools/debug/variable_topk_bench.py
+    python tools/debug/variable_topk_bench.py --batch-size 512 --num-classes 1000 --topk-th 50
+"""
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from mdistiller.distillers.utils import get_topk_mask, calc_topk
+from mdistiller.engine.utils import log_msg
+
+
+def reference_get_masks(logits, topks):
+    # the per-row loop before get_topk_mask
+    maxk = topks.max()
+    ranks = torch.topk(logits, maxk, dim=-1,
+                       largest=True,
+                       sorted=True).indices
+    for i in range(logits.shape[0]):
+        ranks[i, topks[i]:] = ranks[i][0]
+    return torch.zeros_like(logits, dtype=torch.bool).scatter_(1, ranks, 1)
+
+
+def reference_calc_topk(probs, topk_th, ratio_th):
+    # the per-row loop before calc_topk, with num_classes instead of 100
+    num_classes = probs.shape[1]
+    x = torch.arange(1, num_classes+1).to(probs.device)
+    probs = probs.sort(dim=1, descending=False).values
+    cumavg = probs.cumsum(dim=1)/x
+    ratio = probs/cumavg
+
+    topk_arr = []
+    for r in ratio:
+        idx = torch.nonzero(r >= ratio_th).squeeze(1)
+        if len(idx):
+            topk = num_classes-idx[0].item()
+        else:
+            topk = 1
+        topk_arr.append(min(topk, topk_th))
+    return torch.as_tensor(topk_arr, device=probs.device)
+
+
+def get_inputs(batch_size, num_classes, device, scale=3.0):
+    logits = scale * torch.randn(batch_size, num_classes, device=device)
+    # a few confident classes per row, so that k varies
+    num_peaks = torch.randint(1, 20, (batch_size, 1), device=device)
+    peaks = torch.arange(num_classes, device=device) < num_peaks
+    return logits + 4 * scale * peaks
+
+
+def bench(fn, *args, device, iters=20):
+    fn(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn(*args)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    failed = False
+
+    logits = get_inputs(args.batch_size, args.num_classes, device)
+    probs = F.softmax(logits / args.temperature, dim=1)
+
+    # parity
+    topks = calc_topk(probs, args.topk_th, args.ratio_th)
+    ref_topks = reference_calc_topk(probs, args.topk_th, args.ratio_th)
+    ok = torch.equal(topks, ref_topks)
+    failed |= not ok
+    print(log_msg("calc_topk: {} (k in [{}, {}])".format(
+        "identical" if ok else "mismatch", int(topks.min()), int(topks.max())),
+        "INFO" if ok else "ERROR"))
+    for max_k in [None, args.topk_th]:
+        mask = get_topk_mask(logits, ref_topks, max_k)
+        ok = torch.equal(mask, reference_get_masks(logits, ref_topks))
+        ok &= torch.equal(mask.sum(1), ref_topks)
+        failed |= not ok
+        print(log_msg("get_topk_mask max_k={}: {}".format(
+            max_k, "identical" if ok else "mismatch"), "INFO" if ok else "ERROR"))
+
+    # speed of a step: the ks of the batch & the masks
+    def step(probs, logits):
+        return get_topk_mask(logits, calc_topk(probs, args.topk_th, args.ratio_th), args.topk_th)
+
+    def ref_step(probs, logits):
+        return reference_get_masks(logits, reference_calc_topk(probs, args.topk_th, args.ratio_th))
+
+    for name, fn, ref_fn, fn_args in [
+            ("calc_topk", calc_topk, reference_calc_topk, (probs, args.topk_th, args.ratio_th)),
+            ("get_topk_mask", get_topk_mask, reference_get_masks, (logits, ref_topks)),
+            ("step", step, ref_step, (probs, logits))]:
+        ref_time = bench(ref_fn, *fn_args, device=device, iters=args.iters)
+        vec_time = bench(fn, *fn_args, device=device, iters=args.iters)
+        print(log_msg("{} [{}x{}]: loop {:.3f} ms, vectorized {:.3f} ms, {:.1f}x".format(
+            name, args.batch_size, args.num_classes, ref_time, vec_time, ref_time / vec_time), "INFO"))
+
+    if failed:
+        raise SystemExit("parity check failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("parity & speed of the variable-k topk masks.")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch-size", type=int, default=512)
+    parser.add_argument("--num-classes", type=int, default=1000)
+    parser.add_argument("--topk-th", type=int, default=50)
+    parser.add_argument("--ratio-th", type=float, default=2.0)
+    parser.add_argument("--temperature", type=float, default=4.0)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+    main(args)
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import torch
 import torch.backends.cudnn as cudnn
 
@@ -7,11 +8,14 @@ from mdistiller.engine import validate
 cudnn.benchmark = True
 
 from mdistiller.distillers import Vanilla
+from mdistiller.distillers.teacher import get_input_size
+from mdistiller.distillers.teacher_quant import quantize_model, QuantizedTeacher
 from mdistiller.models import get_model
 from mdistiller.dataset import get_dataset
 from mdistiller.dataset.imagenet import get_imagenet_val_loader
 from mdistiller.engine.utils import load_checkpoint
 from mdistiller.engine.cfg import CFG as cfg
+from mdistiller.engine.device import setup_device, wrap_distiller
 
 
 def get_val_dataloader(dataset, batch_size):
@@ -30,6 +34,12 @@ if __name__ == "__main__":
     )
     parser.add_argument("--batch_size", type=int, default=64)
     parser.add_argument("--aug_teacher", action="store_true")
+    parser.add_argument("--device", type=str, default="auto",
+                        choices=["auto", "cuda", "cpu"])
+    parser.add_argument("--quant", type=str, default=None,
+                        choices=["fbgemm", "x86", "onednn", "qnnpack"],
+                        help="also evaluate the int8 model (on cpu), calibrated on the train set")
+    parser.add_argument("--calib_batches", type=int, default=200)
     args = parser.parse_args()
 
     if args.dataset == "cifar100_aug":
@@ -42,11 +52,14 @@ if __name__ == "__main__":
 
     cfg.DATASET.TEST.BATCH_SIZE = args.batch_size
     cfg.DISTILLER.TYPE = "NONE"
+    cfg.DEVICE.TYPE = "cpu" if args.quant else args.device
 
 
 
     cfg.freeze()
 
+    device = setup_device(cfg)
+
     if args.ckpt == "pretrain":
         model = get_model(cfg, args.model, pretrained=True)
     else:
@@ -55,8 +68,20 @@ if __name__ == "__main__":
 
     train_loader, val_loader, num_data, num_classes = get_dataset(cfg)
 
+    model.eval()
+    if args.quant:
+        quant_model = QuantizedTeacher(quantize_model(
+            copy.deepcopy(model), train_loader, torch.randn(2, 3, *get_input_size(cfg)),
+            backend=args.quant, num_batches=args.calib_batches))
+
     model = Vanilla(model)
-    model = model.cuda()
-    model = torch.nn.DataParallel(model)
+    model = wrap_distiller(model, cfg, device)
     test_acc, test_acc_top5, test_loss = validate(val_loader, model)
     print(f"test_acc:{test_acc:.4f}, test_acc_top5:{test_acc_top5:.4f}, test_loss:{test_loss:.4f}")
+
+    if args.quant:
+        quant_model = wrap_distiller(Vanilla(quant_model), cfg, device)
+        # the int8 model has no float parameters to infer the device from
+        quant_acc, quant_acc_top5, quant_loss = validate(val_loader, quant_model, device=device)
+        print(f"int8 ({args.quant}) test_acc:{quant_acc:.4f}, test_acc_top5:{quant_acc_top5:.4f}, test_loss:{quant_loss:.4f}")
+        print(f"delta test_acc:{quant_acc - test_acc:+.4f}, test_acc_top5:{quant_acc_top5 - test_acc_top5:+.4f}")
@@ -0,0 +1,120 @@
+"""
+Precompute the spatial teacher logit maps of the train set for REGION_LABELS.
+
+The teacher runs once per image, on the full image resized to
+REGION_LABELS.RESOLUTION: its fc head is applied to each cell of the last feature
+map, average pooled to REGION_LABELS.GRID x GRID cells (see get_region_logits).
+During the training, the teacher logits of each RandomResizedCrop are the map
+pooled over the crop box, so the teacher cost does not grow with the epochs.
+
+REGION_LABELS.FORMAT topk stores only the TOPK logits, their int16 indices and
+one fill logit per cell (~4*TOPK bytes per cell instead of 2*num_classes).
+The map is only for the logit distillers (KD, DKD, GDKD, ...).
+
+Example:
+    python tools/region_labels.py --cfg configs/imagenet/r34_r18/gdkd.yaml \\
+        --output ./output/region_labels/imagenet_res34
+    python tools/train.py --cfg configs/imagenet/r34_r18/gdkd.yaml \\
+        REGION_LABELS.ENABLE True REGION_LABELS.PATH ./output/region_labels/imagenet_res34
+    python tools/region_labels.py --cfg configs/TL/cub2011/r50_mv1/gdkd.yaml \\
+        --output ./output/region_labels/cub2011_res50 \\
+        REGION_LABELS.RESOLUTION 448 REGION_LABELS.GRID 14 REGION_LABELS.FORMAT dense
+"""
+import argparse
+from tqdm import tqdm
+
+import torch
+import torch.backends.cudnn as cudnn
+from torch.utils.data import DataLoader
+
+from mdistiller.models import get_model, set_feature_taps
+from mdistiller.dataset import get_dataset, get_region_map_meta
+from mdistiller.dataset.region_labels import (
+    TeacherRegionMap,
+    get_region_logits,
+    get_region_transform
+)
+from mdistiller.distillers.teacher import get_parity_errors
+from mdistiller.engine.cfg import CFG as cfg
+from mdistiller.engine.utils import log_msg
+from mdistiller.engine.device import (
+    setup_device,
+    configure_dataloader,
+    get_memory_format,
+    get_amp_dtype,
+    autocast
+)
+from mdistiller.engine.prefetcher import DevicePrefetcher
+
+cudnn.benchmark = True
+
+
+def main(cfg, output):
+    device = setup_device(cfg)
+    memory_format = get_memory_format(cfg, device)
+    amp_dtype = get_amp_dtype(cfg, device)
+    if cfg.DATASET.TYPE == "cifar100":
+        raise NotImplementedError("REGION_LABELS requires a RandomResizedCrop dataset")
+    if len(cfg.DISTILLER.TEACHERS) > 0:
+        raise NotImplementedError("REGION_LABELS does not support DISTILLER.TEACHERS")
+
+    train_loader, _, num_data, num_classes = get_dataset(cfg)
+    region_map = TeacherRegionMap.create(
+        output, num_data, num_classes,
+        grid=cfg.REGION_LABELS.GRID,
+        format=cfg.REGION_LABELS.FORMAT,
+        topk=cfg.REGION_LABELS.TOPK if cfg.REGION_LABELS.FORMAT == "topk" else 0,
+        **get_region_map_meta(cfg, num_data, num_classes))
+
+    # the full images of the train set, in order
+    dataset = train_loader.loader.dataset
+    dataset.transform = get_region_transform(
+        dataset.transform, cfg.REGION_LABELS.RESOLUTION)
+    loader = DataLoader(
+        dataset,
+        batch_size=train_loader.loader.batch_size,
+        num_workers=train_loader.loader.num_workers,
+        pin_memory=True,
+        shuffle=False,
+    )
+    loader = configure_dataloader(loader, cfg)
+    loader = DevicePrefetcher(loader, device, memory_format)
+
+    teacher = get_model(cfg, cfg.DISTILLER.TEACHER, pretrained=True)
+    set_feature_taps(teacher, ["feats"])
+    teacher = teacher.to(device, memory_format=memory_format)
+    teacher.eval()
+
+    with torch.no_grad():
+        for idx, data in enumerate(tqdm(loader, desc="region labels")):
+            image, index = data[0], data[2]
+            with autocast(device, amp_dtype):
+                logit_map, logits = get_region_logits(
+                    teacher, image, cfg.REGION_LABELS.GRID)
+            if idx == 0:
+                # the mean of the map over the full image vs the teacher logits
+                errors = get_parity_errors(logit_map.mean((1, 2)), logits.float())
+                print(log_msg("Full image pooling vs teacher logits, max relative error: {:.2e}".format(
+                    max(errors.values())), "INFO"))
+            region_map.write(index.cpu().numpy(), logit_map.cpu().numpy())
+    region_map.finish()
+
+    print(log_msg("Region label map is saved to {}".format(output), "INFO"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("precompute the region teacher logit maps.")
+    parser.add_argument("--cfg", type=str, default="")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("opts", nargs="*")
+    args = parser.parse_args()
+
+    cfg.merge_from_file(args.cfg)
+    cfg.merge_from_list(args.opts)
+    # build the map from the original train set
+    cfg.REGION_LABELS.ENABLE = False
+    cfg.TEACHER_CACHE.ENABLE = False
+    cfg.LOG.WANDB = False
+    cfg.freeze()
+
+    main(cfg, args.output)
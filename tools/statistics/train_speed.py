@@ -1,260 +1,340 @@
-import argparse
+"""
+Training throughput benchmark over distillers x teacher/student pairs x batch sizes.
+
+Each run uses the real `Trainer.train_iter` (incl. AMP & gradient accumulation
+settings from the cfg). By default the data is synthetic and preloaded on the
+device, so the benchmark runs anywhere (incl. cpu-only) and measures the
+distillation step itself; use `--data real` to include the dataloader.
+
+Example:
+    python tools/statistics/train_speed.py --distillers KD DKD GDKD \\
+        --pairs resnet32x4:resnet8x4 --batch-sizes 64 128
+    python tools/statistics/train_speed.py --compare output/benchmark/old.json
+"""
 import os
-import random
-from datetime import datetime
+import json
 import time
-from tqdm import tqdm
+import socket
+import tempfile
+import resource
+import subprocess
+import traceback
+from datetime import datetime
 
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
-import torch.nn as nn
-import torch.optim as optim
 
 from mdistiller.dataset import get_dataset
-from mdistiller.distillers import get_distiller
-# from mdistiller.engine import Trainer
-from mdistiller.engine.cfg import CFG as cfg
-from mdistiller.engine.cfg import dump_cfg, show_cfg
-from mdistiller.engine.utils import log_msg, is_distributed
+from mdistiller.distillers import get_distiller, distiller_dict
+from mdistiller.engine import Trainer
+from mdistiller.engine.cfg import CFG
+from mdistiller.engine.utils import log_msg
+from mdistiller.engine.device import setup_device, wrap_distiller, get_memory_format
+from mdistiller.engine.metrics import DeviceMeterGroup
 
 cudnn.benchmark = True
 
-class Trainer():
-    def __init__(self, experiment_name, distiller, train_loader, val_loader, cfg):
-        self.cfg = cfg
-        self.distiller = distiller
-        self.train_loader = train_loader
-        self.val_loader = val_loader
-        self.optimizer = self.init_optimizer(cfg)
-        self.lr_scheduler = self.init_lr_scheduler(cfg, self.optimizer)
-        self.best_acc = -1
-        self.is_distributed = is_distributed()
-
-        self.enable_progress_bar = cfg.LOG.ENABLE_PROGRESS_BAR
-
-        self.train_meters = None
-        self.train_info_meters = None
-
-    def init_optimizer(self, cfg):
-        if cfg.SOLVER.TYPE == "SGD":
-            optimizer = optim.SGD(
-                self.distiller.module.get_learnable_parameters(),
-                lr=cfg.SOLVER.LR,
-                momentum=cfg.SOLVER.MOMENTUM,
-                weight_decay=cfg.SOLVER.WEIGHT_DECAY,
-                nesterov=cfg.SOLVER.SGD_NESTEROV,
-            )
-        else:
-            raise NotImplementedError(cfg.SOLVER.TYPE)
-        return optimizer
-
-    def init_lr_scheduler(self, cfg, optimizer):
-        if cfg.SOLVER.LR_SCHEDULER == "cosine":
-            lr_scheduler = optim.lr_scheduler.CosineAnnealingLR(
-                optimizer, cfg.SOLVER.EPOCHS, eta_min=cfg.SOLVER.LR_MIN)
-        elif cfg.SOLVER.LR_SCHEDULER == "step":
-            lr_scheduler = optim.lr_scheduler.MultiStepLR(
-                optimizer, cfg.SOLVER.LR_DECAY_STAGES, cfg.SOLVER.LR_DECAY_RATE
-            )
+dataset_info = {
+    # image_size, num_classes, num_data
+    "cifar100": (32, 100, 50000),
+    "imagenet": (224, 1000, 1281167),
+    "tiny-imagenet": (224, 200, 100000),
+    "cub2011": (224, 200, 5994),
+    "dtd": (224, 47, 1880),
+    "food101": (224, 101, 75750),
+}
+
+default_pairs = {
+    "cifar100": ["resnet32x4:resnet8x4", "resnet56:resnet20", "wrn_40_2:wrn_16_2"],
+    "imagenet": ["ResNet34:ResNet18", "ResNet50:MobileNetV1"],
+}
+
+
+def get_git_info():
+    def run(cmd):
+        return subprocess.check_output(
+            cmd, cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    try:
+        return {
+            "commit": run(["git", "rev-parse", "HEAD"]),
+            "dirty": len(run(["git", "status", "--porcelain", "--untracked-files=no"])) > 0,
+        }
+    except Exception:
+        return {"commit": "unknown", "dirty": None}
+
+
+def get_synthetic_batches(cfg, batch_size, device, num_batches=4):
+    """
+        Random batches with the same layout as the dataloaders
+        (after DevicePrefetcher), preloaded on the device.
+    """
+    image_size, num_classes, num_data = dataset_info[cfg.DATASET.TYPE]
+    memory_format = get_memory_format(cfg, device)
+    batches = []
+    for _ in range(num_batches):
+        image = torch.randn(batch_size, 3, image_size, image_size, device=device).contiguous(
+            memory_format=memory_format)
+        target = torch.randint(0, num_classes, (batch_size,), device=device)
+        index = torch.randint(0, num_data, (batch_size,), device=device)
+        if cfg.DISTILLER.TYPE == "CRD":
+            contrastive_index = torch.randint(
+                0, num_data, (batch_size, cfg.CRD.NCE.K + 1), device=device)
+            batches.append([image, target, index, contrastive_index])
         else:
-            raise NotImplementedError(cfg.SOLVER.LR_SCHEDULER.TYPE)
-        return lr_scheduler
-    
-    def _preprocess_data(self, data) -> dict:
-        if self.cfg.DISTILLER.TYPE == "CRD":
-            image, target, index, contrastive_index = data
-            image = image.float()
-            image = image.cuda()
-            target = target.cuda()
-            index = index.cuda()
-            contrastive_index = contrastive_index.cuda()
-            return image, target, dict(index=index, contrastive_index=contrastive_index)
-        else:
-            image, target, index = data
-            image = image.float()
-            image = image.cuda()
-            target = target.cuda()
-            return image, target, {}
-
-class Timer:
-    def __init__(self) -> None:
-        self.time = 0.0
-        self.start_time = 0.0
-        self.end_time = 0.0
-        self.total_time = 0.0
-        self.cnt = 0
-
-    def __enter__(self):
-        self.start_time = time.perf_counter()
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.end_time = time.perf_counter()
-        self.total_time += time.perf_counter() - self.start_time
-        self.cnt += 1
-        self.time = self.total_time / self.cnt
-
-    def __str__(self) -> str:
-        return f"{self.time*1000:.2f}ms"
-
-
-def get_train_speed(trainer, epochs=1):
-    timer = Timer()
-    trainer.distiller.train()
-
-    torch.cuda.synchronize()
-    for epoch in range(0, epochs):
-        with tqdm(total=len(trainer.train_loader), desc=f"Epoch {epoch+1}/{epochs}") as pbar:
-            dataloader=iter(trainer.train_loader)
-            for i in range(len(trainer.train_loader)):
-                with timer:
-                    data = next(dataloader)
-                    image, target, other_data_dict = trainer._preprocess_data(data)
-                    # forward
-                    preds, losses_dict = trainer.distiller(
-                        image=image, target=target, epoch=epoch, **other_data_dict)
-
-                    # backward
-                    loss = sum([l.mean() for l in losses_dict.values()])
-                    loss.backward()
-                    trainer.optimizer.step()
-                pbar.update(1)
-                # pbar.set_description(f'[train speed: {timer}]')
-                pbar.set_postfix_str(f'train speed: {timer}')
-
-
-    print(f'Average train speed per iter: {timer}')
-
-
-
-def get_train_speed2(trainer, epochs=1):
-    timer = Timer()
+            batches.append([image, target, index])
+    return batches
+
+
+def iterate_forever(loader):
+    while True:
+        for data in loader:
+            yield data
+
+
+def build_cfg(base_cfg, distiller_type, teacher, student, batch_size, log_prefix):
+    cfg = base_cfg.clone()
+    cfg.defrost()
+    cfg.DISTILLER.TYPE = distiller_type
+    cfg.DISTILLER.TEACHER = teacher
+    cfg.DISTILLER.STUDENT = student
+    cfg.SOLVER.BATCH_SIZE = batch_size
+    cfg.LOG.PREFIX = log_prefix
+    cfg.LOG.WANDB = False
+    cfg.LOG.ENABLE_PROGRESS_BAR = False
+    cfg.LOG.ASYNC_CHECKPOINT = False
+    cfg.LOG.ASYNC_EVAL = False
+    cfg.LOG.PROFILE.ENABLE = False
+    cfg.freeze()
+    return cfg
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def benchmark(cfg, device, args):
+    """
+        Returns: dict of the measurements of one (distiller, pair, batch_size).
+    """
+    num_data = dataset_info[cfg.DATASET.TYPE][2]
+    if args.data == "real":
+        train_loader, val_loader, num_data, num_classes = get_dataset(
+            cfg, teacher_feature_keys=distiller_dict[cfg.DISTILLER.TYPE].get_teacher_feature_keys(cfg))
+        data_iter = iterate_forever(train_loader)
+    else:
+        # the synthetic batches have no dataset
+        if cfg.TEACHER.QUERY.ENABLE:
+            raise ValueError("TEACHER.QUERY requires --data real")
+        if cfg.TEACHER_CACHE.ENABLE:
+            raise ValueError("TEACHER_CACHE requires --data real")
+        train_loader, val_loader = [], []
+        batches = get_synthetic_batches(cfg, cfg.SOLVER.BATCH_SIZE, device)
+        data_iter = iterate_forever(batches)
+
+    # the teacher weights do not affect the speed
+    distiller = get_distiller(
+        cfg, pretrained_teacher=args.pretrained_teacher, num_data=num_data,
+        train_loader=train_loader if args.data == "real" else None)
+    distiller = wrap_distiller(distiller, cfg, device)
+
+    trainer = Trainer("train_speed", distiller,
+                      train_loader, val_loader, cfg)
+    trainer.checkpoint_writer.close()
+    trainer.train_meters = DeviceMeterGroup(device)
+    trainer.train_info_meters = DeviceMeterGroup(device)
     trainer.distiller.train()
 
-    torch.cuda.synchronize()
-
-    timer_all = Timer()
-    with timer_all:
-        for epoch in range(0, epochs):
-            with tqdm(total=len(trainer.train_loader), desc=f"Epoch {epoch+1}/{epochs}") as pbar:
-                dataloader=iter(trainer.train_loader)
-                for i in range(len(trainer.train_loader)):
-                    with timer:
-                        data = next(dataloader)
-                        image, target, other_data_dict = trainer._preprocess_data(data)
-                        # forward
-                        preds, losses_dict = trainer.distiller(
-                            image=image, target=target, epoch=epoch, **other_data_dict)
-
-                        # backward
-                        loss = sum([l.mean() for l in losses_dict.values()])
-                        loss.backward()
-                        trainer.optimizer.step()
-                    pbar.update(1)
-                    # pbar.set_description(f'[train speed: {timer}]')
-                    pbar.set_postfix_str(f'train speed: {timer}')
-        torch.cuda.synchronize()
-
-    print(f'Average train speed per iter: {timer}')
-    avg_time=timer_all.time/(epochs*len(trainer.train_loader))
-    print(f'Average train speed per iter (all): {avg_time*1000:.2f}ms')
-
-def main(cfg, epochs, opts):
-    experiment_name = cfg.EXPERIMENT.NAME
-    if experiment_name == "":
-        experiment_name = cfg.EXPERIMENT.TAG
-    tags = cfg.EXPERIMENT.TAG.split(",")
-    if opts:
-        addtional_tags = ["{}:{}".format(k, v)
-                          for k, v in zip(opts[::2], opts[1::2])]
-        tags += addtional_tags
-        experiment_name += "|"+",".join(addtional_tags)
-
-    # cfg & loggers
-    # show_cfg(cfg)
-    # init dataloader & models
-    train_loader, val_loader, num_data, num_classes = get_dataset(cfg)
-
-    distiller = get_distiller(cfg, num_data=num_data)
-
-    if cfg.DISTILLER.TYPE != "NONE":
-        print(
-            log_msg(
-                "Extra parameters of {}: {}\033[0m".format(
-                    cfg.DISTILLER.TYPE, distiller.get_extra_parameters()
-                ),
-                "INFO",
-            )
-        )
-
-    # backward compatibility for `.module`:
-    # We recommend to use one GPU since DP is deprecated:
-    # https://github.com/pytorch/pytorch/issues/65936
-    distiller = torch.nn.DataParallel(distiller.cuda())
-
-    if int(os.environ.get("USE_TORCH_COMPILE", "0")):
-        # require torch>=2.0
-        print(log_msg("Enable torch.compile", "INFO"))
-        distiller = torch.compile(distiller, mode="reduce-overhead")
-
-    # Test training
-    print(f'Start test {experiment_name}')
-    experiment_name = "train_speed"
-
-    experiment_name = experiment_name + \
-        f'_{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}'
-
-    trainer = Trainer(
-        experiment_name, distiller, train_loader, val_loader, cfg
-    )
-
-    # get_train_speed2(trainer, epochs=epochs)
-
-    print("="*10)
-
-
-def setup_cfg(args):
-    cfg.merge_from_file(args.cfg)
-    cfg.merge_from_list(args.opts)
-
-    if cfg.DATASET.ENHANCE_AUGMENT:
-        cfg.EXPERIMENT.TAG += ",aug"
-
-    if args.suffix != "":
-        cfg.EXPERIMENT.TAG += ","+args.suffix
-
-    if args.data_workers is not None:
-        cfg.DATASET.NUM_WORKERS = int(args.data_workers)
-
-    if args.seed is not None:
-        seed = args.seed
-        torch.manual_seed(seed)
-        torch.cuda.manual_seed(seed)
-        np.random.seed(seed)
-        random.seed(seed)
-        cfg.EXPERIMENT.TAG += ",seed_"+str(seed)
+    if trainer.teacher_pipeline is not None:
+        # TEACHER.PIPELINE: the teacher of the next batch overlaps with the step
+        data_iter = trainer.teacher_pipeline.iterate(data_iter, device)
+
+    def train_iter():
+        data = next(data_iter)
+        teacher_outputs = None
+        if trainer.teacher_pipeline is not None:
+            data, teacher_outputs = data
+        trainer.train_iter(data, epoch=args.epoch, teacher_outputs=teacher_outputs)
+
+    # warmup, incl. cudnn autotuning & allocator warmup
+    for i in range(args.warmup):
+        train_iter()
+    sync(device)
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        # time each step with events, without host syncs between steps
+        events = [torch.cuda.Event(enable_timing=True)
+                  for _ in range(args.iters + 1)]
+
+    step_times = []
+    start = time.perf_counter()
+    if device.type == "cuda":
+        events[0].record()
+    for i in range(args.iters):
+        step_start = time.perf_counter()
+        train_iter()
+        if device.type == "cuda":
+            events[i + 1].record()
+        else:
+            step_times.append((time.perf_counter() - step_start) * 1000)
+    sync(device)
+    total_time = time.perf_counter() - start
+
+    if device.type == "cuda":
+        step_times = [events[i].elapsed_time(events[i + 1])
+                      for i in range(args.iters)]
+
+    result = {
+        "images_per_sec": args.iters * cfg.SOLVER.BATCH_SIZE / total_time,
+        "latency_ms": {
+            "mean": float(np.mean(step_times)),
+            "p50": float(np.percentile(step_times, 50)),
+            "p90": float(np.percentile(step_times, 90)),
+            "p99": float(np.percentile(step_times, 99)),
+        },
+        "extra_parameters": trainer.distiller.module.get_extra_parameters(),
+    }
+    if device.type == "cuda":
+        result["peak_mem_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+    else:
+        # process-wide high-water mark
+        result["peak_rss_mb"] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 2**10
+    if trainer.teacher_pipeline is not None:
+        trainer.teacher_pipeline.shutdown()
+    return result
+
+
+def compare(results, old_path):
+    with open(old_path, "r") as f:
+        old = json.load(f)
+
+    def key(r):
+        return (r["distiller"], r["teacher"], r["student"], r["batch_size"])
+
+    old_results = {key(r): r for r in old["results"] if r["status"] == "ok"}
+    print(log_msg("Compare with {} (commit {})".format(
+        old_path, old["meta"]["git"]["commit"]), "INFO"))
+    for r in results:
+        if r["status"] != "ok" or key(r) not in old_results:
+            continue
+        r_old = old_results[key(r)]
+        print("{:>14} {:>24} bs={:<4}: {:10.1f} -> {:10.1f} img/s ({:+.1%})".format(
+            r["distiller"], "{}->{}".format(r["teacher"], r["student"]), r["batch_size"],
+            r_old["images_per_sec"], r["images_per_sec"],
+            r["images_per_sec"] / r_old["images_per_sec"] - 1))
+
+
+def main(args):
+    if args.experimental:
+        import mdistiller.distillers.experimental as experimental
 
-    cfg.freeze()
+    base_cfg = CFG.clone()
+    if args.cfg:
+        base_cfg.merge_from_file(args.cfg)
+    base_cfg.merge_from_list(args.opts)
+    base_cfg.freeze()
+
+    device = setup_device(base_cfg)
+
+    distillers = args.distillers or list(distiller_dict.keys())
+    pairs = args.pairs or default_pairs.get(base_cfg.DATASET.TYPE, [])
+
+    results = []
+    with tempfile.TemporaryDirectory() as log_prefix:
+        for distiller_type in distillers:
+            for pair in pairs:
+                teacher, student = pair.split(":")
+                for batch_size in args.batch_sizes:
+                    cfg = build_cfg(base_cfg, distiller_type,
+                                    teacher, student, batch_size, log_prefix)
+                    record = {
+                        "distiller": distiller_type,
+                        "teacher": teacher,
+                        "student": student,
+                        "batch_size": batch_size,
+                    }
+                    try:
+                        record.update(benchmark(cfg, device, args))
+                        record["status"] = "ok"
+                        print(log_msg("{:>14} {:>24} bs={:<4}: {:10.1f} img/s, p50 {:.2f} ms, p99 {:.2f} ms".format(
+                            distiller_type, pair, batch_size, record["images_per_sec"],
+                            record["latency_ms"]["p50"], record["latency_ms"]["p99"]), "TRAIN"))
+                    except Exception as e:
+                        # eg: unsupported pair, prebuild on the real dataset, OOM
+                        record["status"] = "error"
+                        record["error"] = "{}: {}".format(type(e).__name__, e)
+                        print(log_msg("{:>14} {:>24} bs={:<4}: {}".format(
+                            distiller_type, pair, batch_size, record["error"]), "ERROR"))
+                        if args.verbose:
+                            traceback.print_exc()
+                    results.append(record)
+                    if device.type == "cuda":
+                        torch.cuda.empty_cache()
+
+    git_info = get_git_info()
+    output = {
+        "meta": {
+            "git": git_info,
+            "date": datetime.now().isoformat(),
+            "host": socket.gethostname(),
+            "torch": torch.__version__,
+            "device": str(device),
+            "device_name": torch.cuda.get_device_name(device) if device.type == "cuda" else "cpu",
+            "num_threads": torch.get_num_threads(),
+            "dataset": base_cfg.DATASET.TYPE,
+            "data": args.data,
+            "warmup": args.warmup,
+            "iters": args.iters,
+            "amp": base_cfg.SOLVER.AMP.ENABLE,
+            "accum_steps": base_cfg.SOLVER.ACCUM_STEPS,
+            "opts": args.opts,
+        },
+        "results": results,
+    }
+
+    output_path = args.output
+    if output_path is None:
+        output_path = os.path.join(
+            "output", "benchmark", "train_speed_{}_{}.json".format(
+                git_info["commit"][:8], datetime.now().strftime("%Y-%m-%d-%H-%M-%S")))
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(output, f, indent=4)
+    print(log_msg("Results are saved to {}".format(output_path), "INFO"))
+
+    if args.compare:
+        compare(results, args.compare)
 
 
-# for training with original python reqs
 if __name__ == "__main__":
     import argparse
 
-    parser = argparse.ArgumentParser("training for knowledge distillation.")
-    parser.add_argument("--cfg", type=str, default="")
-    parser.add_argument("--suffix", type=str, nargs="?", default="", const="")
-    parser.add_argument("--seed", type=int)
-    parser.add_argument("--epochs", type=int, default=1)
-    parser.add_argument("--data_workers", type=int, default=None)
+    parser = argparse.ArgumentParser("training throughput benchmark.")
+    parser.add_argument("--cfg", type=str, default="",
+                        help="base cfg, eg: DATASET.TYPE, DEVICE & SOLVER.AMP")
+    parser.add_argument("--distillers", type=str, nargs="+", default=None,
+                        help="keys of distiller_dict, default: all")
+    parser.add_argument("--pairs", type=str, nargs="+", default=None,
+                        help="teacher:student pairs")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[64])
+    parser.add_argument("--data", type=str, choices=["synthetic", "real"], default="synthetic")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--epoch", type=int, default=1000,
+                        help="epoch passed to the distillers, default: after the warmup of losses")
+    parser.add_argument("--pretrained-teacher", action="store_true",
+                        help="load the teacher weights (not needed for speed)")
+    parser.add_argument("--experimental", action="store_true",
+                        help="include the experimental distillers")
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--compare", type=str, default=None,
+                        help="previous json results to compare with")
+    parser.add_argument("--verbose", action="store_true")
     parser.add_argument("opts", nargs="*")
 
     args = parser.parse_args()
-
-    if os.environ.get("KD_EXPERIMENTAL", "0") == "1":
-        import mdistiller.distillers.experimental as experimental
-
-    setup_cfg(args)
-
-    main(cfg, args.epochs, args.opts)
+    main(args)
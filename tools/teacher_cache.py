@@ -0,0 +1,187 @@
+"""
+Precompute the teacher logits of the train set for TEACHER_CACHE.
+
+The augmentations of each sample are seeded by (TEACHER_CACHE.SEED, view, index),
+and the training replays exactly the same views: epoch e uses the view
+(e-1) % NUM_VIEWS, eg: NUM_VIEWS=SOLVER.EPOCHS gives each epoch its own
+augmentations, as in the online training.
+
+TEACHER_CACHE.FORMAT topk stores only the TOPK logits, their int16 indices and
+one tail logit per sample (~4*TOPK bytes instead of 2*num_classes), see
+tools/debug/teacher_cache_error.py for the KL error vs the dense logits. It is
+only exact for the GDKD partitions: the training requires GDKD with GDKD.TOPK <=
+TEACHER_CACHE.TOPK and GDKD.T == TEACHER_CACHE.TEMPERATURE.
+
+For the feature distillers, the teacher features they use (see
+Distiller.get_teacher_feature_keys) are also cached in `features/`, quantized to
+TEACHER_CACHE.FEATURE_DTYPE. The cache is specific to the distiller (& its cfg,
+eg: FITNET.HINT_LAYER). TEACHER_CACHE.AUGMENT False caches the un-augmented samples.
+
+Example:
+    python tools/teacher_cache.py --cfg configs/cifar100/kd.yaml \\
+        --output ./output/teacher_cache/cifar100_res32x4 TEACHER_CACHE.NUM_VIEWS 240
+    python tools/train.py --cfg configs/cifar100/kd.yaml \\
+        TEACHER_CACHE.ENABLE True TEACHER_CACHE.PATH ./output/teacher_cache/cifar100_res32x4
+    python tools/teacher_cache.py --cfg configs/cifar100/fitnet.yaml \\
+        --output ./output/teacher_cache/cifar100_res32x4_fitnet TEACHER_CACHE.AUGMENT False
+    python tools/teacher_cache.py --cfg configs/imagenet/r34_r18/gdkd.yaml \\
+        --output ./output/teacher_cache/imagenet_res34 \\
+        TEACHER_CACHE.FORMAT topk TEACHER_CACHE.TOPK 20 TEACHER_CACHE.TEMPERATURE 1.0
+"""
+import os
+import argparse
+from tqdm import tqdm
+
+import torch
+import torch.backends.cudnn as cudnn
+
+from mdistiller.models import set_feature_taps
+from mdistiller.dataset import get_dataset, get_teacher_cache_meta, get_device_normalize
+from mdistiller.dataset.teacher_cache import (
+    TeacherLogitCache,
+    TopKTeacherLogitCache,
+    TeacherFeatureCache,
+    open_teacher_cache,
+    compress_topk_logits,
+    resolve_feature_keys,
+    get_feature,
+    get_replay_loader
+)
+from mdistiller.distillers import distiller_dict
+from mdistiller.distillers.ensemble import get_teacher
+from mdistiller.engine.cfg import CFG as cfg
+from mdistiller.engine.utils import log_msg
+from mdistiller.engine.device import (
+    setup_device,
+    configure_dataloader,
+    get_memory_format,
+    get_amp_dtype,
+    autocast
+)
+from mdistiller.engine.prefetcher import DevicePrefetcher
+
+cudnn.benchmark = True
+
+
+def main(cfg, output, resume=False):
+    device = setup_device(cfg)
+    memory_format = get_memory_format(cfg, device)
+    amp_dtype = get_amp_dtype(cfg, device)
+
+    train_loader, val_loader, num_data, num_classes = get_dataset(cfg)
+    if not cfg.TEACHER_CACHE.AUGMENT:
+        # cache the un-augmented samples, TEACHER_CACHE.ENABLE is off here
+        train_loader.dataset.transform = val_loader.dataset.transform
+    num_views = cfg.TEACHER_CACHE.NUM_VIEWS
+    meta = get_teacher_cache_meta(cfg, num_data, num_classes)
+    feature_meta = dict(meta)
+
+    cache_format = cfg.TEACHER_CACHE.FORMAT
+    if cache_format == "topk":
+        cache_cls = TopKTeacherLogitCache
+        meta.update(topk=cfg.TEACHER_CACHE.TOPK,
+                    temperature=cfg.TEACHER_CACHE.TEMPERATURE)
+    elif cache_format == "dense":
+        cache_cls = TeacherLogitCache
+    else:
+        raise ValueError(f"Unknown TEACHER_CACHE.FORMAT: {cache_format}")
+
+    if resume and os.path.exists(os.path.join(output, TeacherLogitCache.meta_file)):
+        cache = open_teacher_cache(output, mode="r+")
+        for k, v in dict(format=cache_format, num_views=num_views, **meta).items():
+            if cache.meta.get(k) != v:
+                raise ValueError(
+                    "Can not resume {}: {}={}, expected {}".format(output, k, cache.meta.get(k), v))
+    else:
+        cache = cache_cls.create(
+            output, num_views, num_data, num_classes, **meta)
+
+    feature_keys = distiller_dict[cfg.DISTILLER.TYPE].get_teacher_feature_keys(cfg)
+    if feature_keys is None:
+        raise ValueError("{} does not declare its teacher features".format(cfg.DISTILLER.TYPE))
+    feature_path = os.path.join(output, "features")
+    feature_cache = None
+    if len(feature_keys) > 0 and resume and os.path.exists(
+            os.path.join(feature_path, TeacherFeatureCache.meta_file)):
+        feature_cache = TeacherFeatureCache(feature_path, mode="r+")
+        missing_keys = feature_cache.missing_keys(feature_keys)
+        if len(missing_keys) > 0:
+            raise ValueError("Can not resume {}: missing teacher features {}".format(
+                feature_path, missing_keys))
+
+    def is_finished(view):
+        if view not in cache.meta["finished_views"]:
+            return False
+        if len(feature_keys) > 0:
+            return feature_cache is not None and view in feature_cache.meta["finished_views"]
+        return True
+
+    # the same loader as training, but in order
+    loader = get_replay_loader(
+        train_loader.loader, cfg.TEACHER_CACHE.SEED, num_views, shuffle=False)
+    loader = configure_dataloader(loader, cfg)
+    loader = DevicePrefetcher(
+        loader, device, memory_format, get_device_normalize(cfg))
+
+    teacher = get_teacher(cfg, pretrained=True)
+    # only build the teacher features to cache
+    set_feature_taps(teacher, distiller_dict[cfg.DISTILLER.TYPE].get_feature_taps(cfg)[1])
+    teacher = teacher.to(device, memory_format=memory_format)
+    teacher.eval()
+
+    for view in range(num_views):
+        if is_finished(view):
+            continue
+        loader.sampler.set_epoch(view + 1)
+        with torch.no_grad():
+            for data in tqdm(loader, desc="view {}/{}".format(view + 1, num_views)):
+                image, index = data[0], data[2]
+                with autocast(device, amp_dtype):
+                    logits, feats = teacher(image)
+                index = index.cpu().numpy()
+                if cache_format == "topk":
+                    # compress on the device, only the sparse form is copied back
+                    values, topk_indices, tail = compress_topk_logits(
+                        logits, cache.meta["topk"], cache.meta["temperature"])
+                    cache.write_sparse(view, index, values.cpu().numpy(),
+                                       topk_indices.cpu().numpy(), tail.cpu().numpy())
+                else:
+                    cache.write(view, index, logits.float().cpu().numpy())
+
+                if len(feature_keys) > 0:
+                    if feature_cache is None:
+                        # the feature shapes are known after the first batch
+                        list_lens = {k: len(v) for k, v in feats.items() if isinstance(v, list)}
+                        keys = resolve_feature_keys(feature_keys, list_lens)
+                        feature_cache = TeacherFeatureCache.create(
+                            feature_path, num_views, num_data, keys,
+                            shapes={k: list(get_feature(feats, k).shape[1:]) for k in keys},
+                            list_lens=list_lens,
+                            dtype=cfg.TEACHER_CACHE.FEATURE_DTYPE,
+                            chunk_size=cfg.TEACHER_CACHE.CHUNK_SIZE,
+                            **feature_meta)
+                    feature_cache.write(view, index, feats)
+        cache.finish_view(view)
+        if feature_cache is not None:
+            feature_cache.finish_view(view)
+
+    print(log_msg("Teacher cache is saved to {}".format(output), "INFO"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("precompute the teacher logits.")
+    parser.add_argument("--cfg", type=str, default="")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the finished views of an existing cache")
+    parser.add_argument("opts", nargs="*")
+    args = parser.parse_args()
+
+    cfg.merge_from_file(args.cfg)
+    cfg.merge_from_list(args.opts)
+    # build the cache from the original train loader
+    cfg.TEACHER_CACHE.ENABLE = False
+    cfg.LOG.WANDB = False
+    cfg.freeze()
+
+    main(cfg, args.output, args.resume)
@@ -0,0 +1,126 @@
+"""
+Report of the int8 teacher (TEACHER.QUANT) vs the fp32 teacher for a teacher/student
+pair (cfg), on cpu: the teacher accuracy delta, the error of the logits and of the
+feature taps used by the distiller, and the drift of the distillation losses.
+
+Example:
+    python -m tools.teacher_quant_report --cfg configs/cifar100/gdkd.yaml
+    # with a trained student
+    python -m tools.teacher_quant_report --cfg configs/cifar100/kd.yaml \\
+        --student_ckpt output/.../student_best.pth TEACHER.QUANT.BACKEND onednn
+"""
+import copy
+import argparse
+from collections import defaultdict
+
+import torch
+import torch.nn.functional as F
+
+from mdistiller.dataset import get_dataset
+from mdistiller.distillers import get_distiller, Vanilla
+from mdistiller.distillers.teacher import get_input_size, get_parity_errors
+from mdistiller.distillers.teacher_quant import quantize_model, QuantizedTeacher
+from mdistiller.engine import validate
+from mdistiller.engine.cfg import CFG as cfg
+from mdistiller.engine.utils import log_msg, load_checkpoint
+from mdistiller.engine.device import setup_device, wrap_distiller
+
+
+def get_batch_kwargs(cfg, data):
+    # as Trainer._preprocess_data
+    image, target = data[:2]
+    kwargs = dict(image=image, target=target, epoch=cfg.SOLVER.EPOCHS)
+    if cfg.DISTILLER.TYPE == "CRD":
+        kwargs.update(index=data[2], contrastive_index=data[3])
+    return kwargs
+
+
+def kl_div(logits, ref_logits, temperature):
+    return F.kl_div(
+        F.log_softmax(logits / temperature, dim=1),
+        F.log_softmax(ref_logits / temperature, dim=1),
+        reduction="batchmean", log_target=True,
+    ).item() * temperature**2
+
+
+def main(cfg, args):
+    device = setup_device(cfg)
+    train_loader, val_loader, num_data, num_classes = get_dataset(cfg)
+    distiller = get_distiller(cfg, num_data=num_data)
+    if args.student_ckpt:
+        distiller.student.load_state_dict(load_checkpoint(args.student_ckpt)["model"])
+    teacher = distiller.teacher
+    teacher.eval()
+    quant_teacher = QuantizedTeacher(quantize_model(
+        copy.deepcopy(teacher), train_loader, torch.randn(2, 3, *get_input_size(cfg)),
+        backend=cfg.TEACHER.QUANT.BACKEND, num_batches=cfg.TEACHER.QUANT.CALIB_BATCHES))
+
+    # teacher accuracy
+    acc, acc_top5, _ = validate(
+        val_loader, wrap_distiller(Vanilla(teacher), cfg, device), device=device)
+    quant_acc, quant_acc_top5, _ = validate(
+        val_loader, wrap_distiller(Vanilla(quant_teacher), cfg, device), device=device)
+
+    # output error & loss drift, on the train batches after the calibration ones
+    distiller.eval()
+    errors = defaultdict(float)
+    losses = defaultdict(float)
+    quant_losses = defaultdict(float)
+    num_batches = 0
+    with torch.no_grad():
+        for idx, data in enumerate(train_loader):
+            if idx < cfg.TEACHER.QUANT.CALIB_BATCHES:
+                continue
+            if num_batches >= args.batches:
+                break
+            kwargs = get_batch_kwargs(cfg, data)
+            outputs = teacher(kwargs["image"])
+            quant_outputs = quant_teacher(kwargs["image"])
+            for k, v in get_parity_errors(quant_outputs, outputs).items():
+                errors[k] = max(errors[k], v)
+            errors["kl(fp32||int8)"] += kl_div(quant_outputs[0], outputs[0], args.T)
+            for k, v in distiller.forward_train(teacher_outputs=outputs, **kwargs)[1].items():
+                losses[k] += v.mean().item()
+            for k, v in distiller.forward_train(teacher_outputs=quant_outputs, **kwargs)[1].items():
+                quant_losses[k] += v.mean().item()
+            num_batches += 1
+    if num_batches == 0:
+        raise ValueError("No train batches left after the calibration batches")
+    errors["kl(fp32||int8)"] /= num_batches
+
+    print(log_msg("{} -> {} ({}), int8 backend: {}".format(
+        cfg.DISTILLER.TEACHER, cfg.DISTILLER.STUDENT, cfg.DISTILLER.TYPE,
+        cfg.TEACHER.QUANT.BACKEND), "INFO"))
+    print(log_msg("Teacher Top-1: fp32 {:.3f}, int8 {:.3f} ({:+.3f}); Top-5: fp32 {:.3f}, int8 {:.3f} ({:+.3f})".format(
+        acc, quant_acc, quant_acc - acc, acc_top5, quant_acc_top5, quant_acc_top5 - acc_top5), "INFO"))
+    print(log_msg("Teacher output errors (max relative error, mean KL at T={}): {}".format(
+        args.T, ", ".join("{}: {:.2e}".format(k, v) for k, v in errors.items())), "INFO"))
+    for k in losses:
+        loss, quant_loss = losses[k] / num_batches, quant_losses[k] / num_batches
+        print(log_msg("{}: fp32 {:.5f}, int8 {:.5f}, drift {:+.5f} ({:+.2%})".format(
+            k, loss, quant_loss, quant_loss - loss,
+            (quant_loss - loss) / max(abs(loss), 1e-12)), "INFO"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("int8 teacher report.")
+    parser.add_argument("--cfg", type=str, default="")
+    parser.add_argument("--student_ckpt", type=str, default="",
+                        help="a checkpoint of the student, else at the initialization")
+    parser.add_argument("--batches", type=int, default=50,
+                        help="train batches to measure the loss drift")
+    parser.add_argument("--T", type=float, default=4.0)
+    parser.add_argument("opts", nargs="*")
+    args = parser.parse_args()
+
+    cfg.merge_from_file(args.cfg)
+    cfg.merge_from_list(args.opts)
+    cfg.DEVICE.TYPE = "cpu"
+    # the int8 teacher is built here, next to the fp32 one
+    cfg.TEACHER.QUANT.ENABLE = False
+    cfg.TEACHER.OPTIMIZE = False
+    cfg.TEACHER.SERVER.ENABLE = False
+    cfg.TEACHER_CACHE.ENABLE = False
+    cfg.freeze()
+
+    main(cfg, args)
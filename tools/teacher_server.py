@@ -0,0 +1,54 @@
+"""
+Local teacher server: one process holds the teacher (DISTILLER.TEACHER) and serves
+the training processes started with TEACHER.SERVER.ENABLE True, eg: the runs of
+`train_dist.py --num_tests 5 --teacher_server`.
+
+Example:
+    python -m tools.teacher_server --cfg configs/cifar100/gdkd.yaml &
+    python -m tools.train --cfg configs/cifar100/gdkd.yaml TEACHER.SERVER.ENABLE True
+"""
+import argparse
+
+import torch.backends.cudnn as cudnn
+
+from mdistiller.distillers.ensemble import get_teacher
+from mdistiller.distillers.teacher import prepare_teacher
+from mdistiller.distillers.teacher_server import TeacherServer, get_server_meta
+from mdistiller.engine.cfg import CFG as cfg
+from mdistiller.engine.device import setup_device, get_memory_format, get_amp_dtype
+
+cudnn.benchmark = True
+
+
+def main(cfg):
+    device = setup_device(cfg)
+    teacher = get_teacher(cfg, pretrained=True)
+    if cfg.TEACHER.OPTIMIZE:
+        teacher = prepare_teacher(teacher, cfg)
+    teacher = teacher.to(device, memory_format=get_memory_format(cfg, device))
+    teacher.eval()
+
+    server = TeacherServer(
+        teacher,
+        device,
+        get_server_meta(cfg),
+        cfg.TEACHER.SERVER.ADDRESS,
+        cfg.TEACHER.SERVER.AUTHKEY,
+        amp_dtype=get_amp_dtype(cfg, device),
+        max_batch_size=cfg.TEACHER.SERVER.MAX_BATCH_SIZE,
+        max_wait_ms=cfg.TEACHER.SERVER.MAX_WAIT_MS,
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("local teacher server.")
+    parser.add_argument("--cfg", type=str, default="")
+    parser.add_argument("opts", nargs="*")
+    args = parser.parse_args()
+
+    cfg.merge_from_file(args.cfg)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+
+    main(cfg)
@@ -9,11 +9,12 @@ import torch.backends.cudnn as cudnn
 import torch.nn as nn
 
 from mdistiller.dataset import get_dataset
-from mdistiller.distillers import get_distiller
+from mdistiller.distillers import get_distiller, distiller_dict
 from mdistiller.engine import Trainer
 from mdistiller.engine.cfg import CFG as cfg
 from mdistiller.engine.cfg import dump_cfg, show_cfg
 from mdistiller.engine.utils import log_msg
+from mdistiller.engine.device import setup_device, wrap_distiller
 
 cudnn.benchmark = True
 
@@ -52,10 +53,13 @@ def main(cfg, resume, opts, group_flag=False, id=""):
 
     # cfg & loggers
     show_cfg(cfg)
+    # init execution backend before any parallel work
+    device = setup_device(cfg)
     # init dataloader & models
-    train_loader, val_loader, num_data, num_classes = get_dataset(cfg)
+    train_loader, val_loader, num_data, num_classes = get_dataset(
+        cfg, teacher_feature_keys=distiller_dict[cfg.DISTILLER.TYPE].get_teacher_feature_keys(cfg))
 
-    distiller = get_distiller(cfg, num_data=num_data)
+    distiller = get_distiller(cfg, num_data=num_data, train_loader=train_loader)
 
     if cfg.DISTILLER.TYPE != "NONE":
         print(
@@ -67,10 +71,7 @@ def main(cfg, resume, opts, group_flag=False, id=""):
             )
         )
 
-    # backward compatibility for `.module`:
-    # We recommend to use one GPU since DP is deprecated:
-    # https://github.com/pytorch/pytorch/issues/65936
-    distiller = torch.nn.DataParallel(distiller.cuda())
+    distiller = wrap_distiller(distiller, cfg, device)
 
     if int(os.environ.get("USE_TORCH_COMPILE", "0")):
         # require torch>=2.0
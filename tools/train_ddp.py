@@ -13,11 +13,12 @@ from torch.distributed.elastic.multiprocessing.errors import record
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from mdistiller.dataset import get_dataset
-from mdistiller.distillers import get_distiller
+from mdistiller.distillers import get_distiller, distiller_dict
 from mdistiller.engine import Trainer
 from mdistiller.engine.cfg import CFG as cfg
 from mdistiller.engine.cfg import dump_cfg, show_cfg
 from mdistiller.engine.utils import log_msg, is_main_process, local_print
+from mdistiller.engine.device import setup_device, get_device, get_memory_format
 
 cudnn.benchmark = True
 
@@ -67,12 +68,15 @@ def main(cfg, resume, opts, group_flag=False, id=""):
 
     # init dist
     local_rank = dist.get_rank()
-    torch.cuda.set_device(local_rank)
+    if torch.cuda.is_available() and cfg.DEVICE.TYPE != "cpu":
+        torch.cuda.set_device(local_rank)
+    device = setup_device(cfg)
 
     # init dataloader & models
-    train_loader, val_loader, num_data, num_classes = get_dataset(cfg)
+    train_loader, val_loader, num_data, num_classes = get_dataset(
+        cfg, teacher_feature_keys=distiller_dict[cfg.DISTILLER.TYPE].get_teacher_feature_keys(cfg))
 
-    distiller = get_distiller(cfg, num_data=num_data)
+    distiller = get_distiller(cfg, num_data=num_data, train_loader=train_loader)
 
     if cfg.DISTILLER.TYPE != "NONE":
         local_print(
@@ -83,11 +87,13 @@ def main(cfg, resume, opts, group_flag=False, id=""):
                 "INFO",
             ))
 
-    distiller = nn.SyncBatchNorm.convert_sync_batchnorm(distiller)
-    distiller = distiller.cuda()
+    if device.type == "cuda":
+        distiller = nn.SyncBatchNorm.convert_sync_batchnorm(distiller)
+    distiller = distiller.to(
+        device, memory_format=get_memory_format(cfg, device))
     distiller = DDP(
         distiller,
-        device_ids=[local_rank],
+        device_ids=[local_rank] if device.type == "cuda" else None,
         # find_unused_parameters=True,
         static_graph=True
     )
@@ -114,9 +120,6 @@ def main(cfg, resume, opts, group_flag=False, id=""):
 
 
 def setup_cfg(args):
-    cfg.merge_from_file(args.cfg)
-    cfg.merge_from_list(args.opts)
-
     if cfg.DATASET.ENHANCE_AUGMENT:
         cfg.EXPERIMENT.TAG += ",aug"
 
@@ -128,6 +131,9 @@ def setup_cfg(args):
 
     local_print(f"resize batch_size {cfg.SOLVER.BATCH_SIZE} to {cfg.SOLVER.BATCH_SIZE // world_size}")
     cfg.SOLVER.BATCH_SIZE = cfg.SOLVER.BATCH_SIZE // world_size
+    if cfg.SOLVER.ACCUM_STEPS > 1:
+        local_print(
+            f"micro batch_size: {cfg.SOLVER.BATCH_SIZE // cfg.SOLVER.ACCUM_STEPS} x {cfg.SOLVER.ACCUM_STEPS} accumulation steps")
 
     local_print(
         f"resize test batch_size {cfg.DATASET.TEST.BATCH_SIZE} to {cfg.DATASET.TEST.BATCH_SIZE // world_size}")
@@ -169,7 +175,12 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    dist.init_process_group(backend='nccl')
+    cfg.merge_from_file(args.cfg)
+    cfg.merge_from_list(args.opts)
+
+    # the backend of the model device, eg: gloo for DEVICE.TYPE cpu on a gpu node
+    dist.init_process_group(
+        backend='nccl' if get_device(cfg).type == "cuda" else 'gloo')
     local_rank = dist.get_rank()
     world_size = dist.get_world_size()
     local_print(f"start local_rank: {local_rank}, world_size: {world_size}")
@@ -0,0 +1,118 @@
+"""
+Train several runs (eg: a hyperparameter sweep or seeds) in one process:
+one dataloader and one teacher forward per batch for all the runs,
+see MultiStudentTrainer. Each run logs & saves checkpoints as tools/train.py.
+
+Example:
+    # 3x2 grid of GDKD.W1 x GDKD.TOPK
+    python -m tools.train_multi --cfg configs/cifar100/gdkd.yaml \\
+        --grid GDKD.W1=1.0,2.0,4.0 GDKD.TOPK=5,10
+    # explicit runs
+    python -m tools.train_multi --cfg configs/cifar100/gdkd.yaml \\
+        --runs "GDKD.T 2.0" "GDKD.T 4.0" -- SOLVER.EPOCHS 120
+"""
+import argparse
+import itertools
+from datetime import datetime
+
+import torch.backends.cudnn as cudnn
+
+from mdistiller.dataset import get_dataset
+from mdistiller.distillers import get_distiller, get_prepared_teacher, get_teacher, distiller_dict
+from mdistiller.engine import MultiStudentTrainer
+from mdistiller.engine.cfg import CFG
+from mdistiller.engine.cfg import show_cfg
+from mdistiller.engine.utils import log_msg
+from mdistiller.models import merge_feature_taps
+from mdistiller.engine.device import setup_device, wrap_distiller
+
+cudnn.benchmark = True
+
+
+def get_run_opts(args):
+    if args.runs:
+        return [run.split() for run in args.runs]
+    if args.grid:
+        keys, values = [], []
+        for item in args.grid:
+            k, v = item.split("=", 1)
+            keys.append(k)
+            values.append(v.split(","))
+        return [
+            [x for kv in zip(keys, combination) for x in kv]
+            for combination in itertools.product(*values)
+        ]
+    return [[]]
+
+
+def get_experiment_name(cfg, run_opts):
+    experiment_name = cfg.EXPERIMENT.NAME
+    if experiment_name == "":
+        experiment_name = cfg.EXPERIMENT.TAG
+    if run_opts:
+        experiment_name += "_" + ",".join(
+            "{}={}".format(k, v) for k, v in zip(run_opts[::2], run_opts[1::2]))
+    experiment_name = experiment_name.replace(" ", "")
+    return experiment_name + f'_{datetime.now().strftime("%Y-%m-%d-%H-%M-%S")}'
+
+
+def main(args):
+    cfgs = []
+    experiment_names = []
+    for run_opts in get_run_opts(args):
+        cfg = CFG.clone()
+        cfg.merge_from_file(args.cfg)
+        cfg.merge_from_list(args.opts + run_opts)
+        # wandb runs are not supported in one process
+        cfg.LOG.WANDB = False
+        cfg.freeze()
+        cfgs.append(cfg)
+        experiment_names.append(get_experiment_name(cfg, run_opts))
+    show_cfg(cfgs[0])
+
+    device = setup_device(cfgs[0])
+    # the teacher features of all the runs
+    teacher_feature_keys = []
+    for cfg in cfgs:
+        teacher_feature_keys += distiller_dict[cfg.DISTILLER.TYPE].get_teacher_feature_keys(cfg) or []
+    train_loader, val_loader, num_data, num_classes = get_dataset(
+        cfgs[0], teacher_feature_keys=teacher_feature_keys)
+
+    # the shared teacher returns the feature taps of all the runs
+    teacher_taps = merge_feature_taps(*[
+        distiller_dict[cfg.DISTILLER.TYPE].get_feature_taps(cfg)[1] for cfg in cfgs])
+    # the teacher is loaded, tapped & prepared (eg: TEACHER.QUANT) once for all the runs
+    teacher_cfgs = [cfg for cfg in cfgs if cfg.DISTILLER.TYPE != "NONE"]
+    teacher = get_teacher(teacher_cfgs[0]) if teacher_cfgs else None
+    distillers = [
+        get_distiller(cfg, teacher=teacher, num_data=num_data, teacher_feature_taps=teacher_taps)
+        for cfg in cfgs
+    ]
+    if teacher is not None:
+        teacher = get_prepared_teacher(teacher, teacher_cfgs[0], teacher_taps, train_loader)
+        for distiller, cfg in zip(distillers, cfgs):
+            if cfg.DISTILLER.TYPE != "NONE":
+                distiller.teacher = teacher
+    distillers = [wrap_distiller(d, cfg, device) for d, cfg in zip(distillers, cfgs)]
+
+    print(log_msg("Runs: {}".format(experiment_names), "INFO"))
+    trainer = MultiStudentTrainer(
+        experiment_names, distillers, train_loader, val_loader, cfgs,
+        stack_students=not args.no_stack)
+    trainer.train(resume=args.resume)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("train several runs with one teacher forward.")
+    parser.add_argument("--cfg", type=str, default="")
+    parser.add_argument("--runs", type=str, nargs="+", default=None,
+                        help='opts of each run, eg: "GDKD.T 2.0" "GDKD.T 4.0"')
+    parser.add_argument("--grid", type=str, nargs="+", default=None,
+                        help="grid of the runs, eg: GDKD.W1=1.0,2.0 GDKD.TOPK=5,10")
+    parser.add_argument("--no-stack", action="store_true",
+                        help="do not vmap the students of the same architecture")
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("opts", nargs="*")
+    args = parser.parse_args()
+
+    main(args)
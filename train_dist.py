@@ -25,6 +25,8 @@ if __name__ == "__main__":
     parser.add_argument("--resume", action="store_true")
     parser.add_argument("--data_workers", type=int, default=None)
     parser.add_argument("--wandb_model_log", action="store_true")
+    parser.add_argument("--teacher_server", action="store_true",
+                        help="share one teacher server among the tests")
     parser.add_argument("opts", nargs="*")
 
     args = parser.parse_args()
@@ -56,6 +58,15 @@ if __name__ == "__main__":
         cmds.append("--wandb_model_log")
     cmds.extend(args.opts)
 
+    server = None
+    if args.teacher_server:
+        server_cmds = ["python", "-m", "tools.teacher_server",
+                       "--cfg", args.cfg] + args.opts
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=str(allgpu_ids[0]))
+        print(f'Running: {" ".join(server_cmds)}')
+        server = subprocess.Popen(server_cmds, env=env)
+        cmds.extend(["TEACHER.SERVER.ENABLE", "True"])
+
     executor = ProcessPoolExecutor(args.num_tests)
 
     try:
@@ -84,3 +95,6 @@ if __name__ == "__main__":
         print(log_msg("Training failed", "ERROR"))
     finally:
         executor.shutdown(wait=True)
+        if server is not None:
+            server.terminate()
+            server.wait()